@@ -0,0 +1,190 @@
+# archive.py
+import datetime
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+MESSAGE_COLUMNS = (
+    "message_id, chat_id, sender_id, content, created_at, reply_to, forwarded_from, message_type, media_path, "
+    "version, pinned, read_status, deleted, edited"
+)
+
+# Created inside the attached file, so unqualified names in the triggers refer to that file's tables
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {schema}.messages (
+        message_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        content TEXT,
+        created_at INTEGER NOT NULL,
+        reply_to INTEGER,
+        forwarded_from INTEGER,
+        message_type TEXT,
+        media_path TEXT,
+        version INTEGER DEFAULT 1,
+        pinned INTEGER DEFAULT 0,
+        read_status INTEGER DEFAULT 0,
+        deleted INTEGER DEFAULT 0,
+        edited INTEGER DEFAULT 0,
+        PRIMARY KEY (chat_id, message_id)
+    );
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.messages_fts USING fts5(
+        content, content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+    END;
+"""
+
+
+def month_of(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y_%m")
+
+
+class MessageArchive:
+    # Messages older than retention_days live in one SQLite file per month next to the main database.
+    # archive_months in the main database records which chats each file holds and their id range, so
+    # readers only ATTACH a file when a page or a search actually reaches into it.
+    def __init__(self, pool, directory: str, retention_days: float = 180, max_attached: int = 4):
+        self.pool = pool
+        self.directory = directory
+        self.prefix = os.path.splitext(os.path.basename(pool.db_path))[0]
+        self.retention_days = retention_days
+        self.max_attached = max_attached  # Per connection, SQLite allows 10 attached databases by default
+        self._ranges = None  # chat_id -> [(month, min_id, max_id)], loaded on first use
+        self._attached = {}  # id(connection) -> OrderedDict of attached months, least recently used first
+        self.batch_size = 5000
+
+    def path_for(self, month: str) -> str:
+        return os.path.join(self.directory, f"{self.prefix}_{month}.db")
+
+    async def load(self):
+        if self._ranges is not None:
+            return
+        async with self.pool.reader() as conn:
+            async with conn.execute("SELECT chat_id, month, min_id, max_id FROM archive_months") as cursor:
+                rows = await cursor.fetchall()
+        ranges = {}
+        for chat_id, month, min_id, max_id in rows:
+            ranges.setdefault(chat_id, []).append((month, min_id, max_id))
+        self._ranges = ranges
+
+    def contains(self, chat_id: int, message_id: int) -> bool:
+        # Only an id range, ids in it that were never fetched also count as archived
+        return any(low <= message_id <= high for _, low, high in (self._ranges or {}).get(chat_id, ()))
+
+    def months_below(self, chat_id: int, message_id: int = None):
+        # Months that may hold ids below message_id (None = any), nearest first
+        months = (self._ranges or {}).get(chat_id, ())
+        months = [entry for entry in months if message_id is None or entry[1] < message_id]
+        return sorted(months, key=lambda entry: entry[2], reverse=True)
+
+    def months_above(self, chat_id: int, message_id: int):
+        months = [entry for entry in (self._ranges or {}).get(chat_id, ()) if entry[2] > message_id]
+        return sorted(months, key=lambda entry: entry[1])
+
+    def all_months(self):
+        return sorted({month for ranges in (self._ranges or {}).values() for month, _, _ in ranges}, reverse=True)
+
+    async def attach(self, conn, month: str) -> str:
+        # ATTACH is per connection, each reader keeps its own few most recently used months attached
+        attached = self._attached.setdefault(id(conn), OrderedDict())
+        schema = f"archive_{month}"
+        if schema in attached:
+            attached.move_to_end(schema)
+            return schema
+        if len(attached) >= self.max_attached:
+            old_schema, _ = attached.popitem(last=False)
+            await conn.execute(f"DETACH DATABASE {old_schema}")
+        await conn.execute(f"ATTACH DATABASE ? AS {schema}", (self.path_for(month),))
+        attached[schema] = month
+        logging.debug(f"ARCHIVE_ATTACHED: month={month}")
+        return schema
+
+    async def archive_old(self, retention_days: float = None) -> int:
+        # Moves messages in committed batches. Rows are copied before they are deleted from the main database,
+        # an interrupted run leaves duplicates that the next run (and the readers) resolve in favour of main.
+        retention_days = self.retention_days if retention_days is None else retention_days
+        cutoff = int(time.time() - retention_days * 86400)
+        start_time = time.time()
+        await self.load()
+        by_month = {}
+        async with self.pool.reader() as conn:
+            async with conn.execute("SELECT rowid, created_at FROM messages WHERE created_at < ?", (cutoff,)) as cursor:
+                async for rowid, created_at in cursor:
+                    by_month.setdefault(month_of(created_at), []).append(rowid)
+        if by_month:
+            os.makedirs(self.directory, exist_ok=True)
+        moved = 0
+        for month, rowids in sorted(by_month.items()):
+            for start in range(0, len(rowids), self.batch_size):
+                moved += await self._move(month, rowids[start : start + self.batch_size])
+            logging.info(f"ARCHIVE_MONTH: month={month}, messages={len(rowids)}")
+        logging.info(f"ARCHIVE_DONE: moved={moved}, months={len(by_month)}, time={time.time() - start_time:.2f}s")
+        return moved
+
+    async def _move(self, month: str, rowids) -> int:
+        batch = json.dumps(rowids)
+        async with self.pool.writer() as conn:
+            # ATTACH is not allowed inside a transaction, so this bypasses the write queue and holds the writer
+            # for one batch at a time
+            await conn.execute("ATTACH DATABASE ? AS archive_target", (self.path_for(month),))
+            try:
+                await conn.executescript(ARCHIVE_SCHEMA.format(schema="archive_target"))
+                await conn.execute("BEGIN")
+                # The copy in main is never older than an archived one (edits of archived messages land in main)
+                await conn.execute(
+                    f"""
+                    INSERT INTO archive_target.messages ({MESSAGE_COLUMNS})
+                    SELECT {MESSAGE_COLUMNS} FROM main.messages WHERE rowid IN (SELECT value FROM json_each(?))
+                    ON CONFLICT (chat_id, message_id) DO UPDATE SET
+                        content = excluded.content, version = excluded.version, pinned = excluded.pinned,
+                        deleted = excluded.deleted, edited = excluded.edited, media_path = excluded.media_path
+                    """,
+                    (batch,),
+                )
+                async with conn.execute(
+                    """
+                    SELECT chat_id, min(message_id), max(message_id), count(*) FROM main.messages
+                    WHERE rowid IN (SELECT value FROM json_each(?))
+                    GROUP BY chat_id
+                    """,
+                    (batch,),
+                ) as cursor:
+                    ranges = await cursor.fetchall()
+                await conn.executemany(
+                    """
+                    INSERT INTO main.archive_months (chat_id, month, min_id, max_id, messages) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (chat_id, month) DO UPDATE SET
+                        min_id = min(min_id, excluded.min_id), max_id = max(max_id, excluded.max_id),
+                        messages = messages + excluded.messages
+                    """,
+                    [(chat_id, month, low, high, count) for chat_id, low, high, count in ranges],
+                )
+                cursor = await conn.execute(
+                    "DELETE FROM main.messages WHERE rowid IN (SELECT value FROM json_each(?))", (batch,)
+                )
+                moved = cursor.rowcount
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+            finally:
+                await conn.execute("DETACH DATABASE archive_target")
+        for chat_id, low, high, _ in ranges:
+            months = self._ranges.setdefault(chat_id, [])
+            for index, (known_month, known_low, known_high) in enumerate(months):
+                if known_month == month:
+                    months[index] = (month, min(low, known_low), max(high, known_high))
+                    break
+            else:
+                months.append((month, low, high))
+        return moved
@@ -0,0 +1,193 @@
+# backfill.py
+import asyncio
+import logging
+import time
+
+from telethon.errors import FloodWaitError, RPCError
+
+from ratelimit import API_BURST, TokenBucket
+from tg_api import entity_info
+
+
+class BackfillEngine:
+    def __init__(
+        self,
+        manager,
+        workers: int = 4,
+        rate: float = None,
+        burst: int = API_BURST,
+        page_size: int = 100,
+        progress=None,
+        report_interval: float = 5.0,
+    ):
+        self.manager = manager
+        self.client = manager.client
+        self.workers_count = workers
+        # The manager's, shared with prefetch and media downloads. A rate given here gets a bucket of its own.
+        self.bucket = manager.api_bucket if rate is None else TokenBucket(rate, burst)
+        self.page_size = page_size  # messages.getHistory returns at most 100 per request
+        self.progress = progress  # Called with stats() after every page
+        self.report_interval = report_interval
+        self.chats_total = 0
+        self.chats_done = 0
+        self.messages = 0
+        self.requests = 0
+        self.flood_waits = 0
+        self.errors = 0
+        self.started_at = None
+
+    async def _request(self, call, *args, **kwargs):
+        while True:
+            await self.bucket.acquire()
+            self.requests += 1
+            try:
+                return await call(*args, **kwargs)
+            except FloodWaitError as exc:
+                self.flood_waits += 1
+                self.bucket.pause(exc.seconds + 1)
+                logging.warning(f"BACKFILL_FLOOD_WAIT: seconds={exc.seconds}")
+
+    async def _load_dialogs(self):
+        dialogs = await self._request(self.client.get_dialogs)
+        for dialog in dialogs:
+            chat = entity_info(dialog.entity)
+            self.manager.entities.put(dialog.id, chat)
+            await self.manager.save_chat(dialog.id, chat.chat_type, chat.title)
+        # Most recently active first, the chats the user is likely to open get their history soonest
+        return sorted(
+            dialogs, key=lambda dialog: dialog.date.timestamp() if dialog.date else 0, reverse=True
+        )
+
+    async def run(self, limit: int = 1000, dialogs=None):
+        # Fetches up to limit messages per chat going back from the newest one. Checkpoints in chat_sync make a
+        # restarted run (or a later one with a bigger limit) continue below the oldest message already fetched.
+        self.started_at = time.monotonic()
+        if dialogs is None:
+            dialogs = await self._load_dialogs()
+        checkpoints = {
+            chat_id: (oldest_id, fetched, complete)
+            for chat_id, oldest_id, fetched, complete in await self.manager._fetch_with_semaphore(
+                "SELECT chat_id, oldest_id, backfill_fetched, backfill_complete FROM chat_sync"
+            )
+        }
+        queue = asyncio.Queue()
+        for dialog in dialogs:
+            oldest_id, fetched, complete = checkpoints.get(dialog.id, (None, 0, 0))
+            if complete or fetched >= limit:
+                continue
+            queue.put_nowait((dialog.id, oldest_id, fetched))
+        self.chats_total = queue.qsize()
+        logging.info(f"BACKFILL_START: chats={self.chats_total}, limit={limit}, workers={self.workers_count}")
+
+        reporter = asyncio.get_running_loop().create_task(self._report())
+        try:
+            await asyncio.gather(*(self._worker(queue, limit) for _ in range(self.workers_count)))
+        finally:
+            reporter.cancel()
+        logging.info(f"BACKFILL_DONE: {self.stats()}")
+        return self.stats()
+
+    async def _worker(self, queue, limit: int):
+        while not queue.empty():
+            chat_id, oldest_id, fetched = queue.get_nowait()
+            try:
+                await self._backfill_chat(chat_id, oldest_id, fetched, limit)
+            except RPCError as exc:
+                # No access any more, banned, etc. The checkpoint stays, the next run tries again.
+                self.errors += 1
+                logging.error(f"BACKFILL_CHAT_ERR: chat_id={chat_id}, exc={exc}")
+            except Exception as exc:
+                self.errors += 1
+                logging.exception(f"BACKFILL_CHAT_ERR: chat_id={chat_id}, exc={exc}")
+            self.chats_done += 1
+
+    async def _backfill_chat(self, chat_id: int, oldest_id, fetched: int, limit: int):
+        while fetched < limit:
+            # The page is fetched without the chat's sync lock, so sync_chat and fill_gaps of a chat the user opens
+            # do not wait behind the rate limit. The lock is only taken to write it: if they moved the checkpoint in
+            # the meantime the page is dropped and the next one starts from where they left the run.
+            stored_oldest_id, _, stored_complete = checkpoint = await self.manager._sync_state(chat_id)
+            if stored_complete:
+                break
+            if stored_oldest_id is not None:
+                oldest_id = stored_oldest_id
+            # Messages below offset_id, 0 starts from the newest
+            offset_id = oldest_id or 0
+            messages = await self._request(
+                self.client.get_messages,
+                chat_id,
+                limit=min(self.page_size, limit - fetched),
+                offset_id=offset_id,
+            )
+            messages = [message for message in messages if message is not None]
+            rows = [row for row in (self.manager._history_row(chat_id, message) for message in messages) if row]
+            rows = await self.manager._unknown_rows(chat_id, rows)
+            complete = len(messages) < min(self.page_size, limit - fetched)
+            page_oldest_id = min((message.id for message in messages), default=oldest_id)
+            # The first page starts at the newest message, so it also moves the sync high-water mark
+            newest_id = max((message.id for message in messages), default=None) if not offset_id else None
+            high = offset_id - 1 if offset_id else newest_id
+            synced = (1 if complete else page_oldest_id, high) if high is not None else None
+            async with self.manager._sync_locks.setdefault(chat_id, asyncio.Lock()):
+                oldest_now, _, complete_now = await self.manager._sync_state(chat_id)
+                if (oldest_now, complete_now) != (checkpoint[0], checkpoint[2]):
+                    logging.info(f"BACKFILL_PAGE_DROPPED: chat_id={chat_id}, offset_id={offset_id}")
+                    continue
+                await self.manager.write_queue.run(
+                    self._write_page,
+                    chat_id,
+                    rows,
+                    self.manager._history_users(messages),
+                    page_oldest_id,
+                    newest_id,
+                    synced,
+                    fetched + len(messages),
+                    complete,
+                )
+            oldest_id = page_oldest_id
+            fetched += len(messages)
+            self.manager._queue_history_media(rows, messages)
+            self.messages += len(rows)
+            if self.progress:
+                self.progress(self.stats())
+            if complete:
+                break
+        logging.info(f"BACKFILL_CHAT: chat_id={chat_id}, fetched={fetched}, oldest_id={oldest_id}")
+
+    async def _write_page(self, conn, chat_id, rows, users, oldest_id, newest_id, synced, fetched, complete):
+        # Messages and their checkpoint commit together, a crash cannot skip or refetch a page
+        if rows:
+            await self.manager._write_history(conn, rows, users)
+        if synced:
+            await self.manager._add_synced_range(conn, chat_id, *synced)
+        await conn.execute(
+            """
+            INSERT INTO chat_sync (chat_id, oldest_id, newest_id, backfill_fetched, backfill_complete, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                oldest_id = excluded.oldest_id,
+                newest_id = max(coalesce(newest_id, excluded.newest_id), coalesce(excluded.newest_id, newest_id)),
+                backfill_fetched = excluded.backfill_fetched,
+                backfill_complete = excluded.backfill_complete,
+                updated_at = excluded.updated_at
+            """,
+            (chat_id, oldest_id, newest_id, fetched, int(complete), int(time.time())),
+        )
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            logging.info(f"BACKFILL_PROGRESS: {self.stats()}")
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "chats_done": self.chats_done,
+            "chats_total": self.chats_total,
+            "messages": self.messages,
+            "requests": self.requests,
+            "flood_waits": self.flood_waits,
+            "errors": self.errors,
+            "elapsed": round(elapsed, 1),
+            "messages_per_second": round(self.messages / elapsed, 1) if elapsed else 0.0,
+        }
@@ -0,0 +1,835 @@
+# bench.py
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import aiosqlite
+
+from db import DatabasePool
+from migrations import MIGRATIONS
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        content TEXT,
+        created_at INTEGER NOT NULL,
+        deleted INTEGER DEFAULT 0,
+        UNIQUE(chat_id, message_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created_at);
+"""
+
+BATCH_QUERY = """
+    SELECT m.message_id, m.content, u.username, m.created_at, m.sender_id
+    FROM messages m JOIN users u ON m.sender_id = u.user_id
+    WHERE m.chat_id = ? AND m.deleted = 0
+    ORDER BY m.message_id DESC LIMIT 50
+"""
+
+
+def build_database(path: str, messages: int, chats: int = 1000, users: int = 5000):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    # chat 0 is scratch space for the writer side of the mixed workload
+    conn.execute("DELETE FROM messages WHERE chat_id = 0")
+    conn.commit()
+    if conn.execute("SELECT count(*) FROM messages").fetchone()[0] >= messages:
+        conn.close()
+        return
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+        ((user_id, f"user{user_id}") for user_id in range(1, users + 1)),
+    )
+    rnd = random.Random(1)
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO messages (message_id, chat_id, sender_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+        (
+            (i // chats + 1, i % chats + 1, rnd.randint(1, users), f"message body {i} " * 3, now - messages + i)
+            for i in range(messages)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+async def run_mixed(read, write, duration: float, readers: int, chats: int, first_id: int = 1):
+    counters = {"reads": 0, "writes": 0}
+    deadline = time.perf_counter() + duration
+
+    async def reader_task():
+        rnd = random.Random()
+        while time.perf_counter() < deadline:
+            await read(BATCH_QUERY, (rnd.randint(1, chats),))
+            counters["reads"] += 1
+
+    async def writer_task():
+        message_id = first_id
+        while time.perf_counter() < deadline:
+            message_id += 1
+            await write(
+                "INSERT INTO messages (message_id, chat_id, sender_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                (message_id, 0, 1, "backfill", int(time.time())),
+            )
+            counters["writes"] += 1
+
+    await asyncio.gather(writer_task(), *(reader_task() for _ in range(readers)))
+    return counters["reads"] / duration, counters["writes"] / duration
+
+
+async def bench_pool(args):
+    path = args.db or os.path.join(tempfile.gettempdir(), f"teleforge_bench_{args.messages}.db")
+    print(f"building {args.messages} messages in {path} ...")
+    build_database(path, args.messages)
+
+    semaphore = asyncio.Semaphore(1)
+
+    async def legacy_read(query, params):
+        async with semaphore:
+            async with aiosqlite.connect(path, timeout=10) as conn:
+                async with conn.execute(query, params) as cursor:
+                    return await cursor.fetchall()
+
+    async def legacy_write(query, params):
+        async with semaphore:
+            async with aiosqlite.connect(path, timeout=10) as conn:
+                await conn.execute(query, params)
+                await conn.commit()
+
+    pool = DatabasePool(path, readers=args.readers)
+
+    async def pool_read(query, params):
+        async with pool.reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                return await cursor.fetchall()
+
+    async def pool_write(query, params):
+        async with pool.writer() as conn:
+            await conn.execute(query, params)
+            await conn.commit()
+
+    before = await run_mixed(legacy_read, legacy_write, args.duration, args.readers, 1000)
+    print(f"connect-per-query: reads={before[0]:.0f} q/s, writes={before[1]:.0f} q/s")
+    after = await run_mixed(pool_read, pool_write, args.duration, args.readers, 1000, first_id=10_000_000)
+    print(f"pool (1w+{args.readers}r): reads={after[0]:.0f} q/s, writes={after[1]:.0f} q/s")
+    await pool.close()
+
+
+class StubClient:
+    # Enough of TelegramClient for a TelegramChatManager that never talks to the network
+    def on(self, event):
+        return lambda handler: handler
+
+
+WORDS = (
+    "сегодня обновление канала новости подробности ссылка внутри поста update release notes changelog fixed "
+    "версия важно друзья спасибо за поддержку стрим начнётся через минут розыгрыш итоги голосования"
+).split()
+
+
+def build_history_database(path: str, messages: int, now: int):
+    # The layout before compression: every event stores its full text and replaced_content (schema version 3)
+    async def create():
+        async with aiosqlite.connect(path) as conn:
+            for target, _, step in MIGRATIONS:
+                if target <= 3:
+                    await step(conn, None)
+
+    asyncio.run(create())
+    conn = sqlite3.connect(path)
+    rnd = random.Random(1)
+    message_rows = []
+    event_rows = []
+    for message_id in range(1, messages + 1):
+        created_at = now - 90 * 86400 + message_id * 60 * 86400 // messages
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 120)))
+        event_rows.append((1, message_id, "created", text, created_at, text, 1))
+        version = 1
+        for _ in range(rnd.choice((0, 0, 0, 1, 2, 5))):
+            words = text.split()
+            words[rnd.randrange(len(words))] = rnd.choice(WORDS)
+            edited = " ".join(words)
+            version += 1
+            event_rows.append((1, message_id, "edited", edited, created_at + version, text, version))
+            text = edited
+        if rnd.random() < 0.05:
+            event_rows.append((1, message_id, "deleted", text, created_at + 100, text, version))
+        message_rows.append((message_id, 1, 1, text, created_at, version))
+    conn.executemany(
+        "INSERT INTO messages (message_id, chat_id, sender_id, content, created_at, version) VALUES (?, ?, ?, ?, ?, ?)",
+        message_rows,
+    )
+    conn.executemany(
+        """
+        INSERT INTO message_events (chat_id, message_id, event_type, content, created_at, replaced_content, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        event_rows,
+    )
+    conn.commit()
+    conn.close()
+    return len(event_rows)
+
+
+def database_size(path: str) -> int:
+    conn = sqlite3.connect(path)
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(path)
+
+
+async def bench_history(args):
+    from tg_api import TelegramChatManager
+
+    path = args.db or os.path.join(tempfile.gettempdir(), f"teleforge_history_{args.messages}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    print(f"building {args.messages} messages with edit history in {path} ...")
+    events = await asyncio.to_thread(build_history_database, path, args.messages, int(time.time()))
+    legacy_size = database_size(path)
+    rnd = random.Random(2)
+    sample = [rnd.randint(1, args.messages) for _ in range(args.lookups)]
+
+    async with aiosqlite.connect(path) as conn:
+        start = time.perf_counter()
+        for message_id in sample:
+            async with conn.execute(
+                "SELECT * FROM message_events WHERE chat_id = 1 AND message_id = ? ORDER BY created_at", (message_id,)
+            ) as cursor:
+                await cursor.fetchall()
+        legacy_latency = (time.perf_counter() - start) / len(sample)
+
+    manager = TelegramChatManager(path, StubClient())
+    start = time.perf_counter()
+    await manager._create_tables()
+    migrate_time = time.perf_counter() - start
+    start = time.perf_counter()
+    packed = await manager.compact_history(cold_after=args.cold_days * 86400)
+    compact_time = time.perf_counter() - start
+    await manager.write_queue.close()
+    await manager.db.close()
+    compressed_size = database_size(path)
+
+    manager = TelegramChatManager(path, StubClient())
+    start = time.perf_counter()
+    for message_id in sample:
+        await manager.get_message_history(1, message_id)
+    latency = (time.perf_counter() - start) / len(sample)
+    await manager.close()
+
+    print(f"events: {events}, packed cold rows: {packed} (migrate {migrate_time:.1f}s, compact {compact_time:.1f}s)")
+    print(f"full text + replaced_content: {legacy_size / 2**20:.1f} MiB, history {legacy_latency * 1000:.3f} ms")
+    print(f"delta + dictionary:          {compressed_size / 2**20:.1f} MiB, history {latency * 1000:.3f} ms")
+
+
+class StartupClient(StubClient):
+    # A logged-in account whose every request takes latency seconds. Offline, connecting fails after the latency.
+    def __init__(self, latency: float, dialogs: int, offline: bool = False):
+        self.latency = latency
+        self.dialogs = dialogs
+        self.offline = offline
+
+    async def start(self):
+        await asyncio.sleep(self.latency)
+        if self.offline:
+            raise ConnectionError("bench: offline")
+        return self
+
+    async def get_me(self):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(id=1, username="bench", first_name="Bench", last_name=None)
+
+    async def get_dialogs(self):
+        await asyncio.sleep(self.latency)
+        now = time.time()
+        return [
+            SimpleNamespace(
+                id=-1000 - i,
+                name=f"chat {i}",
+                entity=SimpleNamespace(title=f"chat {i}", username=f"chat{i}"),
+                unread_count=i % 7,
+                pinned=i < 5,
+                archived=False,
+                date=datetime.datetime.fromtimestamp(now - i * 60, datetime.timezone.utc),
+            )
+            for i in range(self.dialogs)
+        ]
+
+
+def startup_child(args):
+    # One measured start in this process: imports, Qt, migrations and the window up to its first frame
+    from startup import StartupProfiler, import_in_background, open_main_window, start_loop
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    profiler = StartupProfiler()
+    backend = import_in_background(profiler, ("telethon", "tg_api"))
+    with profiler.phase("import PyQt6"):
+        from PyQt6.QtWidgets import QApplication
+    with profiler.phase("QApplication"):
+        app = QApplication([])
+    loop = start_loop(profiler)
+    with profiler.phase("wait imports"):
+        backend.result()
+
+    client = StartupClient(args.latency, args.dialogs, args.offline)
+    window, manager = open_main_window(client, loop, args.db, profiler, app.quit)
+    app.exec()
+    # Not timed: the connect and refresh a real start does in the background, so the next warm start finds a cache
+    try:
+        asyncio.run_coroutine_threadsafe(manager.refresh_dialogs(), loop).result()
+    except ConnectionError:
+        pass  # --offline, the next start finds what the last online one left
+    asyncio.run_coroutine_threadsafe(manager.close(), loop).result()
+    window.close()
+    print(json.dumps(profiler.as_dict()))
+
+
+async def bench_startup(args):
+    path = args.db or os.path.join(tempfile.gettempdir(), "teleforge_startup.db")
+
+    async def measure(cold: bool) -> dict:
+        if cold:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.abspath(__file__),
+            "startup",
+            "--child",
+            "--db",
+            path,
+            "--latency",
+            str(args.latency),
+            "--dialogs",
+            str(args.dialogs),
+            *(["--offline"] if args.offline else []),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await process.communicate()
+        return json.loads(stdout.decode().strip().splitlines()[-1])
+
+    results = {"cold": [], "warm": []}
+    for run in range(args.runs):
+        results["cold"].append(await measure(cold=True))
+        results["warm"].append(await measure(cold=False))  # On the database the cold run left
+        print(f"run {run + 1}/{args.runs}: cold {results['cold'][-1]['first frame']:.0f} ms, "
+              f"warm {results['warm'][-1]['first frame']:.0f} ms")
+
+    phases = list(dict.fromkeys(name for runs in results.values() for result in runs for name in result))
+    print(
+        f"median over {args.runs} runs, {args.dialogs} dialogs, {args.latency * 1000:.0f} ms per request"
+        f"{', offline' if args.offline else ''}. The first frame does not wait for client.start."
+    )
+    print(f"{'phase':<28}{'cold ms':>10}{'warm ms':>10}")
+    for name in phases:
+        cells = []
+        for mode in ("cold", "warm"):
+            values = [result[name] for result in results[mode] if name in result]
+            cells.append(f"{statistics.median(values):>10.1f}" if values else f"{'-':>10}")
+        print(f"{name:<28}{''.join(cells)}")
+
+
+def resize_rows(groups: int, per_group: int):
+    # Rows as get_messages_for_batch returns them, senders alternate every per_group messages
+    random.seed(1)
+    words = "lorem ipsum dolor sit amet привет мир как дела consectetur adipiscing elit".split()
+    rows = []
+    for i in range(groups * per_group):
+        sender = 1 + (i // per_group) % 2
+        text = " ".join(random.choice(words) for _ in range(random.randint(1, 60)))
+        rows.append((i + 1, text, f"user{sender}", 1_700_000_000 + i * 30, sender))
+    return rows
+
+
+async def bench_resize(args):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+
+    from message_view import MessageView
+    from text_layout import TextLayoutCache
+
+    app = QApplication.instance() or QApplication([])
+    rows = resize_rows(args.groups, args.per_group)
+    widths = [args.min_width + (args.max_width - args.min_width) * step // args.steps for step in range(args.steps + 1)]
+    widths += widths[-2::-1]  # Out and back, the way a user drags the window edge
+
+    def sweep(view) -> list:
+        timings = []
+        for width in widths:
+            start = time.perf_counter()
+            view.resize(width, 700)
+            view.doItemsLayout()  # The layout Qt would run 100 ms later, forced so it is timed
+            view.viewport().repaint()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def run(name: str, layouts: TextLayoutCache, precompute: bool):
+        view = MessageView(layouts=layouts)
+        view.resize(args.min_width, 700)
+        view.show()
+        app.processEvents()
+        start = time.perf_counter()
+        view.model().add(rows)
+        view.doItemsLayout()
+        load = (time.perf_counter() - start) * 1000
+        if precompute:  # What the worker does while Qt waits out a resize
+            for width in widths:
+                view.resize(width, 700)
+                app.processEvents()
+                future = view.precompute([row[1] for row in rows])
+                if future is not None:
+                    future.result()
+        timings = sweep(view)
+        print(
+            f"{name:<22}{load:>10.1f}{statistics.median(timings):>12.2f}{max(timings):>10.2f}"
+            f"   {layouts.stats()['hit_rate']:.3f}"
+        )
+        view.close()
+
+    print(f"{args.groups} groups of {args.per_group} messages, {len(widths)} resizes "
+          f"{args.min_width}-{args.max_width} px")
+    print(f"{'':<22}{'load ms':>10}{'median ms':>12}{'max ms':>10}   hit rate")
+    caches = [TextLayoutCache(max_entries=0), TextLayoutCache(), TextLayoutCache()]
+    run("no cache", caches[0], precompute=False)
+    run("cache, first chat", caches[1], precompute=False)
+    run("cache, chat reopened", caches[1], precompute=False)  # The same cache, as when the chat is opened again
+    run("cache, precomputed", caches[2], precompute=True)
+    for layouts in caches:
+        layouts.close()
+
+
+async def bench_theme(args):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication, QLabel, QScrollArea, QVBoxLayout, QWidget
+
+    from message_view import MessageView
+    from theme import PALETTES, Theme
+
+    app = QApplication.instance() or QApplication([])
+    rows = resize_rows(args.groups, args.per_group)
+
+    def per_bubble_sheets():
+        # The widgets the chat used to build: one widget, two labels and an f-string stylesheet per message
+        area = QScrollArea()
+        area.setWidgetResizable(True)
+        container = QWidget()
+        layout = QVBoxLayout(container)
+        for position, (message_id, text, username, created_at, sender_id) in enumerate(rows):
+            first, last = position % args.per_group == 0, position % args.per_group == args.per_group - 1
+            bubble = QWidget()
+            bubble.setStyleSheet(
+                f"background-color: {'#3390FF' if sender_id == 1 else '#2A2F3B'};"
+                f"border-top-left-radius: {12 if first else 4}px; border-top-right-radius: 4px;"
+                f"border-bottom-left-radius: {12 if last else 4}px; border-bottom-right-radius: 4px; color: white;"
+            )
+            bubble_layout = QVBoxLayout(bubble)
+            label = QLabel(text)
+            label.setWordWrap(True)
+            timestamp = QLabel("12:00")
+            timestamp.setStyleSheet("color: gray; font-size: 10px;")
+            bubble_layout.addWidget(label)
+            bubble_layout.addWidget(timestamp)
+            layout.addWidget(bubble)
+        area.setWidget(container)
+        return area
+
+    def shared_theme():
+        view = MessageView(theme=Theme())
+        view.setStyleSheet(view.theme.stylesheet)
+        view.model().add(rows)
+        return view
+
+    def build(make) -> float:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            widget = make()
+            widget.resize(900, 700)
+            widget.show()
+            app.processEvents()
+            timings.append((time.perf_counter() - start) * 1000)
+            widget.close()
+            widget.deleteLater()
+            app.processEvents()
+        return statistics.median(timings)
+
+    print(f"{args.groups} groups of {args.per_group} messages, median of {args.runs} builds")
+    print(f"{'per-bubble stylesheets':<26}{build(per_bubble_sheets):>10.1f} ms")
+    print(f"{'shared theme, painted':<26}{build(shared_theme):>10.1f} ms")
+
+    view = shared_theme()
+    view.resize(900, 700)
+    view.show()
+    app.processEvents()
+    widgets = len(view.findChildren(QWidget))
+    timings = []
+    for name in list(PALETTES) * args.runs:
+        start = time.perf_counter()
+        view.theme.set_palette(name)
+        view.setStyleSheet(view.theme.stylesheet)
+        view.viewport().repaint()
+        timings.append((time.perf_counter() - start) * 1000)
+    created = len(view.findChildren(QWidget)) - widgets
+    print(f"{'theme switch':<26}{statistics.median(timings):>10.1f} ms, {created} widgets created")
+
+
+def chat_dialogs(count: int):
+    # DialogInfo rows with Cyrillic and Latin names, most recent first as refresh_dialogs orders them
+    from tg_api import DialogInfo
+
+    random.seed(1)
+    first = "Алексей Мария Дмитрий Юлия Сергей Анна Иван Ольга Alex Maria Julia John Kate Mike Anna Olga".split()
+    last = "Иванов Петрова Смирнов Кузнецова Попов Smith Brown Ivanov Petrova Miller".split()
+    groups = "Работа Семья Друзья Новости Crypto Python Dev Chat Flood Music".split()
+    dialogs = []
+    for i in range(count):
+        if i % 4 == 0:
+            title = f"{random.choice(groups)} {random.choice(groups)} {i}"
+        else:
+            title = f"{random.choice(first)} {random.choice(last)}"
+        username = f"user{i}" if i % 3 else None
+        dialogs.append(DialogInfo(i + 1, title, username, i % 5, False, 1_700_000_000 - i * 60))
+    return dialogs
+
+
+async def bench_chats(args):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtCore import Qt
+    from PyQt6.QtWidgets import QApplication, QListView, QListWidget, QListWidgetItem
+
+    from chat_list import ChatFilterModel, ChatListModel
+
+    app = QApplication.instance() or QApplication([])
+    dialogs = chat_dialogs(args.dialogs)
+    queries = [args.query[:length] for length in range(1, len(args.query) + 1)]
+    queries += queries[-2::-1]  # Typed, then erased
+
+    def per_item():
+        # The list the sidebar used to be, filtered item by item on every keystroke
+        widget = QListWidget()
+        for dialog in dialogs:
+            item = QListWidgetItem(dialog.title)
+            item.setData(Qt.ItemDataRole.UserRole + 1, dialog.username)
+            widget.addItem(item)
+
+        def search(text):
+            text_lower = text.lower()
+            for i in range(widget.count()):
+                item = widget.item(i)
+                username = item.data(Qt.ItemDataRole.UserRole + 1)
+                username_lower = username.lower() if isinstance(username, str) else ""
+                item.setHidden(not (text_lower in item.text().lower() or text_lower in username_lower))
+
+        return widget, search
+
+    def indexed():
+        chats = ChatListModel()
+        proxy = ChatFilterModel(chats)
+        view = QListView()
+        view.setUniformItemSizes(True)
+        view.setModel(proxy)
+        chats.set_dialogs(dialogs)
+        view.chats, view.proxy = chats, proxy  # Kept alive with the view
+        return view, lambda text: proxy.set_ranks(
+            chats.search_index.search(text, limit=args.results) if text.strip() else None
+        )
+
+    def run(name: str, make):
+        start = time.perf_counter()
+        widget, search = make()
+        widget.resize(300, 700)
+        widget.show()
+        app.processEvents()
+        build = (time.perf_counter() - start) * 1000
+        timings = []
+        for _ in range(args.runs):
+            for query in queries:
+                start = time.perf_counter()
+                search(query)
+                widget.viewport().repaint()
+                timings.append((time.perf_counter() - start) * 1000)
+        print(f"{name:<18}{build:>10.1f}{statistics.median(timings):>12.2f}{max(timings):>10.2f}")
+        widget.close()
+
+    print(f"{args.dialogs} dialogs, typing and erasing {args.query!r}, {args.runs} runs")
+    print(f"{'':<18}{'build ms':>10}{'median ms':>12}{'max ms':>10}")
+    run("per-item hiding", per_item)
+    run("index + proxy", indexed)
+
+
+def build_summary_database(path: str, chats: int, messages: int, now: int):
+    # Every migration, the dialogs of the sidebar and messages spread over the chats with the triggers in place
+    async def create():
+        async with aiosqlite.connect(path) as conn:
+            for _, _, step in MIGRATIONS:
+                await step(conn, None)
+
+    asyncio.run(create())
+    conn = sqlite3.connect(path)
+    rnd = random.Random(1)
+    conn.execute("INSERT INTO account (user_id, updated_at) VALUES (1, ?)", (now,))
+    conn.executemany(
+        """
+        INSERT INTO dialogs (chat_id, title, position, unread_count, last_message_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        [(chat_id, f"chat {chat_id}", chat_id, 0, now, now) for chat_id in range(1, chats + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO messages (message_id, chat_id, sender_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+        (
+            (message_id, rnd.randint(1, chats), rnd.choice((1, 2, 3)), " ".join(rnd.choices(WORDS, k=12)),
+             now - messages + message_id)
+            for message_id in range(1, messages + 1)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+async def bench_summary(args):
+    from tg_api import TelegramChatManager
+
+    path = args.db or os.path.join(tempfile.gettempdir(), f"teleforge_summary_{args.chats}_{args.messages}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    now = int(time.time())
+    print(f"building {args.chats} chats, {args.messages} messages in {path} ...")
+    await asyncio.to_thread(build_summary_database, path, args.chats, args.messages, now)
+
+    def timed(fn) -> float:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    conn = sqlite3.connect(path)
+    last = """
+        SELECT content, created_at FROM messages WHERE chat_id = ? AND deleted = 0 ORDER BY message_id DESC LIMIT 1
+    """
+    unread = "SELECT count(*) FROM messages WHERE chat_id = ? AND deleted = 0 AND sender_id != 1"
+
+    def per_chat():
+        for chat_id in range(1, args.chats + 1):
+            conn.execute(last, (chat_id,)).fetchone()
+            conn.execute(unread, (chat_id,)).fetchone()
+
+    def grouped():
+        conn.execute(
+            """
+            SELECT d.chat_id, d.title, m.content, l.created_at, l.unread FROM dialogs d
+            LEFT JOIN (SELECT chat_id, max(message_id) AS message_id, max(created_at) AS created_at,
+                              sum(sender_id != 1) AS unread
+                       FROM messages WHERE deleted = 0 GROUP BY chat_id) l ON l.chat_id = d.chat_id
+            LEFT JOIN messages m ON m.chat_id = l.chat_id AND m.message_id = l.message_id
+            ORDER BY l.created_at DESC
+            """
+        ).fetchall()
+
+    def insert_live(count: int, offset: int):
+        start = time.perf_counter()
+        for message_id in range(offset, offset + count):
+            conn.execute(
+                "INSERT INTO messages (message_id, chat_id, sender_id, content, created_at) VALUES (?, ?, 2, 'hi', ?)",
+                (message_id, message_id % args.chats + 1, now + message_id),
+            )
+        conn.commit()
+        return (time.perf_counter() - start) * 1e6 / count
+
+    print(f"{'per-chat queries':<24}{timed(per_chat):>10.1f} ms")
+    print(f"{'one aggregate query':<24}{timed(grouped):>10.1f} ms")
+
+    manager = TelegramChatManager(path, StubClient())
+    await manager._create_tables()
+    timings = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        dialogs = await manager.load_dialogs()
+        timings.append((time.perf_counter() - start) * 1000)
+    await manager.close()
+    print(f"{'chat_summary scan':<24}{statistics.median(timings):>10.1f} ms, {len(dialogs)} dialogs")
+
+    with_triggers = insert_live(args.live, args.messages + 1)
+    triggers = conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'chat_summary%'")
+    for (name,) in triggers.fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    without = insert_live(args.live, args.messages + args.live + 1)
+    conn.close()
+    print(f"live insert: {without:.1f} us without the summary triggers, {with_triggers:.1f} us with them")
+
+
+def build_search_database(path: str, messages: int, chats: int, now: int):
+    # Every migration, messages with a "created" event each and an "edited" one for every tenth. Rare words make
+    # the selective queries: "tag<n>" is in one message of every thousand.
+    async def create():
+        async with aiosqlite.connect(path) as conn:
+            for _, _, step in MIGRATIONS:
+                await step(conn, None)
+
+    asyncio.run(create())
+    conn = sqlite3.connect(path)
+    rnd = random.Random(1)
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+        [(user_id, f"user{user_id}", f"User {user_id}") for user_id in (1, 2, 3)],
+    )
+    rows = []
+    for message_id in range(1, messages + 1):
+        words = rnd.choices(WORDS, k=12)
+        if message_id % 1000 == 0:
+            words.append(f"tag{message_id // 1000}")
+        chat_id, sender_id = rnd.randint(1, chats), rnd.choice((1, 2, 3))
+        rows.append((message_id, chat_id, sender_id, " ".join(words), now - messages + message_id))
+    conn.executemany(
+        "INSERT INTO messages (message_id, chat_id, sender_id, content, created_at) VALUES (?, ?, ?, ?, ?)", rows
+    )
+    events = [
+        (chat_id, message_id, "created", content, created_at) for message_id, chat_id, _, content, created_at in rows
+    ]
+    events += [
+        (chat_id, message_id, "edited", content + " " + rnd.choice(WORDS), created_at + 60)
+        for message_id, chat_id, _, content, created_at in rows[::10]
+    ]
+    conn.executemany(
+        "INSERT INTO message_events (chat_id, message_id, event_type, content, created_at, version) "
+        "VALUES (?, ?, ?, ?, ?, 1)",
+        sorted(events, key=lambda event: event[4]),
+    )
+    conn.execute("INSERT INTO message_events_fts (rowid, content) SELECT event_id, content FROM message_events")
+    conn.commit()
+    conn.close()
+
+
+async def bench_search(args):
+    from tg_api import TelegramChatManager
+
+    path = args.db or os.path.join(tempfile.gettempdir(), f"teleforge_search_{args.messages}.db")
+    if not os.path.exists(path):
+        print(f"building {args.messages} messages in {path} ...")
+        await asyncio.to_thread(build_search_database, path, args.messages, args.chats, int(time.time()))
+    manager = TelegramChatManager(path, StubClient())
+    await manager._create_tables()
+    queries = (
+        ("selective", f"tag{args.messages // 2000}"),
+        ("two terms + prefix", f"{WORDS[0]} {WORDS[5][:4]}"),
+        ("common term", WORDS[0]),
+    )
+    modes = (
+        ("messages, rank", {"order": "rank"}),
+        ("messages, recent", {"order": "recent"}),
+        ("history, rank", {"include_history": True, "order": "rank"}),
+        ("history, recent (UI)", {"include_history": True, "order": "recent"}),
+    )
+    print(f"{args.messages} messages, first page of {args.limit}, median of {args.runs} runs, ms")
+    print(f"{'':<22}" + "".join(f"{name:>20}" for name, _ in queries))
+    for mode, options in modes:
+        cells = []
+        for _, query in queries:
+            timings = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                await manager.search(query, include_archive=True, limit=args.limit, **options)
+                timings.append((time.perf_counter() - start) * 1000)
+            cells.append(f"{statistics.median(timings):>20.1f}")
+        print(f"{mode:<22}{''.join(cells)}")
+    await manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TeleForge storage benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    pool = sub.add_parser("pool", help="connect-per-query vs persistent connection pool")
+    pool.add_argument("--messages", type=int, default=1_000_000)
+    pool.add_argument("--readers", type=int, default=4)
+    pool.add_argument("--duration", type=float, default=10.0)
+    pool.add_argument("--db", default=None)
+    pool.set_defaults(func=bench_pool)
+
+    history = sub.add_parser("history", help="message_events size and reconstruction latency, before/after compression")
+    history.add_argument("--messages", type=int, default=200_000)
+    history.add_argument("--cold-days", type=float, default=30.0)
+    history.add_argument("--lookups", type=int, default=2000)
+    history.add_argument("--db", default=None)
+    history.set_defaults(func=bench_history)
+
+    startup = sub.add_parser("startup", help="cold/warm start to the first frame with a stubbed client")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--dialogs", type=int, default=2000)
+    startup.add_argument("--latency", type=float, default=0.1, help="seconds per stubbed request")
+    startup.add_argument("--offline", action="store_true", help="connecting fails, the window opens from the cache")
+    startup.add_argument("--db", default=None)
+    startup.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    startup.set_defaults(func=bench_startup)
+
+    resize = sub.add_parser("resize", help="message view relayout on window resize, with and without the layout cache")
+    resize.add_argument("--groups", type=int, default=150)
+    resize.add_argument("--per-group", type=int, default=3)
+    resize.add_argument("--steps", type=int, default=20)
+    resize.add_argument("--min-width", type=int, default=600)
+    resize.add_argument("--max-width", type=int, default=1400)
+    resize.set_defaults(func=bench_resize)
+
+    theme = sub.add_parser("theme", help="per-bubble stylesheets vs the shared theme, and theme switching")
+    theme.add_argument("--groups", type=int, default=150)
+    theme.add_argument("--per-group", type=int, default=3)
+    theme.add_argument("--runs", type=int, default=5)
+    theme.set_defaults(func=bench_theme)
+
+    chats = sub.add_parser("chats", help="chat list filtering per keystroke, per-item hiding vs index and proxy")
+    chats.add_argument("--dialogs", type=int, default=10000)
+    chats.add_argument("--query", default="алексей")
+    chats.add_argument("--runs", type=int, default=3)
+    chats.add_argument("--results", type=int, default=100, help="best matches shown, as ui.CHAT_RESULTS")
+    chats.set_defaults(func=bench_chats)
+
+    summary = sub.add_parser("summary", help="sidebar rows from per-chat aggregates vs the chat_summary table")
+    summary.add_argument("--chats", type=int, default=10000)
+    summary.add_argument("--messages", type=int, default=500_000)
+    summary.add_argument("--live", type=int, default=5000, help="messages inserted one by one to time the triggers")
+    summary.add_argument("--runs", type=int, default=5)
+    summary.add_argument("--db", default=None)
+    summary.set_defaults(func=bench_summary)
+
+    search = sub.add_parser("search", help="message search latency by query kind, bm25 vs recent order")
+    search.add_argument("--messages", type=int, default=1_000_000)
+    search.add_argument("--chats", type=int, default=1000)
+    search.add_argument("--limit", type=int, default=50, help="page size, as the UI asks for")
+    search.add_argument("--runs", type=int, default=5)
+    search.add_argument("--db", default=None, help="reused when it exists")
+    search.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    if getattr(args, "child", False):
+        startup_child(args)
+    else:
+        asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# bridge.py
+import asyncio
+import logging
+import threading
+
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+
+_AUTO = object()  # submit() default: the request is keyed by the coroutine function and its arguments
+
+
+class _Call:
+    __slots__ = ("key", "future", "subscribers")
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.subscribers = []  # (on_result, on_error, group)
+
+
+class AsyncBridge(QObject):
+    # Runs coroutines on the asyncio loop thread for the GUI thread. Nothing on the GUI thread waits: the result comes
+    # back through a queued signal and the callbacks run on the GUI thread.
+    #
+    # Requests with the same key share one coroutine while it runs, a scroll handler firing ten times for the same
+    # page costs one query. A group names what the subscribers belong to (the open chat, the current search):
+    # cancel_group drops their callbacks and cancels the coroutines nobody else is waiting for.
+    done = pyqtSignal(object)  # _Call, emitted from the loop thread
+    failed = pyqtSignal(object, object)  # key, exception, for errors without an on_error callback
+
+    def __init__(self, loop, parent=None):
+        super().__init__(parent)
+        self.loop = loop
+        self._calls = {}  # key -> _Call in flight, GUI thread only
+        self._running = set()  # Every _Call in flight, keyed or not
+        self.done.connect(self._deliver)
+        self.submitted = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+        self.errors = 0
+
+    def submit(self, fn, *args, on_result=None, on_error=None, group=None, key=_AUTO, **kwargs):
+        # fn(*args, **kwargs) is a coroutine function. key=None opts out of deduplication, for requests with side
+        # effects that must run every time.
+        if key is _AUTO:
+            key = (fn, args, tuple(sorted(kwargs.items())))
+        if key is not None:
+            try:
+                call = self._calls.get(key)
+            except TypeError:  # Unhashable arguments, not deduplicated
+                key, call = None, None
+            if call is not None:
+                self.deduplicated += 1
+                subscriber = (on_result, on_error, group)
+                if subscriber not in call.subscribers:
+                    call.subscribers.append(subscriber)
+                return call
+        call = _Call(key)
+        call.subscribers.append((on_result, on_error, group))
+        if key is not None:
+            self._calls[key] = call
+        self._running.add(call)
+        self.submitted += 1
+        call.future = asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop)
+        call.future.add_done_callback(lambda _: self.done.emit(call))
+        return call
+
+    def cancel_group(self, group):
+        for call in list(self._running):
+            call.subscribers = [subscriber for subscriber in call.subscribers if subscriber[2] != group]
+            if not call.subscribers:
+                self._forget(call)
+                if call.future.cancel():
+                    self.cancelled += 1
+
+    def _forget(self, call):
+        self._running.discard(call)
+        if call.key is not None and self._calls.get(call.key) is call:
+            del self._calls[call.key]
+
+    def _deliver(self, call):
+        self._forget(call)
+        if call.future.cancelled():
+            return
+        exc = call.future.exception()
+        for on_result, on_error, _ in call.subscribers:
+            try:
+                if exc is None:
+                    if on_result is not None:
+                        on_result(call.future.result())
+                elif on_error is not None:
+                    on_error(exc)
+            except Exception:
+                logging.exception(f"BRIDGE_CALLBACK_ERR: key={call.key}")
+        if exc is not None:
+            self.errors += 1
+            if not any(on_error for _, on_error, _ in call.subscribers):
+                logging.error(f"BRIDGE_ERR: key={call.key}, exc={exc}")
+                self.failed.emit(call.key, exc)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._running),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "cancelled": self.cancelled,
+            "errors": self.errors,
+        }
+
+
+class FrameBatcher(QObject):
+    # Collects items pushed from any thread and hands them to handler(items) on the GUI thread, at most once per
+    # interval. A burst of updates costs one repaint instead of one per item.
+    _wake = pyqtSignal()
+
+    def __init__(self, handler, interval_ms: int = 16, parent=None):
+        super().__init__(parent)
+        self.handler = handler
+        self._items = []
+        self._lock = threading.Lock()
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self._flush)
+        self._wake.connect(self._timer.start)  # Queued when pushed from another thread, the timer lives here
+        self.pushed = 0
+        self.frames = 0
+
+    def push(self, item):
+        with self._lock:
+            self._items.append(item)
+            self.pushed += 1
+            first = len(self._items) == 1
+        if first:
+            self._wake.emit()
+
+    def _flush(self):
+        with self._lock:
+            items, self._items = self._items, []
+        if not items:
+            return
+        self.frames += 1
+        try:
+            self.handler(items)
+        except Exception:
+            logging.exception(f"FRAME_BATCH_ERR: items={len(items)}")
+
+    def stats(self) -> dict:
+        return {"pushed": self.pushed, "frames": self.frames, "pending": len(self._items)}
@@ -0,0 +1,39 @@
+# changes.py
+import logging
+from collections import namedtuple
+
+# kind is "new" (payload is the page row), "edit" (payload is the new content), "deleted" (payload is None) or
+# "summary" (message_id is None, payload is the chat's tg_api.ChatSummary)
+MessageChange = namedtuple("MessageChange", "kind chat_id message_id payload")
+
+
+class ChangeFeed:
+    # Committed message changes, published on the loop thread right after the write that made them. Subscribers must
+    # not block: the UI only queues the change for its next frame.
+    def __init__(self):
+        self._subscribers = []
+        self.published = 0
+        self.errors = 0
+
+    def subscribe(self, callback):
+        # Returns the function that unsubscribes it
+        self._subscribers.append(callback)
+
+        def unsubscribe():
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+        return unsubscribe
+
+    def publish(self, kind: str, chat_id: int, message_id: int, payload=None):
+        change = MessageChange(kind, chat_id, message_id, payload)
+        self.published += 1
+        for callback in list(self._subscribers):
+            try:
+                callback(change)
+            except Exception as exc:
+                self.errors += 1
+                logging.exception(f"CHANGE_FEED_ERR: change={change}, exc={exc}")
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subscribers), "published": self.published, "errors": self.errors}
@@ -0,0 +1,137 @@
+# chat_list.py
+from PyQt6.QtCore import QAbstractListModel, QModelIndex, QSortFilterProxyModel, Qt
+
+from chat_search import ChatSearchIndex
+
+CHAT_ID_ROLE = Qt.ItemDataRole.UserRole
+USERNAME_ROLE = Qt.ItemDataRole.UserRole + 1
+TITLE_ROLE = Qt.ItemDataRole.UserRole + 2  # Chat title without the unread counter
+
+
+class ChatListModel(QAbstractListModel):
+    # One row per DialogInfo, pinned chats first and then by last activity, as load_dialogs returns them. Pushed
+    # summaries move a chat up as its messages arrive. The search index follows every change.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.dialogs = []
+        self._rows = {}  # chat_id -> row
+        self.search_index = ChatSearchIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.dialogs)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        dialog = self.dialogs[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            title = f"{dialog.title} ({dialog.unread_count})" if dialog.unread_count else dialog.title or ""
+            # Always two lines, the rows keep one height. The delegate elides what does not fit.
+            return f"{title}\n{' '.join((dialog.preview or '').split())[:200]}"
+        if role == CHAT_ID_ROLE:
+            return dialog.chat_id
+        if role == USERNAME_ROLE:
+            return dialog.username
+        if role == TITLE_ROLE:
+            return dialog.title or ""
+        return None
+
+    def row_of(self, chat_id):
+        return self._rows.get(chat_id)
+
+    def set_dialogs(self, dialogs):
+        self.beginResetModel()
+        self.dialogs = list(dialogs)
+        self._reindex_rows()
+        self.search_index.build(self.dialogs)
+        self.endResetModel()
+
+    def _reindex_rows(self):
+        self._rows = {dialog.chat_id: row for row, dialog in enumerate(self.dialogs)}
+
+    def apply(self, changes):
+        # Updates the rows that changed and moves the ones whose position did, the model is not reset
+        for chat_id in changes.removed:
+            row = self._rows.get(chat_id)
+            if row is None:
+                continue
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.dialogs[row]
+            self._reindex_rows()
+            self.endRemoveRows()
+            self.search_index.remove(chat_id)
+        for dialog in changes.changed:
+            row = self._rows.get(dialog.chat_id)
+            if row is None:
+                self.beginInsertRows(QModelIndex(), len(self.dialogs), len(self.dialogs))
+                self.dialogs.append(dialog)
+                self._rows[dialog.chat_id] = len(self.dialogs) - 1
+                self.endInsertRows()
+            else:
+                self.dialogs[row] = dialog
+                self.dataChanged.emit(self.index(row), self.index(row))
+            self.search_index.update(dialog)
+        for position, dialog in enumerate(changes.dialogs):
+            if self.dialogs[position].chat_id == dialog.chat_id:
+                continue
+            row = self._rows[dialog.chat_id]
+            self._move(row, position)
+
+    def _move(self, row: int, position: int):
+        if position in (row, row + 1):  # Qt refuses moves onto the row itself
+            return
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), position)
+        self.dialogs.insert(position if position < row else position - 1, self.dialogs.pop(row))
+        self._reindex_rows()
+        self.endMoveRows()
+
+    def update_summary(self, chat_id, summary):
+        # A pushed tg_api.ChatSummary: the row is updated and moved up to its place by last activity
+        row = self._rows.get(chat_id)
+        if row is None:
+            return  # Not in the dialog list yet, the next refresh brings it
+        dialog = self.dialogs[row]._replace(
+            preview=summary.preview, last_message_at=summary.last_activity_at, unread_count=summary.unread_count
+        )
+        self.dialogs[row] = dialog
+        self.dataChanged.emit(self.index(row), self.index(row))
+        self.search_index.update(dialog)
+        position = 0
+        while position < len(self.dialogs) and self._before(self.dialogs[position], dialog, position, row):
+            position += 1
+        self._move(row, position)
+
+    @staticmethod
+    def _before(other, dialog, position: int, row: int) -> bool:
+        # Whether other stays above dialog: pinned chats first, then the most recent
+        if position == row:
+            return False
+        if bool(other.pinned) != bool(dialog.pinned):
+            return bool(other.pinned)
+        return (other.last_message_at or 0) >= (dialog.last_message_at or 0)
+
+
+class ChatFilterModel(QSortFilterProxyModel):
+    # Shows the chats a query matched, best match first and the most recent of equal ones first. Without a query the
+    # rows keep the dialog order of the source.
+    def __init__(self, chats: ChatListModel, parent=None):
+        super().__init__(parent)
+        self.chats = chats  # The source, read directly: Qt calls back once per row
+        self.ranks = None  # chat_id -> (score, last_message_at), None when not filtering
+        self.setSourceModel(chats)
+
+    def set_ranks(self, ranks):
+        # Filtered first and sorted after, so lessThan only ever compares ranked rows
+        if ranks is None:
+            self.sort(-1)  # Back to the source order
+        self.ranks = ranks
+        self.invalidate()
+        if ranks is not None and self.sortColumn() != 0:
+            self.sort(0, Qt.SortOrder.DescendingOrder)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self.ranks is None or self.chats.dialogs[source_row].chat_id in self.ranks
+
+    def lessThan(self, left, right):
+        dialogs = self.chats.dialogs
+        return self.ranks[dialogs[left.row()].chat_id] < self.ranks[dialogs[right.row()].chat_id]
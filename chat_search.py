@@ -0,0 +1,150 @@
+# chat_search.py
+import bisect
+import heapq
+import re
+import unicodedata
+
+# Cyrillic to Latin, as names are usually spelled in Latin. Both the titles and the query are folded to Latin, so
+# "Юля", "Yulya" and "Julia" meet at the same key.
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i", "й": "i",
+    "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e",
+    "ю": "yu", "я": "ya", "і": "i", "ї": "i", "є": "e", "ґ": "g",
+})
+# Latin spellings of the same sound, applied in order after transliterating
+FOLDS = (("kh", "h"), ("x", "ks"), ("w", "v"), ("j", "i"), ("y", "i"))
+
+TOKEN_RE = re.compile(r"\w+")
+
+EXACT = 1.0  # Match quality of a query token against a title token
+PREFIX = 0.8
+SUBSTRING = 0.6
+FUZZY = 0.5  # Scaled by the share of the query's trigrams the token has, for typos
+FUZZY_MIN_OVERLAP = 0.5
+
+
+def fold(text: str) -> str:
+    # Casefolded, without accents, in Latin. "Ё" and "й" lose their marks before they are transliterated.
+    text = unicodedata.normalize("NFKD", (text or "").casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char)).translate(TRANSLIT)
+    for variant, folded in FOLDS:
+        text = text.replace(variant, folded)
+    return text
+
+
+def tokens(text: str) -> list:
+    return TOKEN_RE.findall(fold(text))
+
+
+def trigrams(token: str) -> set:
+    return {token[i : i + 3] for i in range(len(token) - 2)}
+
+
+class ChatSearchIndex:
+    # Title and username tokens of every dialog. Sorted tokens answer prefix queries with a binary search, a trigram
+    # index finds tokens that contain the query or are a typo away from it. A query costs the tokens it touches, not
+    # a pass over every chat.
+    def __init__(self, dialogs=()):
+        self._chats = {}  # chat_id -> (tokens, last_message_at)
+        self._sorted = []  # Distinct tokens, sorted
+        self._token_chats = {}  # token -> set of chat ids
+        self._trigram_tokens = {}  # trigram -> set of tokens
+        self.build(dialogs)
+
+    def build(self, dialogs):
+        self._chats.clear()
+        self._sorted = []
+        self._token_chats.clear()
+        self._trigram_tokens.clear()
+        for dialog in dialogs:
+            self._index(dialog)
+        self._sorted = sorted(self._token_chats)
+
+    def _index(self, dialog):
+        chat_tokens = set(tokens(dialog.title)) | set(tokens(dialog.username))
+        self._chats[dialog.chat_id] = (chat_tokens, dialog.last_message_at or 0)
+        fresh = []
+        for token in chat_tokens:
+            chats = self._token_chats.get(token)
+            if chats is None:
+                chats = self._token_chats[token] = set()
+                fresh.append(token)
+                for trigram in trigrams(token):
+                    self._trigram_tokens.setdefault(trigram, set()).add(token)
+            chats.add(dialog.chat_id)
+        return fresh
+
+    def update(self, dialog):
+        # A new or renamed dialog, or a new last message
+        self.remove(dialog.chat_id)
+        for token in self._index(dialog):
+            bisect.insort(self._sorted, token)
+
+    def remove(self, chat_id):
+        entry = self._chats.pop(chat_id, None)
+        if entry is None:
+            return
+        for token in entry[0]:
+            chats = self._token_chats[token]
+            chats.discard(chat_id)
+            if chats:
+                continue
+            del self._token_chats[token]
+            del self._sorted[bisect.bisect_left(self._sorted, token)]
+            for trigram in trigrams(token):
+                trigram_tokens = self._trigram_tokens[trigram]
+                trigram_tokens.discard(token)
+                if not trigram_tokens:
+                    del self._trigram_tokens[trigram]
+
+    def _matches(self, query_token: str) -> dict:
+        # token -> match quality of the index tokens that match one query token
+        matches = {}
+        position = bisect.bisect_left(self._sorted, query_token)
+        while position < len(self._sorted) and self._sorted[position].startswith(query_token):
+            token = self._sorted[position]
+            matches[token] = EXACT if token == query_token else PREFIX
+            position += 1
+        query_trigrams = trigrams(query_token)
+        if not query_trigrams:  # Shorter than a trigram, prefixes only
+            return matches
+        shared = {}
+        for trigram in query_trigrams:
+            for token in self._trigram_tokens.get(trigram, ()):
+                shared[token] = shared.get(token, 0) + 1
+        for token, count in shared.items():
+            if token in matches:
+                continue
+            if query_token in token:
+                matches[token] = SUBSTRING
+            elif count / len(query_trigrams) >= FUZZY_MIN_OVERLAP:
+                matches[token] = FUZZY * count / len(query_trigrams)
+        return matches
+
+    def search(self, query: str, limit: int = None) -> dict:
+        # chat_id -> (score, last_message_at) of the chats matching every token of the query, the limit best ones.
+        # An empty query matches nothing, the caller shows the full list instead.
+        scores = None
+        for query_token in tokens(query):
+            best = {}
+            for token, quality in self._matches(query_token).items():
+                for chat_id in self._token_chats[token]:
+                    if quality > best.get(chat_id, 0):
+                        best[chat_id] = quality
+            if scores is None:
+                scores = best
+            else:
+                scores = {chat_id: score + best[chat_id] for chat_id, score in scores.items() if chat_id in best}
+            if not scores:
+                break
+        ranks = ((chat_id, (score, self._chats[chat_id][1])) for chat_id, score in (scores or {}).items())
+        if limit is not None and scores and len(scores) > limit:
+            ranks = heapq.nlargest(limit, ranks, key=lambda rank: rank[1])
+        return dict(ranks)
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def stats(self) -> dict:
+        return {"chats": len(self._chats), "tokens": len(self._sorted), "trigrams": len(self._trigram_tokens)}
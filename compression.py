@@ -0,0 +1,107 @@
+# compression.py
+import difflib
+import json
+import os
+import re
+import zlib
+from collections import Counter
+
+CODEC_TEXT = 0  # content holds the full text of the version
+CODEC_DELTA = 1  # content holds a delta against the previous version, "" means unchanged
+
+MAX_DICT_SIZE = 32 * 1024  # zlib only looks back 32 KiB, a bigger dictionary is never used
+
+
+def make_delta(old: str, new: str) -> str:
+    # Ops: positive int = copy that many chars of old, negative int = skip them, string = insert it
+    old = old or ""
+    new = new or ""
+    if old == new:
+        return ""
+    # Edits are usually local: the common prefix and suffix are copied as is and only the middle is diffed,
+    # by words rather than characters, which keeps difflib fast on long posts
+    prefix = len(os.path.commonprefix([old, new]))
+    suffix = len(os.path.commonprefix([old[prefix:][::-1], new[prefix:][::-1]]))
+    a = re.findall(r"\w+|\W+", old[prefix : len(old) - suffix])
+    b = re.findall(r"\w+|\W+", new[prefix : len(new) - suffix])
+    ops = [prefix] if prefix else []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append(sum(map(len, a[i1:i2])))
+        else:
+            if i2 > i1:
+                ops.append(-sum(map(len, a[i1:i2])))
+            if j2 > j1:
+                ops.append("".join(b[j1:j2]))
+    if suffix:
+        ops.append(suffix)
+    return json.dumps(ops, ensure_ascii=False, separators=(",", ":"))
+
+
+def apply_delta(old: str, delta: str) -> str:
+    old = old or ""
+    if not delta:
+        return old
+    parts = []
+    position = 0
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(old[position : position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
+
+
+def encode_version(previous: str, text: str):
+    # Returns (codec, content). A delta is only kept when it actually saves space
+    if previous is None or text is None:
+        return CODEC_TEXT, text
+    delta = make_delta(previous, text)
+    if len(delta) < len(text) * 0.8:
+        return CODEC_DELTA, delta
+    return CODEC_TEXT, text
+
+
+def decode_version(previous: str, codec: int, content: str) -> str:
+    if codec == CODEC_DELTA:
+        return apply_delta(previous, content)
+    return content
+
+
+def train_dictionary(samples, size: int = MAX_DICT_SIZE) -> bytes:
+    # zlib has no trainer, so the dictionary is built from the words and word pairs that save the most bytes
+    # across the samples. zlib prefers matches close to the end of the dictionary, the best ones go last.
+    counts = Counter()
+    for text in samples:
+        if not text:
+            continue
+        words = re.findall(r"\w+\W*", text)
+        counts.update(word for word in words if len(word) > 3)
+        counts.update(a + b for a, b in zip(words, words[1:]))
+    chosen = []
+    total = 0
+    for piece, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count < 2:
+            break
+        encoded = piece.encode()
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b"".join(reversed(chosen))
+
+
+def pack(text: str, zdict: bytes) -> bytes:
+    if zdict:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(text.encode()) + compressor.flush()
+
+
+def unpack(blob: bytes, zdict: bytes) -> str:
+    decompressor = zlib.decompressobj(-15, zdict) if zdict else zlib.decompressobj(-15)
+    return (decompressor.decompress(blob) + decompressor.flush()).decode()
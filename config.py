@@ -1 +1,2 @@
-SESSIONS_FILE = "sessions.json"
\ No newline at end of file
+SESSIONS_FILE = "sessions.json"
+THEME = "dark"  # One of theme.PALETTES
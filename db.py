@@ -0,0 +1,182 @@
+# db.py
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+
+class DatabasePool:
+    def __init__(self, db_path: str, readers: int = 4, timeout: float = 10):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self.timeout = timeout
+        self._writer = None
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._closed = False
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path, timeout=self.timeout)
+        await conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            if self._closed:
+                raise RuntimeError("Database pool is closed")
+            # WAL is persistent for the file, so the writer switches it once and readers inherit it
+            writer = await self._connect()
+            async with writer.execute("PRAGMA journal_mode = WAL") as cursor:
+                (mode,) = await cursor.fetchone()
+            for _ in range(self.readers_count):
+                conn = await self._connect()
+                await conn.execute("PRAGMA query_only = 1")
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+            self._writer = writer
+            logging.info(f"DB_POOL_OPEN: path={self.db_path}, journal={mode}, readers={self.readers_count}")
+
+    @asynccontextmanager
+    async def writer(self):
+        await self.open()
+        async with self._write_lock:
+            yield self._writer
+
+    @asynccontextmanager
+    async def reader(self):
+        await self.open()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def close(self):
+        self._closed = True
+        async with self._open_lock:
+            if self._writer is None:
+                return
+            async with self._write_lock:
+                await self._writer.close()
+                self._writer = None
+            for conn in self._all_readers:
+                await conn.close()
+            self._all_readers.clear()
+            self._readers = asyncio.Queue()
+        logging.info(f"DB_POOL_CLOSED: path={self.db_path}")
+
+
+class WriteBehindQueue:
+    def __init__(
+        self, pool: DatabasePool, max_batch: int = 500, flush_interval: float = 0.005, max_pending: int = 5000
+    ):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._task = None
+        self._closed = False
+        self._after_commit = []  # (callback, args) registered by the ops of the batch being applied
+
+    def _ensure_started(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._worker())
+
+    async def submit(self, op, *args) -> asyncio.Future:
+        # op is a coroutine function called as op(conn, *args) inside the batch transaction
+        if self._closed:
+            raise RuntimeError("Write queue is closed")
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, args, future))  # Blocks while the queue is full
+        return future
+
+    async def run(self, op, *args):
+        return await (await self.submit(op, *args))
+
+    def after_commit(self, callback, *args):
+        # Called by an op: callback(*args) runs once the batch is committed, not at all if the op is rolled back
+        self._after_commit.append((callback, args))
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            if self._queue.qsize() < self.max_batch:
+                await asyncio.sleep(self.flush_interval)
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._apply(batch)
+            if stop:
+                break
+        # Submitters that were blocked on a full queue when close() started still get their writes applied
+        while not self._queue.empty():
+            batch = [item for item in (self._queue.get_nowait() for _ in range(self._queue.qsize())) if item]
+            for start in range(0, len(batch), self.max_batch):
+                await self._apply(batch[start : start + self.max_batch])
+
+    async def _apply(self, batch):
+        start_time = time.time()
+        outcomes = []
+        async with self.pool.writer() as conn:
+            try:
+                await conn.execute("BEGIN")
+                for op, args, future in batch:
+                    await conn.execute("SAVEPOINT write_op")
+                    registered = len(self._after_commit)
+                    try:
+                        result = await op(conn, *args)
+                    except Exception as exc:
+                        await conn.execute("ROLLBACK TO write_op")
+                        await conn.execute("RELEASE write_op")
+                        del self._after_commit[registered:]
+                        outcomes.append((future, exc, True))
+                    else:
+                        await conn.execute("RELEASE write_op")
+                        outcomes.append((future, result, False))
+                await conn.commit()
+            except Exception as exc:
+                await conn.rollback()
+                logging.exception(f"WB_FLUSH_ERR: ops={len(batch)}, exc={exc}")
+                outcomes = [(future, exc, True) for _, _, future in batch]
+                self._after_commit.clear()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception as exc:
+                logging.exception(f"WB_AFTER_COMMIT_ERR: callback={callback}, exc={exc}")
+        for future, value, failed in outcomes:
+            if future.done():
+                continue
+            if failed:
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+        logging.debug(f"WB_FLUSH: ops={len(batch)}, time={time.time() - start_time:.3f}s")
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        logging.info("WB_CLOSED")
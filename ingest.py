@@ -0,0 +1,165 @@
+# ingest.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+
+class BoundedDedup:
+    # Remembers the last maxsize keys in arrival order. Lookups, inserts and evictions are all O(1).
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def add(self, key) -> bool:
+        # False when the key was seen before
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return False
+        self._keys[key] = None
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+        return True
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def clear(self):
+        self._keys.clear()
+
+
+class IngestPipeline:
+    # Update handlers only parse the update and submit it here. Each chat has its own queue, applied in arrival order
+    # by one worker at a time. Chats take turns in batches of at most burst events, so a flood of updates in one
+    # channel delays that channel and not the others.
+    def __init__(self, workers: int = 4, burst: int = 16, max_pending: int = 10000, dedup_size: int = 10000):
+        self.workers_count = workers
+        self.burst = burst
+        self.dedup = BoundedDedup(dedup_size)
+        self._slots = None  # Semaphore of max_pending, created on the loop. Submitters wait while it is exhausted.
+        self.max_pending = max_pending
+        self._shards = {}  # chat_id -> deque of (seq, received_at, key, apply, args), present while queued or running
+        self._ready = None  # Chat ids with pending events and no worker on them, in turn order
+        self._idle = None
+        self._progress = None  # Condition notified after every applied event, see wait_applied
+        self._running = {}  # seq -> chat_id of the events being applied
+        self._submitted = 0  # seq of the next event
+        self._workers = []
+        self.pending = 0
+        self.max_depth = 0
+        self.applied = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._lag_total = 0.0
+
+    def _ensure_started(self):
+        if self._workers:
+            return
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._progress = asyncio.Condition()
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def submit(self, chat_id: int, key, apply, *args) -> bool:
+        # apply(*args) runs later on a worker. False when the key is a duplicate and the event was dropped.
+        if not self.dedup.add(key):
+            self.duplicates += 1
+            logging.info(f"EVT_DUP_IGN: key={key}")
+            return False
+        self._ensure_started()
+        await self._slots.acquire()
+        shard = self._shards.get(chat_id)
+        if shard is None:
+            shard = self._shards[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        shard.append((self._submitted, time.monotonic(), key, apply, args))
+        self._submitted += 1
+        self.pending += 1
+        self.max_depth = max(self.max_depth, self.pending)
+        self._idle.clear()
+        return True
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            shard = self._shards[chat_id]
+            for _ in range(min(self.burst, len(shard))):
+                seq, received_at, key, apply, args = shard.popleft()
+                self._running[seq] = chat_id
+                try:
+                    await apply(*args)
+                except Exception as exc:
+                    self.errors += 1
+                    logging.exception(f"INGEST_ERR: key={key}, exc={exc}")
+                del self._running[seq]
+                self._record_lag(time.monotonic() - received_at)
+                self.pending -= 1
+                self._slots.release()
+                async with self._progress:
+                    self._progress.notify_all()
+            if shard:
+                self._ready.put_nowait(chat_id)  # Back of the line, the other chats go first
+            else:
+                del self._shards[chat_id]
+                if not self.pending:
+                    self._idle.set()
+
+    async def wait_applied(self, include=None):
+        # Returns once every event submitted before the call was applied in the chats include(chat_id) accepts, all
+        # of them by default. For updates that don't say which chat they belong to: they can only be routed once the
+        # events they may refer to are stored. Events of other chats queued meanwhile are not waited for.
+        if not self._workers:
+            return
+        mark = self._submitted
+        async with self._progress:
+            await self._progress.wait_for(lambda: self._oldest_pending(include) >= mark)
+
+    def _oldest_pending(self, include=None) -> float:
+        # A shard is applied in order, its first entry is its oldest
+        queued = (
+            shard[0][0] for chat_id, shard in self._shards.items() if shard and (include is None or include(chat_id))
+        )
+        running = (seq for seq, chat_id in self._running.items() if include is None or include(chat_id))
+        return min((*queued, *running), default=float("inf"))
+
+    def _record_lag(self, lag: float):
+        self.applied += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self._lag_total += lag
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "chats": len(self._shards),
+            "deepest_chat": max((len(shard) for shard in self._shards.values()), default=0),
+            "max_depth": self.max_depth,
+            "applied": self.applied,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "last_lag": round(self.last_lag, 3),
+            "avg_lag": round(self._lag_total / self.applied, 3) if self.applied else 0.0,
+            "max_lag": round(self.max_lag, 3),
+        }
+
+    async def close(self, timeout: float = 5.0):
+        # Applies what is already queued (up to timeout) before stopping the workers
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"INGEST_CLOSE_TIMEOUT: pending={self.pending}")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logging.info(f"INGEST_STATS: {self.stats()}")
@@ -1,19 +1,15 @@
 # main.py
 import asyncio
 import json
+import logging
 import os
 import sys
-import threading
 import datetime
 import hashlib
 
-from PyQt6.QtWidgets import QApplication, QMessageBox
-
-from tg_api import TelegramChatManager
-from ui import TelegramWindow
-from login import LoginWindow
-from telethon import TelegramClient
+# PyQt6, Telethon and aiosqlite are imported inside run_app, so their import is timed and overlapped
 from config import SESSIONS_FILE
+from startup import StartupProfiler, import_in_background, open_main_window, start_loop
 
 
 def load_sessions():
@@ -34,20 +30,34 @@ def phone_to_session(phone: str) -> str:
 
 
 def run_app():
-    app = QApplication(sys.argv)
+    profile = "--profile-startup" in sys.argv
+    if profile:
+        sys.argv.remove("--profile-startup")
+    profiler = StartupProfiler()
+    backend = import_in_background(profiler, ("telethon", "tg_api"))
+
+    with profiler.phase("import PyQt6"):
+        from PyQt6.QtWidgets import QApplication
+    with profiler.phase("QApplication"):
+        app = QApplication(sys.argv)
 
     # API ID/Hash
     api_id = 23435967
     api_hash = "216c60772fcaf17e0e5822e94ec86b92"
 
     # Event loop for Telethon in a separate thread
-    loop = asyncio.new_event_loop()
-    threading.Thread(target=loop.run_forever, daemon=True).start()
+    loop = start_loop(profiler)
+
+    with profiler.phase("wait imports"):
+        backend.result()
+    from telethon import TelegramClient
 
     sessions = load_sessions()
     client = None
     if not sessions:
         # No saved accounts → show LoginWindow
+        from login import LoginWindow
+
         login = LoginWindow(api_id, api_hash, loop)
         if login.exec() == LoginWindow.DialogCode.Accepted:
             client = login.client
@@ -59,35 +69,45 @@ def run_app():
         session_file = data["session_file"]
         client = TelegramClient(session_file, api_id, api_hash)
 
-    # Start client
-    async def start_client():
-        await client.start()
-
-    future = asyncio.run_coroutine_threadsafe(start_client(), loop)
-    future.result()  # Wait for start
+    def on_first_frame():
+        if profile:
+            logging.info(f"STARTUP_PROFILE:\n{profiler.report()}")
 
-    # Create manager
-    manager = TelegramChatManager("telegram_chat.db", client)
-
-    # Create tables
-    async def create_tables():
-        await manager._create_tables()
-
-    future = asyncio.run_coroutine_threadsafe(create_tables(), loop)
-    future.result()
-
-    # Run UI
-    window = TelegramWindow(client, manager, loop)
-    window.show()
+    # Migrations and the cache loads run concurrently on the loop, the client connects in the background
+    window, manager = open_main_window(client, loop, "telegram_chat.db", profiler, on_first_frame)
 
     # Start background history load
     async def background_load():
-        #await manager.save_chats_history(1000)
-        pass
+        backfill = None
+        try:
+            await manager.connect()
+        except Exception:
+            pass  # Offline, logged by the manager. The window shows the cache, only the local housekeeping runs.
+        else:
+            try:
+                await manager.media.scan_pending()
+            except Exception as exc:
+                logging.exception(f"MEDIA_SCAN_ERR: exc={exc}")
+            # Likely next chats first, then again every 5 minutes while the app runs
+            manager.prefetcher.start(interval=300)
+            backfill = asyncio.create_task(manager.save_chats_history(1000))
+        # Each step on its own: one failing does not skip the housekeeping after it
+        try:
+            await manager.archive.archive_old()
+        except Exception as exc:
+            logging.exception(f"ARCHIVE_ERR: exc={exc}")
+        try:
+            await manager.compact_history()
+        except Exception as exc:
+            logging.exception(f"COMPACT_ERR: exc={exc}")
+        if backfill is not None:
+            await backfill
 
     asyncio.run_coroutine_threadsafe(background_load(), loop)
 
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    asyncio.run_coroutine_threadsafe(manager.close(), loop).result()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,383 @@
+# media.py
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from telethon import types, utils
+from telethon.errors import FloodWaitError
+
+CHUNK_SIZE = 512 * 1024  # Telegram wants offsets aligned to the request size, resumed files restart on a boundary
+DEFAULT_QUOTA = 2 * 1024**3
+
+PRIORITY_FULL = 0  # Asked for by the UI
+PRIORITY_THUMB = 1
+PRIORITY_SCAN = 2  # Thumbnails queued by a background scan
+
+FETCH_BATCH = 100  # messages.getMessages takes at most 100 ids
+MESSAGE_CACHE = 1000  # Fetched messages kept until their media is downloaded
+
+
+def media_key(media, thumb: bool):
+    # Forwarded copies keep the id of the original photo or document, so the key is the same for all of them
+    if isinstance(media, types.MessageMediaPhoto) and media.photo:
+        key = f"photo:{media.photo.id}"
+    elif isinstance(media, types.MessageMediaDocument) and media.document:
+        key = f"document:{media.document.id}"
+    else:
+        return None
+    return f"{key}:thumb" if thumb else key
+
+
+def media_extension(media, thumb: bool) -> str:
+    if thumb or isinstance(media, types.MessageMediaPhoto):
+        return ".jpg"
+    return utils.get_extension(media) or ""
+
+
+class MediaStore:
+    # Files live under root/<2 hex>/<sha256><ext>. Every call that touches the disk runs in a worker thread.
+    def __init__(self, root: str = "assets/", quota: int = DEFAULT_QUOTA):
+        self.root = root
+        self.quota = quota
+        self.partial_root = os.path.join(root, ".partial")
+
+    def blob_path(self, sha256: str, extension: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256 + extension)
+
+    def partial_path(self, key: str) -> str:
+        return os.path.join(self.partial_root, key.replace(":", "_") + ".part")
+
+    async def open_partial(self, key: str):
+        # Returns (file, offset, hasher) with the hasher already fed the bytes kept from an earlier attempt
+        return await asyncio.to_thread(self._open_partial, self.partial_path(key))
+
+    def _open_partial(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = open(path, "a+b")
+        size = file.seek(0, os.SEEK_END)
+        offset = size - size % CHUNK_SIZE
+        file.truncate(offset)
+        file.seek(0)
+        hasher = hashlib.sha256()
+        while chunk := file.read(CHUNK_SIZE):
+            hasher.update(chunk)
+        return file, offset, hasher
+
+    async def write_chunk(self, file, chunk: bytes):
+        await asyncio.to_thread(file.write, chunk)
+
+    async def commit_partial(self, file, sha256: str, extension: str) -> str:
+        return await asyncio.to_thread(self._commit_partial, file, sha256, extension)
+
+    def _commit_partial(self, file, sha256: str, extension: str) -> str:
+        file.close()
+        path = self.blob_path(sha256, extension)
+        if os.path.exists(path):
+            os.remove(file.name)  # Same content is already stored under another Telegram id
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(file.name, path)
+        return path
+
+    async def put_bytes(self, data: bytes, extension: str):
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(sha256, extension)
+        await asyncio.to_thread(self._write_bytes, path, data)
+        return sha256, path
+
+    def _write_bytes(self, path: str, data: bytes):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    async def remove(self, paths):
+        await asyncio.to_thread(self._remove, paths)
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class MediaDownloader:
+    def __init__(self, manager, store: MediaStore = None, workers: int = 3, scan_limit: int = 500):
+        self.manager = manager
+        self.client = manager.client
+        self.store = store or MediaStore(manager.assets_path)
+        self.workers_count = workers
+        self.scan_limit = scan_limit
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()  # FIFO within a priority
+        self._inflight = {}  # (chat_id, message_id, thumb) -> future of the stored path
+        self._running = set()
+        self._messages = OrderedDict()  # (chat_id, message_id) -> message, None when it is gone
+        self._wanted = {}  # chat_id -> ids queued without their message, fetched together
+        self._fetching = {}  # (chat_id, message_id) -> task of the batch fetching it
+        self._workers = []
+        self._used = None  # Bytes in the store, loaded on start
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.evicted = 0
+
+    async def start(self):
+        if self._workers:
+            return
+        rows = await self.manager._fetch_with_semaphore("SELECT coalesce(sum(size), 0) FROM media_blobs")
+        self._used = rows[0][0]
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.workers_count)]
+        logging.info(f"MEDIA_START: workers={self.workers_count}, used={self._used}, quota={self.store.quota}")
+
+    def enqueue(
+        self, chat_id: int, message_id: int, thumb: bool = True, priority: int = PRIORITY_THUMB, message=None
+    ):
+        # message is the Telethon object when the caller already has it
+        if message is not None:
+            self._remember(chat_id, message_id, message)
+        elif (chat_id, message_id) not in self._messages:
+            self._wanted.setdefault(chat_id, set()).add(message_id)
+        key = (chat_id, message_id, thumb)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+        self._queue.put_nowait((priority, next(self._order), key))  # A repeat at higher priority jumps the queue
+        return future
+
+    async def scan_pending(self) -> int:
+        # Media messages without a thumbnail attachment yet, newest first
+        rows = await self.manager._fetch_with_semaphore(
+            """
+            SELECT m.chat_id, m.message_id FROM messages m
+            WHERE m.media_path IS NOT NULL AND m.deleted = 0 AND NOT EXISTS (
+                SELECT 1 FROM attachments a
+                WHERE a.chat_id = m.chat_id AND a.message_id = m.message_id AND a.attachment_type = 'thumb'
+            )
+            ORDER BY m.created_at DESC LIMIT ?
+            """,
+            (self.scan_limit,),
+        )
+        for chat_id, message_id in rows:
+            self.enqueue(chat_id, message_id, thumb=True, priority=PRIORITY_SCAN)
+        logging.info(f"MEDIA_SCAN: queued={len(rows)}")
+        return len(rows)
+
+    async def get(self, chat_id: int, message_id: int, thumb: bool = False):
+        # Path of the stored file, downloading it first if needed. None when the message has no such media.
+        rows = await self.manager._fetch_with_semaphore(
+            """
+            SELECT a.file_path, a.sha256 FROM attachments a
+            WHERE a.chat_id = ? AND a.message_id = ? AND a.attachment_type = ?
+            ORDER BY a.attachment_id DESC LIMIT 1
+            """,
+            (chat_id, message_id, "thumb" if thumb else "full"),
+        )
+        if rows and rows[0][0] is not None:
+            # Not awaited, the path is returned without waiting for the next batch. A failure is logged.
+            touched = await self.manager.write_queue.submit(self._touch, rows[0][1], int(time.time()))
+            touched.add_done_callback(self._touched)
+            return rows[0][0]
+        if rows and rows[0][1] is None:
+            return None  # Known to have nothing to download
+        return await self.enqueue(chat_id, message_id, thumb, PRIORITY_FULL if not thumb else PRIORITY_THUMB)
+
+    async def _worker(self):
+        while True:
+            _, _, key = await self._queue.get()
+            future = self._inflight.get(key)
+            if future is None or future.done() or key in self._running:
+                continue  # Already handled through a higher priority entry
+            self._running.add(key)
+            try:
+                path = await self._download(*key)
+            except FloodWaitError as exc:
+                logging.warning(f"MEDIA_FLOOD_WAIT: key={key}, seconds={exc.seconds}")
+                self.manager.api_bucket.pause(exc.seconds + 1)
+                self._running.discard(key)
+                await asyncio.sleep(exc.seconds)
+                self._queue.put_nowait((PRIORITY_SCAN, next(self._order), key))
+                continue
+            except Exception as exc:
+                logging.exception(f"MEDIA_ERR: key={key}, exc={exc}")
+                future.set_exception(exc)
+                future.exception()
+            else:
+                future.set_result(path)
+            finally:
+                self._running.discard(key)
+            self._inflight.pop(key, None)
+
+    def _remember(self, chat_id: int, message_id: int, message):
+        self._messages[(chat_id, message_id)] = message
+        self._messages.move_to_end((chat_id, message_id))
+        wanted = self._wanted.get(chat_id)
+        if wanted is not None:
+            wanted.discard(message_id)
+            if not wanted:
+                del self._wanted[chat_id]
+        while len(self._messages) > MESSAGE_CACHE:
+            (evicted_chat_id, evicted_id), _ = self._messages.popitem(last=False)
+            self._wanted.setdefault(evicted_chat_id, set()).add(evicted_id)  # Still queued, fetched again
+
+    async def _message(self, chat_id: int, message_id: int):
+        # Fetched along with the other queued ids of the chat, newest first, one token of the shared bucket for all.
+        # Workers asking for an id of a batch on its way wait for that batch.
+        if (chat_id, message_id) in self._messages:
+            return self._messages[(chat_id, message_id)]
+        batch = self._fetching.get((chat_id, message_id))
+        if batch is None:
+            wanted = self._wanted.get(chat_id, set())
+            ids = [message_id, *sorted(wanted - {message_id}, reverse=True)[: FETCH_BATCH - 1]]
+            wanted.difference_update(ids)
+            batch = asyncio.get_running_loop().create_task(self._fetch(chat_id, ids))
+            batch.add_done_callback(lambda task: task.cancelled() or task.exception())
+            for fetched_id in ids:
+                self._fetching[(chat_id, fetched_id)] = batch
+        return (await asyncio.shield(batch))[message_id]
+
+    async def _fetch(self, chat_id: int, ids):
+        try:
+            await self.manager.api_bucket.acquire()
+            async with self.manager.api_semaphore:
+                messages = await self.client.get_messages(chat_id, ids=ids)
+        except BaseException:
+            self._wanted.setdefault(chat_id, set()).update(ids)  # Still queued, the next batch takes them
+            raise
+        finally:
+            for fetched_id in ids:
+                self._fetching.pop((chat_id, fetched_id), None)
+        for fetched_id, message in zip(ids, messages):
+            self._remember(chat_id, fetched_id, message)
+        return dict(zip(ids, messages))
+
+    async def _download(self, chat_id: int, message_id: int, thumb: bool):
+        message = await self._message(chat_id, message_id)
+        self._messages.pop((chat_id, message_id), None)  # A later request for the other size fetches it again
+        attachment_type = "thumb" if thumb else "full"
+        created_at = int(time.time())
+        key = media_key(message.media, thumb) if message else None
+        if key is None:
+            await self.manager.save_attachment(message_id, attachment_type, created_at, chat_id=chat_id)
+            return None
+
+        existing = await self.manager._fetch_with_semaphore(
+            """
+            SELECT a.file_path, a.sha256, b.size FROM attachments a JOIN media_blobs b ON b.sha256 = a.sha256
+            WHERE a.file_key = ? AND a.file_path IS NOT NULL LIMIT 1
+            """,
+            (key,),
+        )
+        if existing:
+            path, sha256, size = existing[0]
+            self.deduplicated += 1
+            await self.manager.save_attachment(
+                message_id, attachment_type, created_at, path, chat_id=chat_id, file_key=key, sha256=sha256, size=size
+            )
+            return path
+
+        extension = media_extension(message.media, thumb)
+        if thumb:
+            data = await self.client.download_media(message, file=bytes, thumb=0)
+            if not data:
+                await self.manager.save_attachment(
+                    message_id, attachment_type, created_at, chat_id=chat_id, file_key=key
+                )
+                return None
+            sha256, path = await self.store.put_bytes(data, extension)
+            size = len(data)
+        else:
+            sha256, path, size = await self._download_file(message, key, extension)
+
+        self.downloaded += 1
+        await self.manager.save_attachment(
+            message_id, attachment_type, created_at, path, chat_id=chat_id, file_key=key, sha256=sha256, size=size
+        )
+        self._used += size  # An upper bound, identical content under another key is stored once
+        await self._enforce_quota()
+        logging.info(f"MEDIA_SAVED: chat_id={chat_id}, msg_id={message_id}, key={key}, size={size}")
+        return path
+
+    async def _download_file(self, message, key: str, extension: str):
+        file, offset, hasher = await self.store.open_partial(key)
+        try:
+            if offset:
+                logging.info(f"MEDIA_RESUME: key={key}, offset={offset}")
+            async for chunk in self.client.iter_download(message.media, offset=offset, request_size=CHUNK_SIZE):
+                hasher.update(chunk)
+                await self.store.write_chunk(file, chunk)
+                offset += len(chunk)
+        except BaseException:
+            await asyncio.to_thread(file.close)  # The partial file stays for the next attempt
+            raise
+        sha256 = hasher.hexdigest()
+        path = await self.store.commit_partial(file, sha256, extension)
+        return sha256, path, offset
+
+    async def _touch(self, conn, sha256, accessed_at):
+        await conn.execute("UPDATE media_blobs SET last_access = ? WHERE sha256 = ?", (accessed_at, sha256))
+
+    @staticmethod
+    def _touched(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"MEDIA_TOUCH_ERR: exc={future.exception()!r}")  # The blob keeps its older access time
+
+    async def _enforce_quota(self):
+        if self._used <= self.store.quota:
+            return
+        self._used, evicted = await self.manager.write_queue.run(self._evict, self.store.quota)
+        self.evicted += len(evicted)
+        await self.store.remove(evicted)
+        logging.info(f"MEDIA_EVICTED: files={len(evicted)}, used={self._used}")
+
+    async def _evict(self, conn, quota: int):
+        # Least recently used first. Attachments keep their rows with file_path cleared, so get() downloads again.
+        async with conn.execute("SELECT coalesce(sum(size), 0) FROM media_blobs") as cursor:
+            (used,) = await cursor.fetchone()
+        excess = used - quota
+        evicted = []
+        async with conn.execute("SELECT sha256, file_path, size FROM media_blobs ORDER BY last_access") as cursor:
+            async for sha256, path, size in cursor:
+                if excess <= 0:
+                    break
+                evicted.append((sha256, path, size))
+                excess -= size
+        await conn.executemany("DELETE FROM media_blobs WHERE sha256 = ?", [(sha256,) for sha256, _, _ in evicted])
+        await conn.executemany(
+            "UPDATE attachments SET file_path = NULL WHERE sha256 = ?", [(sha256,) for sha256, _, _ in evicted]
+        )
+        return used - sum(size for _, _, size in evicted), [path for _, path, _ in evicted]
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "inflight": len(self._inflight),
+            "downloaded": self.downloaded,
+            "deduplicated": self.deduplicated,
+            "evicted": self.evicted,
+            "used": self._used,
+            "quota": self.store.quota,
+        }
+
+    async def close(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for future in self._inflight.values():
+            future.cancel()
+        self._inflight.clear()
+        for batch in set(self._fetching.values()):
+            batch.cancel()
+        self._messages.clear()
+        self._wanted.clear()
+        logging.info(f"MEDIA_STATS: {self.stats()}")
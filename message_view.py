@@ -0,0 +1,334 @@
+# message_view.py
+import bisect
+import datetime
+from collections import namedtuple
+
+from PyQt6.QtCore import QAbstractListModel, QModelIndex, QRect, QRectF, QSize, Qt
+from PyQt6.QtGui import QFont, QFontMetrics, QPainter, QPainterPath
+from PyQt6.QtWidgets import QAbstractItemView, QListView, QStyledItemDelegate
+
+from text_layout import TextLayoutCache
+from theme import Theme
+
+GROUP_GAP = 300  # Seconds, a message of the same sender within it joins the bubble group above
+
+MESSAGE_ID_ROLE = Qt.ItemDataRole.UserRole
+
+EDITED_MARK = "изменено"
+DELETED_MARK = "удалено"
+
+# Geometry of one bubble for the current width. spacing is above the bubble, the *_height are of its text blocks.
+BubbleLayout = namedtuple(
+    "BubbleLayout",
+    "row first last own deleted timestamp spacing width height name_height text_height name_font time_font",
+)
+
+
+class MessageListModel(QAbstractListModel):
+    # One row per message, ascending by message_id, as get_messages_for_batch returns them:
+    # (message_id, content, username, created_at, sender_id). Grouping is derived from the neighbours of a row, so
+    # pages can be added at either end without regrouping what is already shown.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.ids = []
+        self.me_id = None
+        self.edited = set()  # Ids edited or deleted while shown, their bubbles say so
+        self.deleted = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return row[1]
+        if role == MESSAGE_ID_ROLE:
+            return row[0]
+        return None
+
+    def _joins(self, previous, row) -> bool:
+        return previous[2] == row[2] and row[3] - previous[3] <= GROUP_GAP
+
+    def message(self, position: int):
+        # (row, first, last, own) where first and last place the message in its bubble group
+        row = self.rows[position]
+        first = position == 0 or not self._joins(self.rows[position - 1], row)
+        last = position == len(self.rows) - 1 or not self._joins(row, self.rows[position + 1])
+        return row, first, last, self.me_id is not None and row[4] == self.me_id
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.ids = []
+        self.edited.clear()
+        self.deleted.clear()
+        self.endResetModel()
+
+    def add(self, rows):
+        # Rows already shown are replaced in place. A page above or below what is shown goes in as one block.
+        fresh = []
+        for row in rows:
+            position = bisect.bisect_left(self.ids, row[0])
+            if position < len(self.ids) and self.ids[position] == row[0]:
+                self.rows[position] = row
+                self._changed(position, position)
+            else:
+                fresh.append(row)
+        if not fresh:
+            return
+        fresh.sort()
+        if not self.rows or fresh[0][0] > self.ids[-1]:
+            self._insert(len(self.rows), fresh)
+        elif fresh[-1][0] < self.ids[0]:
+            self._insert(0, fresh)
+        else:
+            for row in fresh:
+                self._insert(bisect.bisect_left(self.ids, row[0]), [row])
+
+    def _insert(self, position: int, rows):
+        self.beginInsertRows(QModelIndex(), position, position + len(rows) - 1)
+        self.rows[position:position] = rows
+        self.ids[position:position] = [row[0] for row in rows]
+        self.endInsertRows()
+        # The neighbours may have joined the new rows' groups, their bubbles change shape
+        self._changed(position - 1, position - 1)
+        self._changed(position + len(rows), position + len(rows))
+
+    def trim(self, max_rows: int, from_end: bool):
+        # Drops rows beyond max_rows at one end, they are read again from the cache when scrolled back to
+        # Returns how many were dropped
+        excess = len(self.rows) - max_rows
+        if excess <= 0:
+            return 0
+        first, last = (len(self.rows) - excess, len(self.rows) - 1) if from_end else (0, excess - 1)
+        self.beginRemoveRows(QModelIndex(), first, last)
+        del self.rows[first : last + 1]
+        del self.ids[first : last + 1]
+        self.endRemoveRows()
+        self._changed(first - 1, first)
+        return excess
+
+    def position(self, message_id: int):
+        position = bisect.bisect_left(self.ids, message_id)
+        if position < len(self.ids) and self.ids[position] == message_id:
+            return position
+        return None
+
+    def update(self, message_id: int, content: str):
+        position = self.position(message_id)
+        if position is None:
+            return
+        row = list(self.rows[position])
+        row[1] = content
+        self.rows[position] = tuple(row)
+        self.edited.add(message_id)
+        self._changed(position, position)
+
+    def mark_deleted(self, message_id: int):
+        # The bubble stays where it was, greyed out, so the rows around it do not jump
+        position = self.position(message_id)
+        if position is None:
+            return
+        self.deleted.add(message_id)
+        self._changed(position, position)
+
+    def _changed(self, first: int, last: int):
+        first, last = max(first, 0), min(last, len(self.rows) - 1)
+        if first <= last:
+            self.dataChanged.emit(self.index(first), self.index(last))
+
+
+class MessageDelegate(QStyledItemDelegate):
+    # Lays out and paints a message bubble, only for the rows the view asks about, the visible ones when painting
+    MARGIN = 10  # Between the view edge and the bubble
+    PADDING_H = 10
+    PADDING_V = 4
+    LINE_SPACING = 2
+    GROUP_SPACING = 8  # Above the first bubble of a group
+    BUBBLE_SPACING = 2
+    LARGE_RADIUS = 12
+    SMALL_RADIUS = 4
+    MAX_WIDTH = 0.7  # Of the view width
+
+    def __init__(self, view: QListView, layouts: TextLayoutCache, theme: Theme):
+        super().__init__(view)
+        self.view = view
+        self.layouts = layouts
+        self.theme = theme  # Colours are read from it on every paint, a theme switch is a repaint
+        self._fonts = {}  # font key -> (name_font, time_font, name metrics, time metrics)
+
+    def text_width(self) -> int:
+        # Width messages wrap at, rounded down to the layout cache's bucket
+        return self.layouts.bucket_width(int(self.view.viewport().width() * self.MAX_WIDTH) - 2 * self.PADDING_H)
+
+    def _fonts_for(self, font: QFont):
+        fonts = self._fonts.get(font.key())
+        if fonts is None:
+            name_font = QFont(font)
+            name_font.setBold(True)
+            time_font = QFont(font)
+            time_font.setPixelSize(10)
+            fonts = self._fonts[font.key()] = (name_font, time_font, QFontMetrics(name_font), QFontMetrics(time_font))
+        return fonts
+
+    def _layout(self, option, index) -> BubbleLayout:
+        model = index.model()
+        row, first, last, own = model.message(index.row())
+        name_font, time_font, name_fm, time_fm = self._fonts_for(option.font)
+        max_text_width = self.text_width()
+
+        text_width, text_height = self.layouts.measure(row[1] or "", option.font, max_text_width)
+        timestamp = datetime.datetime.fromtimestamp(row[3]).strftime("%H:%M")
+        deleted = row[0] in model.deleted
+        if deleted:
+            timestamp = f"{DELETED_MARK} {timestamp}"
+        elif row[0] in model.edited:
+            timestamp = f"{EDITED_MARK} {timestamp}"
+        width = max(text_width, time_fm.horizontalAdvance(timestamp))
+        height = self.PADDING_V + text_height + self.LINE_SPACING + time_fm.height() + self.PADDING_V
+        name_height = 0
+        if first:
+            width = max(width, name_fm.horizontalAdvance(row[2] or ""))
+            name_height = name_fm.height()
+            height += name_height + self.LINE_SPACING
+        width = min(width, max_text_width) + 2 * self.PADDING_H
+        spacing = self.GROUP_SPACING if first else self.BUBBLE_SPACING
+        return BubbleLayout(
+            row, first, last, own, deleted, timestamp, spacing, width, height, name_height, text_height,
+            name_font, time_font,
+        )
+
+    def sizeHint(self, option, index):
+        layout = self._layout(option, index)
+        return QSize(self.view.viewport().width(), layout.spacing + layout.height)
+
+    def paint(self, painter: QPainter, option, index):
+        layout = self._layout(option, index)
+        rect = option.rect
+        top = rect.top() + layout.spacing
+        left = rect.right() - self.MARGIN - layout.width if layout.own else rect.left() + self.MARGIN
+
+        top_radius = self.LARGE_RADIUS if layout.first else self.SMALL_RADIUS
+        bottom_radius = self.LARGE_RADIUS if layout.last else self.SMALL_RADIUS
+        small = self.SMALL_RADIUS
+        radii = (top_radius, small, small, bottom_radius) if layout.own else (small, top_radius, bottom_radius, small)
+
+        colors = self.theme.colors
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(colors["own_bubble"] if layout.own else colors["other_bubble"])
+        painter.drawPath(bubble_path(QRectF(left, top, layout.width, layout.height), *radii))
+
+        x = left + self.PADDING_H
+        y = top + self.PADDING_V
+        inner_width = layout.width - 2 * self.PADDING_H
+        if layout.first:
+            painter.setFont(layout.name_font)
+            painter.setPen(colors["own_name"] if layout.own else colors["other_name"])
+            painter.drawText(QRect(x, y, inner_width, layout.name_height), 0, layout.row[2] or "")
+            y += layout.name_height + self.LINE_SPACING
+        painter.setFont(option.font)
+        painter.setPen(colors["timestamp"] if layout.deleted else colors["bubble_text"])
+        painter.drawText(QRect(x, y, inner_width, layout.text_height), Qt.TextFlag.TextWordWrap, layout.row[1] or "")
+        y += layout.text_height + self.LINE_SPACING
+        painter.setFont(layout.time_font)
+        painter.setPen(colors["timestamp"])
+        time_rect = QRect(x, y, inner_width, top + layout.height - y)
+        painter.drawText(time_rect, Qt.AlignmentFlag.AlignRight, layout.timestamp)
+        painter.restore()
+
+
+def bubble_path(rect: QRectF, top_left: int, top_right: int, bottom_right: int, bottom_left: int) -> QPainterPath:
+    # Rounded rectangle with its own radius per corner
+    path = QPainterPath()
+    path.moveTo(rect.left() + top_left, rect.top())
+    path.lineTo(rect.right() - top_right, rect.top())
+    path.arcTo(rect.right() - 2 * top_right, rect.top(), 2 * top_right, 2 * top_right, 90, -90)
+    path.lineTo(rect.right(), rect.bottom() - bottom_right)
+    path.arcTo(
+        rect.right() - 2 * bottom_right, rect.bottom() - 2 * bottom_right, 2 * bottom_right, 2 * bottom_right, 0, -90
+    )
+    path.lineTo(rect.left() + bottom_left, rect.bottom())
+    path.arcTo(rect.left(), rect.bottom() - 2 * bottom_left, 2 * bottom_left, 2 * bottom_left, 270, -90)
+    path.lineTo(rect.left(), rect.top() + top_left)
+    path.arcTo(rect.left(), rect.top(), 2 * top_left, 2 * top_left, 180, -90)
+    path.closeSubpath()
+    return path
+
+
+class MessageView(QListView):
+    # Only the visible rows are painted. Heights depend on the width, a resize lays the rows out again. The model
+    # holds at most MAX_ROWS, so a layout pass stays cheap however far the user scrolls.
+    MAX_ROWS = 1000
+
+    def __init__(self, parent=None, layouts: TextLayoutCache = None, theme: Theme = None):
+        super().__init__(parent)
+        self._pinned = None  # "bottom", or (message_id, offset) of the row to keep in place across the next layout
+        self.layouts = layouts if layouts is not None else TextLayoutCache()
+        self._text_font = None  # Font and wrap width of the last layout, GUI thread only: see text_layout
+        self._text_width = None
+        self.setModel(MessageListModel(self))
+        self.theme = theme if theme is not None else Theme(parent=self)
+        self.theme.changed.connect(self.viewport().update)
+        self.setItemDelegate(MessageDelegate(self, self.layouts, self.theme))
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setWordWrap(True)  # Without it QListView only lays out again when the height changes
+        self.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+
+    def text_layout(self):
+        # (font, wrap width) of the last layout, None before the first one. Taken on the GUI thread and handed to
+        # code on other threads, which measure with it through layouts.precompute.
+        if self._text_width is None:
+            return None
+        return QFont(self._text_font), self._text_width
+
+    def precompute(self, texts):
+        # Measures texts about to be shown off the GUI thread. A Future, or None before the first layout.
+        layout = self.text_layout()
+        if layout is None:
+            return None
+        return self.layouts.precompute(texts, *layout)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        width = self.itemDelegate().text_width()
+        if width != self._text_width:
+            self._text_font, self._text_width = QFont(self.font()), width
+            # Qt lays the rows out again 100 ms after the last resize, the worker measures them meanwhile
+            self.precompute([row[1] or "" for row in self.model().rows])
+
+    def keep_position(self):
+        # Rows are about to be inserted or removed above the visible ones, what the user looks at must not move
+        index = self.indexAt(self.viewport().rect().topLeft())
+        if index.isValid() and self._pinned is None:  # Or already pinned since the last layout
+            self._pinned = (index.data(MESSAGE_ID_ROLE), self.visualRect(index).top())
+
+    def stick_to_bottom(self):
+        self._pinned = "bottom"
+
+    def updateGeometries(self):
+        # Called once the rows are laid out and the scroll range is final
+        super().updateGeometries()
+        pinned, self._pinned = self._pinned, None
+        scrollbar = self.verticalScrollBar()
+        if pinned == "bottom":
+            scrollbar.setValue(scrollbar.maximum())
+        elif pinned is not None:
+            message_id, offset = pinned
+            model = self.model()
+            position = model.position(message_id)
+            if position is not None:
+                top = self.rectForIndex(model.index(position)).top()
+                scrollbar.setValue(top - offset)
+
+    def message_id_at(self, pos):
+        index = self.indexAt(pos)
+        return index.data(MESSAGE_ID_ROLE) if index.isValid() else None
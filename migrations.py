@@ -0,0 +1,595 @@
+# migrations.py
+import logging
+import time
+
+from compression import encode_version
+
+COPY_BATCH_SIZE = 20000
+
+MESSAGES_FTS_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+    END;
+"""
+
+# chat_summary follows every write to messages, whichever path made it. A message above read_id counts as unread
+# unless it is our own. A chat seen for the first time starts with the unread count Telegram reported for it, read
+# up to that message: older history filled in below it does not count.
+# Newest date among a chat's messages that are not deleted, read backwards from idx_messages_chat_created
+LAST_ACTIVITY = (
+    "SELECT created_at FROM messages WHERE chat_id = {chat_id} AND deleted = 0 ORDER BY created_at DESC LIMIT 1"
+)
+
+CHAT_SUMMARY_TRIGGERS = f"""
+    CREATE TRIGGER IF NOT EXISTS chat_summary_ai AFTER INSERT ON messages WHEN new.deleted = 0 BEGIN
+        INSERT INTO chat_summary (chat_id, last_message_id, last_sender_id, last_content, last_activity_at, read_id,
+                                  unread_count)
+        VALUES (new.chat_id, new.message_id, new.sender_id, substr(new.content, 1, 200), new.created_at,
+                new.message_id, coalesce((SELECT unread_count FROM dialogs WHERE chat_id = new.chat_id), 0))
+        ON CONFLICT (chat_id) DO UPDATE SET
+            unread_count = unread_count + (
+                new.message_id > read_id AND new.sender_id != coalesce((SELECT user_id FROM account), 0)
+            ),
+            last_sender_id = CASE WHEN new.message_id > last_message_id THEN new.sender_id ELSE last_sender_id END,
+            last_content = CASE
+                WHEN new.message_id > last_message_id THEN substr(new.content, 1, 200) ELSE last_content
+            END,
+            last_activity_at = max(last_activity_at, new.created_at),
+            last_message_id = max(last_message_id, new.message_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chat_summary_au AFTER UPDATE OF content ON messages BEGIN
+        UPDATE chat_summary SET last_content = substr(new.content, 1, 200)
+        WHERE chat_id = new.chat_id AND last_message_id = new.message_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS chat_summary_ad AFTER UPDATE OF deleted ON messages
+    WHEN new.deleted = 1 AND old.deleted = 0 BEGIN
+        UPDATE chat_summary SET
+            unread_count = max(unread_count - (
+                old.message_id > read_id AND old.sender_id != coalesce((SELECT user_id FROM account), 0)
+            ), 0)
+        WHERE chat_id = old.chat_id;
+        -- The last message is gone, the one before it takes its place
+        UPDATE chat_summary SET
+            (last_message_id, last_sender_id, last_content) = (
+                SELECT message_id, sender_id, substr(content, 1, 200) FROM messages
+                WHERE chat_id = old.chat_id AND deleted = 0 ORDER BY message_id DESC LIMIT 1
+            )
+        WHERE chat_id = old.chat_id AND last_message_id = old.message_id
+          AND EXISTS (SELECT 1 FROM messages WHERE chat_id = old.chat_id AND deleted = 0);
+        -- So is the activity it brought, the chat moves back down the sidebar
+        UPDATE chat_summary SET last_activity_at = ({LAST_ACTIVITY.format(chat_id="old.chat_id")})
+        WHERE chat_id = old.chat_id AND last_activity_at <= old.created_at
+          AND EXISTS (SELECT 1 FROM messages WHERE chat_id = old.chat_id AND deleted = 0);
+        -- No message is left: nothing to preview, the chat is placed by Telegram's last message time like one
+        -- without stored messages. The next message stored takes over as the last one.
+        UPDATE chat_summary SET
+            last_message_id = 0, last_sender_id = NULL, last_content = NULL,
+            last_activity_at = coalesce((SELECT last_message_at FROM dialogs WHERE chat_id = old.chat_id), 0)
+        WHERE chat_id = old.chat_id
+          AND NOT EXISTS (SELECT 1 FROM messages WHERE chat_id = old.chat_id AND deleted = 0);
+    END;
+"""
+
+MESSAGE_EVENTS_FTS_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS message_events_fts_ai AFTER INSERT ON message_events BEGIN
+        INSERT INTO message_events_fts (rowid, content) VALUES (new.event_id, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS message_events_fts_ad AFTER DELETE ON message_events BEGIN
+        INSERT INTO message_events_fts (message_events_fts, rowid, content)
+        VALUES ('delete', old.event_id, old.content);
+    END;
+"""
+
+
+async def get_version(conn) -> int:
+    async with conn.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    return version
+
+
+async def _fetch_value(conn, query: str, params=()):
+    async with conn.execute(query, params) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def _copy_in_batches(
+    conn, name: str, version: int, position_sql: str, total_sql: str, copy_sql: str, progress
+):
+    # The target table doubles as the checkpoint: each batch is committed on its own and a restarted
+    # migration continues after the highest key already copied
+    position = await _fetch_value(conn, position_sql) or 0
+    total = await _fetch_value(conn, total_sql) or 0
+    done = await _fetch_value(conn, f"SELECT count(*) FROM {name}")
+    while True:
+        cursor = await conn.execute(copy_sql, (position, COPY_BATCH_SIZE))
+        copied = cursor.rowcount
+        await cursor.close()
+        await conn.commit()
+        if copied <= 0:
+            break
+        done += copied
+        position = await _fetch_value(conn, position_sql)
+        logging.info(f"DB_MIGRATE_PROGRESS: version={version}, table={name}, done={done}/{total}")
+        if progress:
+            progress(version, name, done, total)
+
+
+async def _base_schema(conn, progress):
+    await conn.executescript("""
+        BEGIN;
+
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            chat_type TEXT NOT NULL,
+            title TEXT,
+            description TEXT,
+            rules TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT,
+            created_at INTEGER NOT NULL,
+            reply_to INTEGER,
+            forwarded_from INTEGER,
+            message_type TEXT,
+            media_path TEXT,
+            version INTEGER DEFAULT 1,
+            pinned INTEGER DEFAULT 0,
+            history_id TEXT NOT NULL PRIMARY KEY,
+            read_status INTEGER DEFAULT 0,
+            deleted INTEGER DEFAULT 0,
+            edited INTEGER DEFAULT 0,
+            FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+            FOREIGN KEY(sender_id) REFERENCES users(user_id),
+            FOREIGN KEY(reply_to) REFERENCES messages(message_id),
+            FOREIGN KEY(forwarded_from) REFERENCES messages(message_id),
+            UNIQUE(chat_id, message_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_sender_id ON messages (chat_id, sender_id, message_id);
+
+        CREATE TABLE IF NOT EXISTS message_events (
+            event_id INTEGER PRIMARY KEY,
+            history_id TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            content TEXT,
+            created_at INTEGER NOT NULL,
+            reply_to INTEGER,
+            forwarded_from INTEGER,
+            message_type TEXT,
+            media_path TEXT,
+            replaced_content TEXT,
+            version INTEGER NOT NULL,
+            pinned INTEGER DEFAULT 0,
+            FOREIGN KEY(reply_to) REFERENCES messages(message_id),
+            FOREIGN KEY(forwarded_from) REFERENCES messages(message_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_message_events_history_id ON message_events (history_id);
+
+        CREATE TABLE IF NOT EXISTS attachments (
+            attachment_id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL,
+            attachment_type TEXT NOT NULL,
+            file_path TEXT,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(message_id) REFERENCES messages(message_id)
+        );
+
+        PRAGMA user_version = 1;
+        COMMIT;
+    """)
+
+
+async def _full_text_search(conn, progress):
+    # Databases from before versioning may already have these tables, rebuilding them once is harmless
+    await conn.executescript(f"""
+        BEGIN;
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+        );
+        {MESSAGES_FTS_TRIGGERS}
+
+        -- Every version of a message has its own event row, so indexing event content covers
+        -- edited and deleted versions without also indexing replaced_content
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_events_fts USING fts5(
+            content, content='message_events', content_rowid='event_id', tokenize='unicode61 remove_diacritics 2'
+        );
+        {MESSAGE_EVENTS_FTS_TRIGGERS}
+
+        INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+        INSERT INTO message_events_fts (message_events_fts) VALUES ('rebuild');
+
+        PRAGMA user_version = 2;
+        COMMIT;
+    """)
+
+
+async def _compact_message_key(conn, progress):
+    # history_id was a 32 char hex digest of chat_id and message_id, repeated in both tables and their indexes.
+    # Messages stay a rowid table (rows are large and messages_fts maps to the rowid), the composite primary
+    # key replaces both the digest and the separate UNIQUE(chat_id, message_id) index.
+    await conn.executescript("""
+        CREATE TABLE IF NOT EXISTS messages_v3 (
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT,
+            created_at INTEGER NOT NULL,
+            reply_to INTEGER,
+            forwarded_from INTEGER,
+            message_type TEXT,
+            media_path TEXT,
+            version INTEGER DEFAULT 1,
+            pinned INTEGER DEFAULT 0,
+            read_status INTEGER DEFAULT 0,
+            deleted INTEGER DEFAULT 0,
+            edited INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, message_id),
+            FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+            FOREIGN KEY(sender_id) REFERENCES users(user_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS message_events_v3 (
+            event_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            content TEXT,
+            created_at INTEGER NOT NULL,
+            reply_to INTEGER,
+            forwarded_from INTEGER,
+            message_type TEXT,
+            media_path TEXT,
+            replaced_content TEXT,
+            version INTEGER NOT NULL,
+            pinned INTEGER DEFAULT 0
+        );
+    """)
+
+    # Events first: their chat_id/message_id come from the old messages table through history_id
+    await _copy_in_batches(
+        conn,
+        "message_events_v3",
+        3,
+        "SELECT max(event_id) FROM message_events_v3",
+        "SELECT count(*) FROM message_events",
+        """
+        INSERT INTO message_events_v3 (event_id, chat_id, message_id, event_type, content, created_at, reply_to,
+                                       forwarded_from, message_type, media_path, replaced_content, version, pinned)
+        SELECT e.event_id, m.chat_id, m.message_id, e.event_type, e.content, e.created_at, e.reply_to,
+               e.forwarded_from, e.message_type, e.media_path, e.replaced_content, e.version, e.pinned
+        FROM message_events e JOIN messages m ON m.history_id = e.history_id
+        WHERE e.event_id > ?
+        ORDER BY e.event_id
+        LIMIT ?
+        """,
+        progress,
+    )
+    # Rowids are kept so messages_fts stays valid without a rebuild
+    await _copy_in_batches(
+        conn,
+        "messages_v3",
+        3,
+        "SELECT max(rowid) FROM messages_v3",
+        "SELECT count(*) FROM messages",
+        """
+        INSERT INTO messages_v3 (rowid, message_id, chat_id, sender_id, content, created_at, reply_to, forwarded_from,
+                                 message_type, media_path, version, pinned, read_status, deleted, edited)
+        SELECT rowid, message_id, chat_id, sender_id, content, created_at, reply_to, forwarded_from,
+               message_type, media_path, version, pinned, read_status, deleted, edited
+        FROM messages
+        WHERE rowid > ?
+        ORDER BY rowid
+        LIMIT ?
+        """,
+        progress,
+    )
+
+    # Events whose message never made it into the database are dropped, their index entries with them
+    orphaned = await _fetch_value(conn, "SELECT count(*) FROM message_events") != await _fetch_value(
+        conn, "SELECT count(*) FROM message_events_v3"
+    )
+    await conn.executescript(f"""
+        BEGIN;
+
+        DROP TABLE messages;
+        ALTER TABLE messages_v3 RENAME TO messages;
+        DROP TABLE message_events;
+        ALTER TABLE message_events_v3 RENAME TO message_events;
+
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_sender_id ON messages (chat_id, sender_id, message_id);
+        CREATE INDEX IF NOT EXISTS idx_message_events_message ON message_events (chat_id, message_id);
+
+        {MESSAGES_FTS_TRIGGERS}
+        {MESSAGE_EVENTS_FTS_TRIGGERS}
+        {"INSERT INTO message_events_fts (message_events_fts) VALUES ('rebuild');" if orphaned else ""}
+
+        PRAGMA user_version = 3;
+        COMMIT;
+    """)
+
+
+async def _compressed_history(conn, progress):
+    # Event rows stop carrying replaced_content (it is always the previous version) and edits become deltas, so
+    # event content is no longer indexable text. message_events_fts turns contentless and is fed by the writers.
+    await conn.executescript("""
+        BEGIN;
+
+        ALTER TABLE message_events ADD COLUMN codec INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE message_events ADD COLUMN packed BLOB;
+        ALTER TABLE message_events ADD COLUMN dict_id INTEGER;
+
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            dict_id INTEGER PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+
+        DROP TRIGGER IF EXISTS message_events_fts_ai;
+        DROP TRIGGER IF EXISTS message_events_fts_ad;
+        DROP TABLE IF EXISTS message_events_fts;
+        CREATE VIRTUAL TABLE message_events_fts USING fts5(
+            content, content='', tokenize='unicode61 remove_diacritics 2'
+        );
+        -- A deleted event repeats the version before it, indexing it again only duplicated search hits
+        INSERT INTO message_events_fts (rowid, content)
+        SELECT event_id, content FROM message_events WHERE event_type != 'deleted' AND content IS NOT NULL;
+
+        UPDATE message_events SET replaced_content = NULL WHERE replaced_content IS NOT NULL;
+    """)
+
+    # Only messages with more than one event have anything to delta-encode
+    async with conn.execute("""
+        SELECT e.event_id, e.chat_id, e.message_id, e.content
+        FROM message_events e
+        JOIN (SELECT chat_id, message_id FROM message_events GROUP BY chat_id, message_id HAVING count(*) > 1) k
+            ON k.chat_id = e.chat_id AND k.message_id = e.message_id
+        ORDER BY e.chat_id, e.message_id, e.event_id
+    """) as cursor:
+        rows = await cursor.fetchall()
+    updates = []
+    previous_key = previous = None
+    for event_id, chat_id, message_id, content in rows:
+        if (chat_id, message_id) == previous_key:
+            codec, stored = encode_version(previous, content)
+            if stored != content:
+                updates.append((codec, stored, event_id))
+        previous_key = (chat_id, message_id)
+        previous = content
+    await conn.executemany("UPDATE message_events SET codec = ?, content = ? WHERE event_id = ?", updates)
+    logging.info(f"DB_MIGRATE_PROGRESS: version=4, table=message_events, delta_encoded={len(updates)}")
+
+    # executescript() would commit the open transaction before running, so the version is bumped directly
+    await conn.execute("PRAGMA user_version = 4")
+    await conn.commit()
+
+
+async def _media_store(conn, progress):
+    # Attachments point into the content-addressed store. file_key is the Telegram photo/document id,
+    # which forwarded copies share, and media_blobs holds one row per stored file for quota accounting.
+    await conn.executescript("""
+        BEGIN;
+
+        ALTER TABLE attachments ADD COLUMN chat_id INTEGER;
+        ALTER TABLE attachments ADD COLUMN file_key TEXT;
+        ALTER TABLE attachments ADD COLUMN sha256 TEXT;
+        ALTER TABLE attachments ADD COLUMN size INTEGER;
+
+        -- One row per message and type, _write_attachment upserts on it. Rows from before chat_id was stored keep
+        -- it NULL and never conflict.
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_attachments_message ON attachments (chat_id, message_id, attachment_type);
+        CREATE INDEX IF NOT EXISTS idx_attachments_file_key ON attachments (file_key);
+
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            sha256 TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access INTEGER NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_media_blobs_last_access ON media_blobs (last_access);
+
+        PRAGMA user_version = 5;
+        COMMIT;
+    """)
+
+
+async def _archive_months(conn, progress):
+    # One row per chat and archived month: which archive file to ATTACH for a given message id range
+    await conn.executescript("""
+        BEGIN;
+
+        CREATE TABLE IF NOT EXISTS archive_months (
+            chat_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, month)
+        );
+
+        PRAGMA user_version = 6;
+        COMMIT;
+    """)
+
+
+async def _chat_sync(conn, progress):
+    # Per-chat sync checkpoints. oldest_id is the lowest message id the backfill has fetched so far.
+    await conn.executescript("""
+        BEGIN;
+
+        CREATE TABLE IF NOT EXISTS chat_sync (
+            chat_id INTEGER PRIMARY KEY,
+            oldest_id INTEGER,
+            backfill_fetched INTEGER NOT NULL DEFAULT 0,
+            backfill_complete INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        );
+
+        PRAGMA user_version = 7;
+        COMMIT;
+    """)
+
+
+async def _sync_high_water(conn, progress):
+    # newest_id/oldest_id bound the contiguous run of messages fetched from the top of each chat
+    await conn.executescript("""
+        BEGIN;
+
+        ALTER TABLE chat_sync ADD COLUMN newest_id INTEGER;
+
+        PRAGMA user_version = 8;
+        COMMIT;
+    """)
+
+
+async def _synced_ranges(conn, progress):
+    # Message id ranges fetched from Telegram in full, ids inside a range that are not stored do not exist.
+    # The run recorded in chat_sync is the only range known for existing databases.
+    await conn.executescript("""
+        BEGIN;
+
+        CREATE TABLE IF NOT EXISTS synced_ranges (
+            chat_id INTEGER NOT NULL,
+            low INTEGER NOT NULL,
+            high INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, low)
+        ) WITHOUT ROWID;
+
+        INSERT OR IGNORE INTO synced_ranges (chat_id, low, high)
+        SELECT chat_id, CASE WHEN backfill_complete THEN 1 ELSE oldest_id END, newest_id FROM chat_sync
+        WHERE oldest_id IS NOT NULL AND newest_id IS NOT NULL;
+
+        PRAGMA user_version = 9;
+        COMMIT;
+    """)
+
+
+async def _message_id_index(conn, progress):
+    # Deletions in private chats and basic groups arrive without a chat id, the message id alone finds them
+    await conn.executescript("""
+        BEGIN;
+
+        CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id);
+
+        PRAGMA user_version = 10;
+        COMMIT;
+    """)
+
+
+async def _dialog_cache(conn, progress):
+    # The sidebar and the current account, so the window opens from the database before any request
+    await conn.executescript("""
+        BEGIN;
+
+        CREATE TABLE IF NOT EXISTS dialogs (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            username TEXT,
+            position INTEGER NOT NULL,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            pinned INTEGER NOT NULL DEFAULT 0,
+            last_message_at INTEGER,
+            updated_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_dialogs_position ON dialogs (position);
+
+        CREATE TABLE IF NOT EXISTS account (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            updated_at INTEGER NOT NULL
+        );
+
+        PRAGMA user_version = 11;
+        COMMIT;
+    """)
+
+
+async def _chat_summary(conn, progress):
+    # One row per chat with its last message and unread count, so the sidebar is a single scan of this table.
+    # Existing chats start read, with the unread count Telegram reported last.
+    await conn.executescript(f"""
+        BEGIN;
+
+        CREATE TABLE IF NOT EXISTS chat_summary (
+            chat_id INTEGER PRIMARY KEY,
+            last_message_id INTEGER NOT NULL,
+            last_sender_id INTEGER,
+            last_content TEXT,  -- First 200 characters
+            last_activity_at INTEGER NOT NULL,
+            read_id INTEGER NOT NULL DEFAULT 0,  -- Messages up to it were seen
+            unread_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_summary_activity ON chat_summary (last_activity_at);
+
+        INSERT OR IGNORE INTO chat_summary (chat_id, last_message_id, last_sender_id, last_content, last_activity_at,
+                                            read_id, unread_count)
+        SELECT m.chat_id, m.message_id, m.sender_id, substr(m.content, 1, 200), m.created_at, m.message_id,
+               coalesce(d.unread_count, 0)
+        FROM (SELECT chat_id, max(message_id) AS message_id FROM messages WHERE deleted = 0 GROUP BY chat_id) l
+        JOIN messages m ON m.chat_id = l.chat_id AND m.message_id = l.message_id
+        LEFT JOIN dialogs d ON d.chat_id = m.chat_id;
+
+        {CHAT_SUMMARY_TRIGGERS}
+
+        PRAGMA user_version = 12;
+        COMMIT;
+    """)
+
+
+# Each step must bump user_version in the same transaction as its last change
+MIGRATIONS = [
+    (1, "base schema", _base_schema),
+    (2, "full-text search", _full_text_search),
+    (3, "compact message key", _compact_message_key),
+    (4, "compressed history", _compressed_history),
+    (5, "media store", _media_store),
+    (6, "message archive", _archive_months),
+    (7, "chat sync checkpoints", _chat_sync),
+    (8, "sync high-water marks", _sync_high_water),
+    (9, "synced ranges", _synced_ranges),
+    (10, "message id index", _message_id_index),
+    (11, "dialog cache", _dialog_cache),
+    (12, "chat summary", _chat_summary),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def migrate(conn, progress=None):
+    version = await get_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this build ({SCHEMA_VERSION})")
+    for target, name, step in MIGRATIONS:
+        if target <= version:
+            continue
+        start_time = time.time()
+        logging.info(f"DB_MIGRATE: {version} -> {target} ({name})")
+        await step(conn, progress)
+        version = await get_version(conn)
+        logging.info(f"DB_MIGRATED: version={version}, time={time.time() - start_time:.2f}s")
+    return version
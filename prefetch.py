@@ -0,0 +1,121 @@
+# prefetch.py
+import asyncio
+import logging
+import time
+
+from telethon.errors import FloodWaitError
+
+UNREAD_WEIGHT = 3.0  # Reached at UNREAD_CAP unread messages
+UNREAD_CAP = 20
+PINNED_WEIGHT = 2.0
+RECENCY_WEIGHT = 1.0
+RECENCY_HALF_LIFE = 6 * 3600
+
+
+def dialog_score(dialog, now: float) -> float:
+    # dialog is a tg_api.DialogInfo
+    unread = min(dialog.unread_count or 0, UNREAD_CAP) / UNREAD_CAP
+    age = max(0.0, now - dialog.last_message_at) if dialog.last_message_at else float("inf")
+    recency = 0.5 ** (age / RECENCY_HALF_LIFE)
+    return UNREAD_WEIGHT * unread + PINNED_WEIGHT * bool(dialog.pinned) + RECENCY_WEIGHT * recency
+
+
+class Prefetcher:
+    # Warms the chats the user is likely to open next: their newest messages are synced into SQLite and their first
+    # page into the window cache. One chat at a time, and it backs off whenever the user opens a chat: the chat being
+    # warmed is cancelled so its requests don't queue ahead of the user's, and nothing starts for quiet_after_open.
+    # Candidates come from the stored dialog list, the only requests are the syncs, paced by the manager's api_bucket.
+    def __init__(self, manager, top: int = 8, limit: int = 50, quiet_after_open: float = 10.0, pause: float = 0.5):
+        self.manager = manager
+        self.top = top
+        self.limit = limit
+        self.quiet_after_open = quiet_after_open
+        self.pause = pause  # Between chats, leaves room for anything else waiting on the connection
+        self._opened_at = 0.0
+        self._opened = set()  # Opened by the user during this pass, their own sync covers them
+        self._current = None  # (chat_id, task) being warmed
+        self._yielded = False  # The current task was cancelled by yield_to, not the pass itself
+        self._task = None
+        self.warmed = 0
+        self.cancelled = 0
+
+    def rank(self, dialogs):
+        now = time.time()
+        return sorted(dialogs, key=lambda dialog: dialog_score(dialog, now), reverse=True)
+
+    def yield_to(self, chat_id: int):
+        # Called on the loop when the user opens a chat
+        self._opened_at = time.monotonic()
+        self._opened.add(chat_id)
+        if self._current is not None:
+            current_chat_id, task = self._current
+            if not task.done():
+                self._yielded = True
+                task.cancel()
+                logging.info(f"PREFETCH_YIELD: chat_id={current_chat_id}, opened={chat_id}")
+
+    async def _wait_quiet(self):
+        while (remaining := self._opened_at + self.quiet_after_open - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+
+    def start(self, interval: float = None):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run(interval=interval))
+
+    async def run(self, dialogs=None, interval: float = None):
+        # One pass over the top chats, repeated every interval seconds when given
+        while True:
+            await self._pass(dialogs)
+            if interval is None:
+                return
+            dialogs = None
+            await asyncio.sleep(interval)
+
+    async def _pass(self, dialogs):
+        start_time = time.time()
+        if dialogs is None:
+            dialogs = await self.manager.load_dialogs()  # Kept current by refresh_dialogs
+        self._opened.clear()
+        pending = [dialog.chat_id for dialog in self.rank(dialogs)[: self.top]]
+        logging.info(f"PREFETCH_START: chats={pending}")
+        while pending:
+            await self._wait_quiet()
+            chat_id = pending.pop(0)
+            if chat_id in self._opened:
+                continue
+            task = asyncio.get_running_loop().create_task(self._warm(chat_id))
+            self._current = (chat_id, task)
+            self._yielded = False
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not self._yielded:
+                    raise  # The pass itself was cancelled
+                self.cancelled += 1
+                pending.append(chat_id)  # Retried after the others, unless the user opened it
+                continue
+            except Exception as exc:
+                logging.error(f"PREFETCH_ERR: chat_id={chat_id}, exc={exc}")
+            finally:
+                self._current = None
+            await asyncio.sleep(self.pause)
+        logging.info(f"PREFETCH_DONE: {self.stats()}, time={time.time() - start_time:.2f}s")
+
+    async def _warm(self, chat_id: int):
+        await self.manager.api_bucket.acquire()  # limit is at most one history request
+        try:
+            await self.manager.sync_chat(chat_id, self.limit)
+        except FloodWaitError as exc:
+            self.manager.api_bucket.pause(exc.seconds + 1)
+            raise
+        await self.manager.get_messages_for_batch(chat_id, "older", None, None, self.limit)
+        self.warmed += 1
+
+    def stats(self) -> dict:
+        return {"warmed": self.warmed, "cancelled": self.cancelled, "opened": len(self._opened)}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,36 @@
+# ratelimit.py
+import asyncio
+import time
+
+API_RATE = 3.0  # Requests per second for background work: backfill, prefetch and media downloads
+API_BURST = 5
+
+
+class TokenBucket:
+    # One per manager, shared by everything that talks to Telegram in the background, so the request rate is
+    # global. A FloodWait pauses all of them, not just the caller that got it.
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:  # Waiters are served in order
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
@@ -0,0 +1,128 @@
+# startup.py
+# Imports only the standard library: it runs before the heavy modules are loaded and times their import.
+import asyncio
+import contextlib
+import importlib
+import threading
+import time
+from concurrent.futures import Future
+
+
+class StartupProfiler:
+    # Phases are timed from the profiler's creation, in any thread. Overlapping phases ran concurrently.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # (name, start, duration, thread), seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.phases.append((name, start - self.started, end - start, threading.current_thread().name))
+
+    def mark(self, name: str):
+        self.phases.append((name, time.perf_counter() - self.started, 0.0, threading.current_thread().name))
+
+    def as_dict(self) -> dict:
+        # name -> duration in ms, marks give the time since start instead
+        return {
+            name: round((duration or start) * 1000, 1) for name, start, duration, _ in sorted(self.phases, key=_start)
+        }
+
+    def report(self) -> str:
+        lines = [f"{'phase':<28}{'start ms':>10}{'took ms':>10}  thread"]
+        for name, start, duration, thread in sorted(self.phases, key=_start):
+            took = f"{duration * 1000:.1f}" if duration else "-"
+            lines.append(f"{name:<28}{start * 1000:>10.1f}{took:>10}  {thread}")
+        return "\n".join(lines)
+
+
+def _start(phase):
+    return phase[1]
+
+
+def import_in_background(profiler: StartupProfiler, names) -> Future:
+    # Telethon alone takes a few hundred ms to import, it loads while the GUI thread sets up Qt
+    future = Future()
+
+    def run():
+        try:
+            for name in names:
+                with profiler.phase(f"import {name}"):
+                    importlib.import_module(name)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(None)
+
+    threading.Thread(target=run, name="imports", daemon=True).start()
+    return future
+
+
+def start_loop(profiler: StartupProfiler):
+    # Event loop for Telethon in a separate thread
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="loop", daemon=True).start()
+    profiler.mark("loop started")
+    return loop
+
+
+async def initialize(manager, profiler: StartupProfiler):
+    # Opens the database and reads the cached (dialogs, account) the window opens with, the steps that follow the
+    # migrations run concurrently. The client connects in the background: the window doesn't wait for the network,
+    # and offline it shows the cache. account is None on the first start, the window asks Telegram once connected.
+    from media import MediaDownloader
+
+    async def connect():
+        with profiler.phase("client.start"):
+            await manager.connect()
+
+    async def media():
+        with profiler.phase("media.start"):
+            manager.media = MediaDownloader(manager)
+            await manager.media.start()
+
+    async def entities():
+        with profiler.phase("warm_entity_cache"):
+            await manager.warm_entity_cache()
+
+    async def sidebar():
+        with profiler.phase("load_dialogs"):
+            return await asyncio.gather(manager.load_dialogs(), manager.load_account())
+
+    # Errors are logged by the manager, refresh_dialogs reports them to the window
+    asyncio.ensure_future(connect()).add_done_callback(lambda task: task.cancelled() or task.exception())
+    with profiler.phase("create_tables"):
+        await manager._create_tables()
+    _, _, (dialogs, account) = await asyncio.gather(media(), entities(), sidebar())
+    return dialogs, account
+
+
+def open_main_window(client, loop, db_path: str, profiler: StartupProfiler, on_first_frame=None):
+    # Needs a QApplication. Returns (window, manager) once the window is shown.
+    from PyQt6.QtCore import QTimer
+
+    from tg_api import TelegramChatManager
+
+    with profiler.phase("manager"):
+        manager = TelegramChatManager(db_path, client)
+    future = asyncio.run_coroutine_threadsafe(initialize(manager, profiler), loop)
+    with profiler.phase("import ui"):
+        from ui import TelegramWindow  # While the loop initializes
+    with profiler.phase("wait initialize"):
+        dialogs, account = future.result()
+
+    with profiler.phase("window"):
+        window = TelegramWindow(client, manager, loop, dialogs=dialogs, account=account)
+        window.show()
+
+    def first_frame():
+        profiler.mark("first frame")
+        if on_first_frame is not None:
+            on_first_frame()
+
+    QTimer.singleShot(0, first_frame)
+    return window, manager
@@ -0,0 +1,110 @@
+# text_layout.py
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PyQt6.QtCore import QRect, Qt
+from PyQt6.QtGui import QFont, QFontMetrics
+
+
+class TextLayoutCache:
+    # Wrapped size of a text, keyed by (hash of the text, font, width bucket). Widths are rounded down to a multiple
+    # of bucket: a window resized by a few pixels reuses every measurement, and a text measured for the bucket still
+    # fits the real width. Measuring is also done ahead of time on a worker thread, see precompute.
+    def __init__(self, max_entries: int = 50000, bucket: int = 16):
+        self.max_entries = max_entries
+        self.bucket = bucket
+        self._sizes = OrderedDict()  # key -> (width, height), least recently used first
+        self._metrics = {}  # font key -> QFontMetrics, GUI thread only
+        self._lock = threading.Lock()
+        self._executor = None
+        self._closed = False
+        self._generation = 0  # A newer precompute supersedes the ones still queued
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.precomputed = 0
+
+    def bucket_width(self, width: int) -> int:
+        return max(width // self.bucket * self.bucket, self.bucket)
+
+    def measure(self, text: str, font: QFont, width: int):
+        # (width, height) of text wrapped at bucket_width(width)
+        width = self.bucket_width(width)
+        font_key = font.key()
+        key = (hash(text), font_key, width)
+        with self._lock:
+            size = self._sizes.get(key)
+            if size is not None:
+                self._sizes.move_to_end(key)
+                self.hits += 1
+                return size
+            self.misses += 1
+        metrics = self._metrics.get(font_key)
+        if metrics is None:
+            metrics = self._metrics[font_key] = QFontMetrics(font)
+        size = _measure(metrics, text, width)
+        self._store(key, size)
+        return size
+
+    def _store(self, key, size, precomputed: bool = False):
+        with self._lock:
+            self.precomputed += precomputed
+            self._sizes[key] = size
+            self._sizes.move_to_end(key)
+            while len(self._sizes) > self.max_entries:
+                self._sizes.popitem(last=False)
+                self.evictions += 1
+
+    def precompute(self, texts, font: QFont, width: int) -> Future:
+        # Measures the texts not cached yet on a worker thread, so the layout that follows only looks them up
+        width = self.bucket_width(width)
+        font_key, description = font.key(), font.toString()
+
+        def run(generation):
+            worker_font = QFont()
+            worker_font.fromString(description)
+            metrics = QFontMetrics(worker_font)
+            for text in texts:
+                key = (hash(text), font_key, width)
+                with self._lock:
+                    if self._generation != generation:
+                        return
+                    if key in self._sizes:
+                        continue
+                self._store(key, _measure(metrics, text, width), precomputed=True)
+
+        with self._lock:
+            if self._closed:
+                future = Future()
+                future.set_result(None)
+                return future
+            self._generation += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="text-layout")
+            return self._executor.submit(run, self._generation)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._sizes),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "precomputed": self.precomputed,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._generation += 1  # Queued precomputes stop at their next text
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def _measure(metrics: QFontMetrics, text: str, width: int):
+    rect = metrics.boundingRect(QRect(0, 0, width, 0), Qt.TextFlag.TextWordWrap, text)
+    return rect.width(), rect.height()
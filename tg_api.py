@@ -1,163 +1,593 @@
 # tg_api.py
 import asyncio
+import bisect
 import datetime
-import hashlib
+import heapq
+import json
 import logging
 import os
+import re
+import sys
 import time
 import threading
+from collections import OrderedDict, namedtuple
 
 import aiosqlite
 from telethon import TelegramClient, events, types
-from telethon.errors import RPCError
+from telethon.errors import FloodWaitError, RPCError
 from telethon.tl.types import PeerUser, PeerChat, PeerChannel
 
+from archive import MessageArchive
+from changes import ChangeFeed
+from compression import CODEC_DELTA, CODEC_TEXT, decode_version, encode_version, pack, train_dictionary, unpack
+from db import DatabasePool, WriteBehindQueue
+from ingest import IngestPipeline
+from media import PRIORITY_SCAN
+from migrations import migrate
+from prefetch import Prefetcher
+from ratelimit import API_BURST, API_RATE, TokenBucket
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+_NOT_FOUND = object()
+
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+CHANNEL_ID_BOUND = -1000000000000  # Marked channel ids (-100...) are all below it
+
+MAX_GAP_REQUESTS = 2  # History requests per fill_gaps call, more gaps are fetched as merged spans
+
+DICT_MIN_SAMPLES = 500
+DICT_SAMPLE_SIZE = 5000
+
+EntityInfo = namedtuple("EntityInfo", ["chat_type", "title", "username", "first_name", "last_name"])
+# preview is the start of the last stored message, from chat_summary. Not part of what Telegram reports.
+DialogInfo = namedtuple(
+    "DialogInfo", ["chat_id", "title", "username", "unread_count", "pinned", "last_message_at", "preview"],
+    defaults=(None,),
+)
+ChatSummary = namedtuple("ChatSummary", ["preview", "last_activity_at", "unread_count"])
+AccountInfo = namedtuple("AccountInfo", ["id", "username", "first_name", "last_name"])
+# dialogs is the new ordered list, changed the entries that differ from the stored list (or moved), removed their ids
+DialogChanges = namedtuple("DialogChanges", ["account", "dialogs", "changed", "removed"])
+
+
+def entity_info(entity) -> EntityInfo:
+    username = getattr(entity, "username", None) or None
+    if isinstance(entity, types.User):
+        first_name = entity.first_name or None
+        last_name = entity.last_name or None
+    else:
+        first_name = getattr(entity, "title", None)
+        last_name = None
+    chat_type = "channel" if isinstance(entity, (types.Chat, types.Channel)) else "private"
+    title = getattr(entity, "title", None) or username
+    return EntityInfo(chat_type, title, username, first_name, last_name)
+
+
+class EntityCache:
+    def __init__(self, loader, maxsize: int = 10000, ttl: float = 3600, negative_ttl: float = 300):
+        self._loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # entity_id -> (expires_at, value, error)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+
+    def _store(self, entity_id: int, value, error, ttl: float):
+        self._entries[entity_id] = (time.monotonic() + ttl, value, error)
+        self._entries.move_to_end(entity_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def put(self, entity_id: int, value):
+        self._store(entity_id, value, None, self.ttl)
+
+    def invalidate(self, entity_id: int):
+        self._entries.pop(entity_id, None)
+
+    async def get(self, entity_id: int):
+        entry = self._entries.get(entity_id)
+        if entry is not None:
+            expires_at, value, error = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(entity_id)
+                if error is not None:
+                    self.negative_hits += 1
+                    raise error.with_traceback(None)
+                self.hits += 1
+                return value
+            del self._entries[entity_id]
+
+        inflight = self._inflight.get(entity_id)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[entity_id] = future
+        try:
+            value = await self._loader(entity_id)
+        except FloodWaitError as exc:
+            # Transient, the entity may well exist - don't remember it as unresolvable
+            future.set_exception(exc)
+            future.exception()
+            raise
+        except (RPCError, ValueError) as exc:
+            self._store(entity_id, None, exc, self.negative_ttl)
+            future.set_exception(exc)
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            self.put(entity_id, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[entity_id]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.negative_hits + self.coalesced
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.negative_hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+class MessageWindow:
+    __slots__ = ("rows", "ids", "low", "high", "gap_free", "nbytes")
+
+    def __init__(self, rows, low: int, high):
+        self.rows = rows  # As get_messages_for_batch returns them, ascending by message_id
+        self.ids = [row[0] for row in rows]
+        self.low = low  # 0 reaches the first message of the chat
+        self.high = high  # None reaches the newest one
+        self.gap_free = None  # (low, high) id span that fill_gaps found complete
+        self.nbytes = 0
+
+
+class MessageWindowCache:
+    # Rows of recently viewed chats, so switching back to one is served without touching the database. A window
+    # holds every stored, non-deleted message of the chat with an id in [low, high]; pages that fall inside it are
+    # answered from memory. Write paths keep windows current. The GUI thread reads it too, hence the lock.
+    ROW_OVERHEAD = 200  # Bytes for the tuple, its ints and the list slots, roughly
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._windows = OrderedDict()  # chat_id -> MessageWindow, least recently used first
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _row_bytes(self, row) -> int:
+        return self.ROW_OVERHEAD + sys.getsizeof(row[1] or "") + sys.getsizeof(row[2] or "")
+
+    def _resize(self, window: MessageWindow):
+        self.bytes -= window.nbytes
+        window.nbytes = sum(map(self._row_bytes, window.rows))
+        self.bytes += window.nbytes
+
+    def _changed(self, window: MessageWindow):
+        window.ids = [row[0] for row in window.rows]
+        self._resize(window)
+
+    def _drop(self, chat_id: int):
+        window = self._windows.pop(chat_id, None)
+        if window is not None:
+            self.bytes -= window.nbytes
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self._windows) > 1:
+            chat_id, _ = next(iter(self._windows.items()))
+            self._drop(chat_id)
+            self.evictions += 1
+
+    def page(self, chat_id: int, direction: str, min_id, max_id, limit: int):
+        # The rows get_messages_for_batch would return, or None when the window can't tell
+        with self._lock:
+            window = self._windows.get(chat_id)
+            rows = None if window is None else self._page(window, direction, min_id, max_id, limit)
+            if rows is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._windows.move_to_end(chat_id)
+            return rows
+
+    def _page(self, window: MessageWindow, direction: str, min_id, max_id, limit: int):
+        if direction == "older":
+            if window.high is not None and (min_id is None or min_id - 1 > window.high):
+                return None
+            end = len(window.ids) if min_id is None else bisect.bisect_left(window.ids, min_id)
+            start = max(0, end - limit)
+            if end - start < limit and window.low > 0:
+                return None
+        else:
+            if max_id + 1 < window.low:
+                return None
+            start = bisect.bisect_right(window.ids, max_id)
+            end = start + limit
+            if end > len(window.ids) and window.high is not None:
+                return None
+        return window.rows[start:end]
+
+    def store(self, chat_id: int, direction: str, min_id, max_id, limit: int, rows):
+        # Records a page read from the database. It joins the chat's window when the two touch, else replaces it.
+        if direction == "older":
+            low, high = (rows[0][0] if len(rows) >= limit else 0), (None if min_id is None else min_id - 1)
+        else:
+            low, high = max_id + 1, (rows[-1][0] if len(rows) >= limit else None)
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is not None and self._touches(window, low, high):
+                merged = {row[0]: row for row in window.rows}
+                merged.update((row[0], row) for row in rows)
+                window.rows = [merged[message_id] for message_id in sorted(merged)]
+                window.low = min(window.low, low)
+                window.high = None if window.high is None or high is None else max(window.high, high)
+                self._changed(window)
+            else:
+                self._drop(chat_id)
+                window = self._windows[chat_id] = MessageWindow(list(rows), low, high)
+                self._resize(window)
+            self._windows.move_to_end(chat_id)
+            self._evict()
+
+    @staticmethod
+    def _touches(window: MessageWindow, low: int, high) -> bool:
+        return (window.high is None or low <= window.high + 1) and (high is None or window.low <= high + 1)
+
+    def add(self, chat_id: int, row):
+        # A new message, kept when its id is inside the window
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is None or row[0] < window.low or (window.high is not None and row[0] > window.high):
+                return
+            index = bisect.bisect_left(window.ids, row[0])
+            if index < len(window.ids) and window.ids[index] == row[0]:
+                window.rows[index] = row
+            else:
+                window.rows.insert(index, row)
+            self._changed(window)
+
+    def update(self, chat_id: int, message_id: int, content: str):
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+            index = bisect.bisect_left(window.ids, message_id)
+            if index < len(window.ids) and window.ids[index] == message_id:
+                window.rows[index] = (message_id, content, *window.rows[index][2:])
+                self._changed(window)
+
+    def remove(self, chat_id: int, message_ids):
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+            message_ids = set(message_ids)
+            rows = [row for row in window.rows if row[0] not in message_ids]
+            if len(rows) != len(window.rows):
+                window.rows = rows
+                self._changed(window)
+
+    def invalidate(self, chat_id: int, low: int, high: int):
+        # Messages in [low, high] were written in bulk, a window overlapping them is out of date
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is not None and (window.high is None or low <= window.high) and window.low <= high:
+                self._drop(chat_id)
+
+    def is_gap_free(self, chat_id: int, low: int, high: int) -> bool:
+        with self._lock:
+            window = self._windows.get(chat_id)
+            span = window.gap_free if window is not None else None
+            return span is not None and span[0] <= low and high <= span[1]
+
+    def mark_gap_free(self, chat_id: int, low: int, high: int):
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+            span = window.gap_free
+            if span is not None and low <= span[1] + 1 and span[0] <= high + 1:
+                low, high = min(low, span[0]), max(high, span[1])
+            window.gap_free = (low, high)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "chats": len(self._windows),
+                "rows": sum(len(window.rows) for window in self._windows.values()),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class MessageIdSet:
+    # Channel ids are dense, so a bitmap over [base, base + 8 * len(bits)) costs about a bit per message.
+    # Private chats and basic groups share the account-wide id counter and stay a plain set until they get dense.
+    __slots__ = ("base", "bits", "ids", "count")
+
+    def __init__(self, ids=()):
+        self.base = 0
+        self.bits = None
+        self.ids = set(ids)
+        self.count = len(self.ids)
+        self._maybe_pack()
+
+    def _maybe_pack(self):
+        if self.bits is not None or self.count < 64:
+            return
+        low, high = min(self.ids), max(self.ids)
+        if (high - low) // 8 + 1 > self.count * 8:
+            return
+        self.base = low
+        self.bits = bytearray((high - low) // 8 + 1)
+        for message_id in self.ids:
+            offset = message_id - low
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+        self.ids = None
+
+    def __contains__(self, message_id: int) -> bool:
+        if self.bits is None:
+            return message_id in self.ids
+        offset = message_id - self.base
+        if offset < 0 or offset >> 3 >= len(self.bits):
+            return False
+        return bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, message_id: int):
+        if self.bits is None:
+            if message_id not in self.ids:
+                self.ids.add(message_id)
+                self.count += 1
+                if self.count & (self.count - 1) == 0:  # Re-check density at powers of two
+                    self._maybe_pack()
+            return
+        if message_id in self:
+            return
+        offset = message_id - self.base
+        span = max(offset + 1, len(self.bits) * 8 - min(offset, 0))
+        if span // 8 > (self.count + 1) * 8:
+            # The new id is far outside the dense range, fall back to a set rather than grow a mostly empty bitmap
+            self.ids = set(self._iter_bits())
+            self.bits = None
+            self.base = 0
+            self.ids.add(message_id)
+            self.count += 1
+            return
+        if offset < 0:
+            grow = (-offset + 7) // 8
+            self.bits[:0] = bytes(grow)
+            self.base -= grow * 8
+            offset = message_id - self.base
+        elif offset >> 3 >= len(self.bits):
+            self.bits.extend(bytes((offset >> 3) - len(self.bits) + 1))
+        self.bits[offset >> 3] |= 1 << (offset & 7)
+        self.count += 1
+
+    def _iter_bits(self):
+        for index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield self.base + index * 8 + bit
+
+    def nbytes(self) -> int:
+        if self.bits is not None:
+            return sys.getsizeof(self.bits)
+        return sys.getsizeof(self.ids) + sum(sys.getsizeof(message_id) for message_id in self.ids)
+
+
+class KnownIdIndex:
+    def __init__(self):
+        self.users = None  # None until loaded from the database
+        self.chats = None
+        self.messages = {}
+
+    def add_user(self, user_id: int):
+        if self.users is not None:
+            self.users.add(user_id)
+
+    def add_chat(self, chat_id: int):
+        if self.chats is not None:
+            self.chats.add(chat_id)
+
+    def add_message(self, chat_id: int, message_id: int):
+        ids = self.messages.get(chat_id)
+        if ids is not None:
+            ids.add(message_id)
+
+    def add_messages(self, keys):
+        for chat_id, message_id in keys:
+            self.add_message(chat_id, message_id)
+
+    def has_message(self, chat_id: int, message_id: int) -> bool:
+        return message_id in self.messages[chat_id]
+
+    def memory_usage(self) -> dict:
+        def set_bytes(ids):
+            if ids is None:
+                return 0
+            return sys.getsizeof(ids) + sum(sys.getsizeof(item) for item in ids)
+
+        return {
+            "users": len(self.users or ()),
+            "users_bytes": set_bytes(self.users),
+            "chats": len(self.chats or ()),
+            "chats_bytes": set_bytes(self.chats),
+            "messages": sum(len(ids) for ids in self.messages.values()),
+            "messages_bytes": sum(ids.nbytes() for ids in self.messages.values()),
+        }
+
 
 class TelegramChatManager:
-    def __init__(self, db_path: str, client: TelegramClient):
+    def __init__(self, db_path: str, client: TelegramClient, db_readers: int = 4):
         self.db_path = db_path
         self.client = client
         self.assets_path = "assets/"
-        self.processed_events = set()
-        self.max_cache_size = 1000
-        self.db_semaphore = asyncio.Semaphore(1)
+        self.db = DatabasePool(db_path, readers=db_readers)
+        self.write_queue = WriteBehindQueue(self.db)
         self.api_semaphore = asyncio.Semaphore(1)
+        self.api_bucket = TokenBucket(API_RATE, API_BURST)  # Background requests: backfill, prefetch, media
+        self.entities = EntityCache(self._resolve_entity)
+        self.known = KnownIdIndex()
+        self._known_lock = asyncio.Lock()
+        self._sync_locks = {}  # chat_id -> lock, one sync of a chat at a time
+        self._dictionaries = {}  # dict_id -> zlib preset dictionary of packed event rows
+        self.media = None  # media.MediaDownloader, new media messages are queued on it when set
+        self.archive = MessageArchive(self.db, os.path.join(os.path.dirname(db_path), "archive"))
+        self.windows = MessageWindowCache()
+        self.prefetcher = Prefetcher(self)
+        self.ingest = IngestPipeline()  # Live updates are applied through it, per chat in arrival order
+        self.changes = ChangeFeed()  # Committed new, edited and deleted messages, pushed to the open chat
+        self._connecting = None  # Task of client.start(), see connect
         self._register_handlers()  # Uncommented for real-time events
 
+    def start_client(self):
+        # Starts the client in the background, once. A start that failed is tried again by the next caller.
+        task = self._connecting
+        if task is None or task.done() and (task.cancelled() or task.exception() is not None):
+            self._connecting = asyncio.ensure_future(self.client.start())
+            self._connecting.add_done_callback(self._client_started)
+        return self._connecting
+
+    @staticmethod
+    def _client_started(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"CLIENT_START_ERR: exc={task.exception()!r}")  # Offline, the cached data stays usable
+
+    async def connect(self):
+        # Everything that needs the network awaits this first, the storage reads don't
+        await asyncio.shield(self.start_client())
+
     async def _execute_with_semaphore(self, query: str, params=()) -> bool:
         start_time = time.time()
-        async with self.db_semaphore:
-            async with aiosqlite.connect(self.db_path, timeout=10) as conn:
-                try:
-                    await conn.execute(query, params)
-                    await conn.commit()
-                    logging.debug(f"DB_EXEC: query={query[:50]}..., time={time.time() - start_time:.2f}s")
-                    return True
-                except Exception as exc:
-                    logging.exception(
-                        f"DB_EXEC_ERR: query={query[:50]}..., time={time.time() - start_time:.2f}s, exc={exc}"
-                    )
-                    return False
+
+        async def execute(conn):
+            await conn.execute(query, params)
+
+        try:
+            await self.write_queue.run(execute)
+            logging.debug(f"DB_EXEC: query={query[:50]}..., time={time.time() - start_time:.2f}s")
+            return True
+        except Exception as exc:
+            logging.exception(f"DB_EXEC_ERR: query={query[:50]}..., time={time.time() - start_time:.2f}s, exc={exc}")
+            return False
 
     async def _fetch_with_semaphore(self, query: str, params=()):
         start_time = time.time()
-        async with self.db_semaphore:
-            async with aiosqlite.connect(self.db_path, timeout=10) as conn:
-                async with conn.execute(query, params) as cursor:
-                    result = await cursor.fetchall()
-                    logging.debug(f"DB_FETCH: query={query[:50]}..., time={time.time() - start_time:.2f}s")
-                    return result
-
-    async def _create_tables(self):
-        async with self.db_semaphore:
-            async with aiosqlite.connect(self.db_path, timeout=10) as conn:
-                await conn.executescript("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        last_name TEXT
-                    );
-
-                    CREATE TABLE IF NOT EXISTS chats (
-                        chat_id INTEGER PRIMARY KEY,
-                        chat_type TEXT NOT NULL,
-                        title TEXT,
-                        description TEXT,
-                        rules TEXT
-                    );
-
-                    CREATE TABLE IF NOT EXISTS messages (
-                        message_id INTEGER NOT NULL,
-                        chat_id INTEGER NOT NULL,
-                        sender_id INTEGER NOT NULL,
-                        content TEXT,
-                        created_at INTEGER NOT NULL,
-                        reply_to INTEGER,
-                        forwarded_from INTEGER,
-                        message_type TEXT,
-                        media_path TEXT,
-                        version INTEGER DEFAULT 1,
-                        pinned INTEGER DEFAULT 0,
-                        history_id TEXT NOT NULL PRIMARY KEY,
-                        read_status INTEGER DEFAULT 0,
-                        deleted INTEGER DEFAULT 0,
-                        edited INTEGER DEFAULT 0,
-                        FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                        FOREIGN KEY(sender_id) REFERENCES users(user_id),
-                        FOREIGN KEY(reply_to) REFERENCES messages(message_id),
-                        FOREIGN KEY(forwarded_from) REFERENCES messages(message_id),
-                        UNIQUE(chat_id, message_id)
-                    );
-
-                    CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created_at);
-                    CREATE INDEX IF NOT EXISTS idx_messages_chat_sender_id ON messages (chat_id, sender_id, message_id);
-
-                    CREATE TABLE IF NOT EXISTS message_events (
-                        event_id INTEGER PRIMARY KEY,
-                        history_id TEXT NOT NULL,
-                        event_type TEXT NOT NULL,
-                        content TEXT,
-                        created_at INTEGER NOT NULL,
-                        reply_to INTEGER,
-                        forwarded_from INTEGER,
-                        message_type TEXT,
-                        media_path TEXT,
-                        replaced_content TEXT,
-                        version INTEGER NOT NULL,
-                        pinned INTEGER DEFAULT 0,
-                        FOREIGN KEY(reply_to) REFERENCES messages(message_id),
-                        FOREIGN KEY(forwarded_from) REFERENCES messages(message_id)
-                    );
-
-                    CREATE INDEX IF NOT EXISTS idx_message_events_history_id ON message_events (history_id);
-
-                    CREATE TABLE IF NOT EXISTS attachments (
-                        attachment_id INTEGER PRIMARY KEY,
-                        message_id INTEGER NOT NULL,
-                        attachment_type TEXT NOT NULL,
-                        file_path TEXT,
-                        created_at INTEGER NOT NULL,
-                        FOREIGN KEY(message_id) REFERENCES messages(message_id)
-                    );
-                """)
-                await conn.commit()
+        async with self.db.reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                result = await cursor.fetchall()
+                logging.debug(f"DB_FETCH: query={query[:50]}..., time={time.time() - start_time:.2f}s")
+                return result
+
+    async def _create_tables(self, progress=None):
+        async with self.db.writer() as conn:
+            await migrate(conn, progress)
+        await self.archive.load()
         logging.info("DB_INIT: tables created/checked")
 
-    def _generate_history_id(self, chat_id: int, message_id: int) -> str:
-        return hashlib.sha224(f"{chat_id}{message_id}".encode()).hexdigest()[:32]
+    async def _resolve_entity(self, entity_id: int) -> EntityInfo:
+        return entity_info(await self.client.get_entity(entity_id))
+
+    async def warm_entity_cache(self):
+        users = await self._fetch_with_semaphore(
+            "SELECT user_id, username, first_name, last_name FROM users LIMIT ?", (self.entities.maxsize,)
+        )
+        chats = await self._fetch_with_semaphore(
+            "SELECT chat_id, chat_type, title FROM chats LIMIT ?", (self.entities.maxsize,)
+        )
+        infos = {
+            user_id: EntityInfo("private", username, username, first_name, last_name)
+            for user_id, username, first_name, last_name in users
+        }
+        for chat_id, chat_type, title in chats:
+            user = infos.get(chat_id)
+            if user is not None:
+                infos[chat_id] = user._replace(chat_type=chat_type, title=title or user.title)
+            else:
+                infos[chat_id] = EntityInfo(chat_type, title, None, title, None)
+        for entity_id, info in infos.items():
+            self.entities.put(entity_id, info)
+        logging.info(f"ENTITY_CACHE_WARM: entries={len(infos)}")
+
+    async def _read_ids(self, conn, query: str, params=()):
+        async with conn.execute(query, params) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def _load_known(self, kind: str, chat_id: int = None):
+        # Loaded through the write queue so writes still sitting in a batch are not missed
+        async with self._known_lock:
+            if kind == "users" and self.known.users is None:
+                self.known.users = set(await self.write_queue.run(self._read_ids, "SELECT user_id FROM users"))
+            elif kind == "chats" and self.known.chats is None:
+                self.known.chats = set(await self.write_queue.run(self._read_ids, "SELECT chat_id FROM chats"))
+            elif kind == "messages" and chat_id not in self.known.messages:
+                ids = await self.write_queue.run(
+                    self._read_ids, "SELECT message_id FROM messages WHERE chat_id = ?", (chat_id,)
+                )
+                self.known.messages[chat_id] = MessageIdSet(ids)
+            logging.debug(f"KNOWN_LOADED: kind={kind}, chat_id={chat_id}")
 
     async def check_user_exists(self, user_id: int) -> bool:
-        result = await self._fetch_with_semaphore("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-        return bool(result)
+        if self.known.users is None:
+            await self._load_known("users")
+        return user_id in self.known.users
 
     async def check_chat_exists(self, chat_id: int) -> bool:
-        result = await self._fetch_with_semaphore("SELECT 1 FROM chats WHERE chat_id = ?", (chat_id,))
-        return bool(result)
+        if self.known.chats is None:
+            await self._load_known("chats")
+        return chat_id in self.known.chats
 
     async def check_message_exists(self, chat_id: int, message_id: int) -> bool:
-        result = await self._fetch_with_semaphore(
-            "SELECT 1 FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
-        )
-        return bool(result)
+        if chat_id not in self.known.messages:
+            await self._load_known("messages", chat_id)
+        return self.known.has_message(chat_id, message_id) or self.archive.contains(chat_id, message_id)
+
+    async def _unknown_rows(self, chat_id: int, rows):
+        # History rows of messages not stored yet. Pages fetched again (merged gap spans, overlapping syncs, a dropped
+        # backfill page) are mostly stored already, _write_history would only ignore them. Archived ids are not
+        # skipped, archive.contains also covers ids never fetched.
+        if chat_id not in self.known.messages:
+            await self._load_known("messages", chat_id)
+        known = self.known.messages[chat_id]
+        return [row for row in rows if row[0] not in known]
 
     async def save_user(self, user_id: int):
         if not await self.check_user_exists(user_id):
             try:
-                entity = await self.client.get_entity(user_id)
-                username = entity.username or None
-                if isinstance(entity, types.User):
-                    first_name = entity.first_name or None
-                    last_name = entity.last_name or None
-                else:
-                    first_name = entity.title
-                    last_name = None
-                await self._execute_with_semaphore(
-                    "INSERT INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
+                info = await self.entities.get(user_id)
+                username, first_name, last_name = info.username, info.first_name, info.last_name
+                if await self._execute_with_semaphore(
+                    "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
                     (user_id, username, first_name, last_name),
-                )
+                ):
+                    self.known.add_user(user_id)
                 logging.info(f"USR_SAVED: id={user_id}, uname={username}")
             except (RPCError, ValueError) as exc:
                 logging.error(f"ERR_GET_ENTITY: id={user_id}, exc={exc}")
@@ -166,10 +596,11 @@ class TelegramChatManager:
         self, chat_id: int, chat_type: str, title: str, description: str = None, rules: str = None
     ) -> int:
         if not await self.check_chat_exists(chat_id):
-            await self._execute_with_semaphore(
-                "INSERT INTO chats (chat_id, chat_type, title, description, rules) VALUES (?, ?, ?, ?, ?)",
+            if await self._execute_with_semaphore(
+                "INSERT OR IGNORE INTO chats (chat_id, chat_type, title, description, rules) VALUES (?, ?, ?, ?, ?)",
                 (chat_id, chat_type, title, description, rules),
-            )
+            ):
+                self.known.add_chat(chat_id)
             logging.info(f"CHAT_SAVED: id={chat_id}")
         return chat_id
 
@@ -191,11 +622,10 @@ class TelegramChatManager:
             return None
 
         try:
-            chat = await self.client.get_entity(chat_id)
-            chat_type = "channel" if isinstance(chat, (types.Chat, types.Channel)) else "private"
-            title = getattr(chat, "title", None) or getattr(chat, "username", None)
-            await self.save_chat(chat_id, chat_type, title)
-        except RPCError as exc:
+            chat = await self.entities.get(chat_id)
+            title = chat.title
+            await self.save_chat(chat_id, chat.chat_type, title)
+        except (RPCError, ValueError) as exc:
             logging.error(f"ERR_GET_CHAT: id={chat_id}, exc={exc}")
             return None
 
@@ -208,13 +638,47 @@ class TelegramChatManager:
 
         # Removed dup detect - rare case, overhead
 
-        history_id = self._generate_history_id(chat_id, message_id)
         try:
-            await self._execute_with_semaphore(
+            result = await self.write_queue.run(
+                self._write_message,
+                chat_id,
+                sender_id,
+                message_id,
+                content,
+                created_at,
+                reply_to,
+                forwarded_from,
+                message_type,
+                media_path,
+                pinned,
+            )
+        except Exception as exc:
+            logging.exception(f"UNEXP_ERR_SAVE_MSG: chat_id={chat_id}, msg_id={message_id}, exc={exc}")
+            return None
+        if media_path and self.media is not None:
+            self.media.enqueue(chat_id, message_id)
+        return result
+
+    async def _write_message(
+        self,
+        conn,
+        chat_id,
+        sender_id,
+        message_id,
+        content,
+        created_at,
+        reply_to,
+        forwarded_from,
+        message_type,
+        media_path,
+        pinned,
+    ):
+        try:
+            await conn.execute(
                 """
                 INSERT INTO messages (message_id, chat_id, sender_id, content, created_at, reply_to, forwarded_from,
-                                      message_type, media_path, version, pinned, history_id, read_status, deleted, edited)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, 0, 0, 0)
+                                      message_type, media_path, version, pinned, read_status, deleted, edited)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, 0, 0, 0)
                 """,
                 (
                     message_id,
@@ -227,33 +691,22 @@ class TelegramChatManager:
                     message_type,
                     media_path,
                     pinned,
-                    history_id,
                 ),
             )
-            await self._execute_with_semaphore(
+        except aiosqlite.IntegrityError:
+            async with conn.execute(
                 """
-                INSERT INTO message_events (history_id, event_type, content, created_at, reply_to, forwarded_from,
-                                            message_type, media_path, replaced_content, version, pinned)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                SELECT chat_id, sender_id, version, content, media_path FROM messages
+                WHERE message_id = ? AND chat_id = ?
                 """,
-                (
-                    history_id,
-                    "created",
-                    content,
-                    created_at,
-                    reply_to,
-                    forwarded_from,
-                    message_type,
-                    media_path,
-                    content,
-                    1,
-                    pinned,
-                ),
-            )
-            logging.info(f"MSG_SAVED: chat_id={chat_id}, msg_id={message_id}")
-        except aiosqlite.IntegrityError:
+                (message_id, chat_id),
+            ) as cursor:
+                stored = await cursor.fetchone()
+            if stored is not None and (stored[3], stored[4]) == (content, media_path):
+                return [stored[:4]]  # The same message again, e.g. the NewMessage echo of one sent from here
             logging.warning(f"INT_ERR_SAVE_MSG: chat_id={chat_id}, msg_id={message_id}")
-            return await self.update_message(
+            result = await self._write_update(
+                conn,
                 message_id,
                 chat_id,
                 content,
@@ -265,14 +718,47 @@ class TelegramChatManager:
                 media_path,
                 pinned,
             )
-        except Exception as exc:
-            logging.exception(f"UNEXP_ERR_SAVE_MSG: chat_id={chat_id}, msg_id={message_id}, exc={exc}")
-            return None
+            return None if result is _NOT_FOUND else result
 
-        return await self._fetch_with_semaphore(
+        # The in-memory caches follow the database once the batch commits, a rolled back op leaves them as they were
+        self.write_queue.after_commit(self.known.add_message, chat_id, message_id)
+        cursor = await conn.execute(
+            """
+            INSERT INTO message_events (chat_id, message_id, event_type, content, created_at, reply_to, forwarded_from,
+                                        message_type, media_path, replaced_content, version, pinned)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                chat_id,
+                message_id,
+                "created",
+                content,
+                created_at,
+                reply_to,
+                forwarded_from,
+                message_type,
+                media_path,
+                None,
+                1,
+                pinned,
+            ),
+        )
+        await self._index_event(conn, cursor.lastrowid, content)
+        await self._extend_synced_range(conn, chat_id, message_id)
+        logging.info(f"MSG_SAVED: chat_id={chat_id}, msg_id={message_id}")
+        async with conn.execute("SELECT username FROM users WHERE user_id = ?", (sender_id,)) as cursor:
+            user = await cursor.fetchone()
+        if user is not None:  # Pages only show messages of known users
+            row = (message_id, content, user[0], created_at, sender_id)
+            self.write_queue.after_commit(self.windows.add, chat_id, row)
+            self.write_queue.after_commit(self.changes.publish, "new", chat_id, message_id, row)
+        await self._publish_summaries(conn, [chat_id])
+
+        async with conn.execute(
             "SELECT chat_id, sender_id, version, content FROM messages WHERE message_id = ? AND chat_id = ?",
             (message_id, chat_id),
-        )
+        ) as cursor:
+            return await cursor.fetchall()
 
     async def update_message(
         self,
@@ -287,11 +773,28 @@ class TelegramChatManager:
         media_path: str = None,
         pinned: bool = False,
     ):
-        result = await self._fetch_with_semaphore(
-            "SELECT chat_id, sender_id, version, content FROM messages WHERE message_id = ? AND chat_id = ?",
-            (message_id, chat_id),
-        )
-        if not result:
+        if sender_id:
+            await self.save_user(sender_id)
+
+        try:
+            result = await self.write_queue.run(
+                self._write_update,
+                message_id,
+                chat_id,
+                content,
+                created_at,
+                sender_id,
+                reply_to,
+                forwarded_from,
+                message_type,
+                media_path,
+                pinned,
+            )
+        except Exception as exc:
+            logging.exception(f"ERR_UPD_MSG: chat_id={chat_id}, msg_id={message_id}, exc={exc}")
+            return None
+
+        if result is _NOT_FOUND:
             logging.warning(f"MSG_NOT_FOUND_UPD: chat_id={chat_id}, msg_id={message_id}")
             return await self.save_message(
                 chat_id,
@@ -305,117 +808,228 @@ class TelegramChatManager:
                 media_path,
                 pinned,
             )
+        return result
+
+    async def _write_update(
+        self,
+        conn,
+        message_id,
+        chat_id,
+        content,
+        created_at,
+        sender_id,
+        reply_to,
+        forwarded_from,
+        message_type,
+        media_path,
+        pinned,
+    ):
+        async with conn.execute(
+            "SELECT chat_id, sender_id, version, content FROM messages WHERE message_id = ? AND chat_id = ?",
+            (message_id, chat_id),
+        ) as cursor:
+            result = await cursor.fetchall()
+        if not result:
+            return _NOT_FOUND
 
         _, stored_sender_id, current_version, old_content = result[0]
         new_version = current_version + 1
-        history_id = self._generate_history_id(chat_id, message_id)
-        sender_id = sender_id or stored_sender_id
 
-        if sender_id and not await self.check_user_exists(sender_id):
-            await self.save_user(sender_id)
+        await conn.execute(
+            """
+            UPDATE messages
+            SET content = ?, reply_to = ?, forwarded_from = ?, message_type = ?,
+                media_path = ?, version = ?, pinned = ?, edited = 1
+            WHERE message_id = ? AND chat_id = ?
+            """,
+            (
+                content,
+                reply_to,
+                forwarded_from,
+                message_type,
+                media_path,
+                new_version,
+                pinned,
+                message_id,
+                chat_id,
+            ),
+        )
+        # The version being replaced is the previous event in the chain, only the delta to it is stored
+        codec, stored = encode_version(old_content, content)
+        cursor = await conn.execute(
+            """
+            INSERT INTO message_events (chat_id, message_id, event_type, content, codec, created_at, reply_to,
+                                        forwarded_from, message_type, media_path, version, pinned)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                chat_id,
+                message_id,
+                "edited",
+                stored,
+                codec,
+                created_at,
+                reply_to,
+                forwarded_from,
+                message_type,
+                media_path,
+                new_version,
+                pinned,
+            ),
+        )
+        await self._index_event(conn, cursor.lastrowid, content)
+        self.write_queue.after_commit(self.windows.update, chat_id, message_id, content)
+        self.write_queue.after_commit(self.changes.publish, "edit", chat_id, message_id, content)
+        await self._publish_summaries(conn, [chat_id])
+        logging.info(f"MSG_UPDATED: chat_id={chat_id}, msg_id={message_id}")
+        return message_id
+
+    async def delete_message(self, chat_id: int, message_id: int, created_at: int):
+        return await self.delete_messages(chat_id, [message_id], created_at)
 
+    async def delete_messages(self, chat_id, message_ids, created_at: int = None):
+        # chat_id None means the chat is unknown, as Telegram reports deletions in private chats and basic groups.
+        # Those ids are unique per account, so they are matched across all chats except channels, whose ids
+        # overlap. Returns the (chat_id, message_id) pairs that were deleted.
+        created_at = int(time.time()) if created_at is None else created_at
         try:
-            await self._execute_with_semaphore(
+            return await self.write_queue.run(self._write_deletes, chat_id, list(message_ids), created_at)
+        except Exception as exc:
+            logging.exception(f"ERR_DEL_MSGS: chat_id={chat_id}, msgs={len(message_ids)}, exc={exc}")
+            return []
+
+    async def _write_deletes(self, conn, chat_id, message_ids, created_at):
+        ids = json.dumps(message_ids)
+        if chat_id is None:
+            query = f"""
+                SELECT rowid, chat_id, message_id FROM messages
+                WHERE message_id IN (SELECT value FROM json_each(?)) AND chat_id > {CHANNEL_ID_BOUND} AND deleted = 0
+            """
+            params = (ids,)
+        else:
+            query = """
+                SELECT rowid, chat_id, message_id FROM messages
+                WHERE chat_id = ? AND message_id IN (SELECT value FROM json_each(?)) AND deleted = 0
+            """
+            params = (chat_id, ids)
+        async with conn.execute(query, params) as cursor:
+            targets = await cursor.fetchall()
+        if targets:
+            rowids = json.dumps([rowid for rowid, _, _ in targets])
+            # A deleted event keeps the last version: an empty delta against it, as encode_version(text, text) gives
+            await conn.execute(
                 """
-                UPDATE messages
-                SET content = ?, reply_to = ?, forwarded_from = ?, message_type = ?,
-                    media_path = ?, version = ?, pinned = ?, edited = 1
-                WHERE message_id = ? AND chat_id = ?
+                INSERT INTO message_events (chat_id, message_id, event_type, content, codec, created_at, reply_to,
+                                            forwarded_from, message_type, media_path, version, pinned)
+                SELECT chat_id, message_id, 'deleted',
+                       CASE WHEN coalesce(content, '') = '' THEN content ELSE '' END,
+                       CASE WHEN coalesce(content, '') = '' THEN ? ELSE ? END,
+                       ?, reply_to, forwarded_from, message_type, media_path, version, pinned
+                FROM messages WHERE rowid IN (SELECT value FROM json_each(?))
+                ORDER BY chat_id, message_id
                 """,
-                (
-                    content,
-                    reply_to,
-                    forwarded_from,
-                    message_type,
-                    media_path,
-                    new_version,
-                    pinned,
-                    message_id,
-                    chat_id,
-                ),
+                (CODEC_TEXT, CODEC_DELTA, created_at, rowids),
             )
-            await self._execute_with_semaphore(
-                """
-                INSERT INTO message_events (history_id, event_type, content, created_at, reply_to, forwarded_from,
-                                            message_type, media_path, replaced_content, version, pinned)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    history_id,
-                    "edited",
-                    content,
-                    created_at,
-                    reply_to,
-                    forwarded_from,
-                    message_type,
-                    media_path,
-                    old_content,
-                    new_version,
-                    pinned,
-                ),
+            await conn.execute(
+                "UPDATE messages SET deleted = 1 WHERE rowid IN (SELECT value FROM json_each(?))", (rowids,)
             )
-            logging.info(f"MSG_UPDATED: chat_id={chat_id}, msg_id={message_id}")
-            return message_id
-        except Exception as exc:
-            logging.exception(f"ERR_UPD_MSG: chat_id={chat_id}, msg_id={message_id}, exc={exc}")
-            return None
+        deleted = [(target_chat_id, message_id) for _, target_chat_id, message_id in targets]
+        if chat_id is not None and len(targets) < len(message_ids):
+            # Not in the main database, possibly moved to an archive month
+            found = {message_id for _, message_id in deleted}
+            for message_id in message_ids:
+                if message_id not in found and await self._write_archived_delete(conn, chat_id, message_id, created_at):
+                    deleted.append((chat_id, message_id))
+        # Archived messages are cached in windows too, the cache follows every deletion
+        by_chat = {}
+        for target_chat_id, message_id in deleted:
+            by_chat.setdefault(target_chat_id, []).append(message_id)
+        for target_chat_id, ids in by_chat.items():
+            self.write_queue.after_commit(self.windows.remove, target_chat_id, ids)
+        for target_chat_id, message_id in deleted:
+            self.write_queue.after_commit(self.changes.publish, "deleted", target_chat_id, message_id)
+        await self._publish_summaries(conn, {target_chat_id for target_chat_id, _ in deleted})
+        logging.info(f"MSGS_DELETED: chat_id={chat_id}, requested={len(message_ids)}, deleted={len(deleted)}")
+        return deleted
 
-    async def delete_message(self, chat_id: int, message_id: int, created_at: int):
-        result = await self._fetch_with_semaphore(
-            """
-            SELECT content, created_at, reply_to, forwarded_from, message_type, media_path, version, pinned
-            FROM messages WHERE message_id = ? AND chat_id = ?
+    async def _chats_of_messages(self, message_ids) -> dict:
+        # chat_id -> ids for message ids of private chats and basic groups, which are unique per account. Ids not
+        # stored are listed under None.
+        rows = await self._fetch_with_semaphore(
+            f"""
+            SELECT chat_id, message_id FROM messages
+            WHERE message_id IN (SELECT value FROM json_each(?)) AND chat_id > {CHANNEL_ID_BOUND}
+            ORDER BY message_id
             """,
-            (message_id, chat_id),
+            (json.dumps(list(message_ids)),),
         )
-        if result:
+        by_chat = {}
+        for chat_id, message_id in rows:
+            by_chat.setdefault(chat_id, []).append(message_id)
+        found = {message_id for _, message_id in rows}
+        missing = [message_id for message_id in message_ids if message_id not in found]
+        if missing:
+            by_chat[None] = missing
+        return by_chat
+
+    async def _write_archived_delete(self, conn, chat_id, message_id, created_at):
+        # Archive files are not written from the queue. The history of an archived message still lives here,
+        # a deleted event is enough for readers of the archive to hide it.
+        async with conn.execute(
+            """
+            SELECT reply_to, forwarded_from, message_type, media_path, version, pinned FROM message_events
+            WHERE chat_id = ? AND message_id = ? ORDER BY event_id DESC LIMIT 1
+            """,
+            (chat_id, message_id),
+        ) as cursor:
+            last = await cursor.fetchone()
+        if last is None or not self.archive.contains(chat_id, message_id):
+            return False
+        reply_to, forwarded_from, message_type, media_path, version, pinned = last
+        await conn.execute(
+            """
+            INSERT INTO message_events (chat_id, message_id, event_type, content, codec, created_at, reply_to,
+                                        forwarded_from, message_type, media_path, version, pinned)
+            VALUES (?, ?, 'deleted', '', ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
             (
-                content,
-                old_created_at,
+                chat_id,
+                message_id,
+                CODEC_DELTA,
+                created_at,
                 reply_to,
                 forwarded_from,
                 message_type,
                 media_path,
                 version,
                 pinned,
-            ) = result[0]
-            history_id = self._generate_history_id(chat_id, message_id)
-            try:
-                await self._execute_with_semaphore(
-                    "UPDATE messages SET deleted = 1 WHERE message_id = ? AND chat_id = ?",
-                    (message_id, chat_id),
-                )
-                await self._execute_with_semaphore(
-                    """
-                    INSERT INTO message_events (history_id, event_type, content, created_at, reply_to, forwarded_from,
-                                                message_type, media_path, replaced_content, version, pinned)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        history_id,
-                        "deleted",
-                        content,
-                        created_at,
-                        reply_to,
-                        forwarded_from,
-                        message_type,
-                        media_path,
-                        content,
-                        version,
-                        pinned,
-                    ),
-                )
-                logging.info(f"MSG_DELETED: chat_id={chat_id}, msg_id={message_id}")
-            except Exception as exc:
-                logging.exception(f"ERR_DEL_MSG: chat_id={chat_id}, msg_id={message_id}, exc={exc}")
+            ),
+        )
+        logging.info(f"MSG_DELETED_ARCHIVED: chat_id={chat_id}, msg_id={message_id}")
+        return True
 
     async def save_attachment(
-        self, message_id: int, attachment_type: str, created_at: int, file_path: str = None
+        self,
+        message_id: int,
+        attachment_type: str,
+        created_at: int,
+        file_path: str = None,
+        chat_id: int = None,
+        file_key: str = None,
+        sha256: str = None,
+        size: int = None,
     ) -> bool:
         try:
-            await self._execute_with_semaphore(
-                "INSERT INTO attachments (message_id, attachment_type, file_path, created_at) VALUES (?, ?, ?, ?)",
-                (message_id, attachment_type, file_path, created_at),
+            await self.write_queue.run(
+                self._write_attachment,
+                message_id,
+                attachment_type,
+                created_at,
+                file_path,
+                chat_id,
+                file_key,
+                sha256,
+                size,
             )
             logging.info(f"ATT_SAVED: msg_id={message_id}, type={attachment_type}")
             return True
@@ -423,6 +1037,33 @@ class TelegramChatManager:
             logging.exception(f"ERR_SAVE_ATT: msg_id={message_id}, exc={exc}")
             return False
 
+    async def _write_attachment(
+        self, conn, message_id, attachment_type, created_at, file_path, chat_id, file_key, sha256, size
+    ):
+        await conn.execute(
+            """
+            INSERT INTO attachments (message_id, attachment_type, file_path, created_at, chat_id, file_key, sha256,
+                                     size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id, message_id, attachment_type) DO UPDATE SET
+                file_path = excluded.file_path,
+                created_at = excluded.created_at,
+                file_key = excluded.file_key,
+                sha256 = excluded.sha256,
+                size = excluded.size
+            """,
+            (message_id, attachment_type, file_path, created_at, chat_id, file_key, sha256, size),
+        )
+        if sha256 is not None and file_path is not None:
+            # Storing or re-using a blob both count as an access for the LRU quota
+            await conn.execute(
+                """
+                INSERT INTO media_blobs (sha256, file_path, size, last_access) VALUES (?, ?, ?, ?)
+                ON CONFLICT (sha256) DO UPDATE SET last_access = excluded.last_access
+                """,
+                (sha256, file_path, size, created_at),
+            )
+
     async def get_last_messages(self, chat_id: int, limit: int = 100):
         if not await self.check_chat_exists(chat_id):
             raise ValueError("Chat does not exist")
@@ -431,47 +1072,487 @@ class TelegramChatManager:
             (chat_id, limit),
         )
 
+    async def _index_event(self, conn, event_id: int, text: str):
+        if text:
+            await conn.execute("INSERT INTO message_events_fts (rowid, content) VALUES (?, ?)", (event_id, text))
+
+    async def _load_dictionaries(self, conn, dict_ids):
+        missing = [dict_id for dict_id in dict_ids if dict_id not in self._dictionaries]
+        if missing:
+            async with conn.execute(
+                f"SELECT dict_id, data FROM compression_dicts WHERE dict_id IN ({', '.join('?' * len(missing))})",
+                missing,
+            ) as cursor:
+                self._dictionaries.update(await cursor.fetchall())
+
+    async def _read_versions(self, conn, chat_id: int, message_id: int):
+        # Rows come back in the pre-compression message_events layout with every version spelled out
+        return (await self._read_versions_of(conn, [(chat_id, message_id)])).get((chat_id, message_id), [])
+
+    async def _read_versions_of(self, conn, keys):
+        # (chat_id, message_id) -> versions as _read_versions returns them, for every key in one query
+        async with conn.execute(
+            """
+            SELECT event_id, chat_id, message_id, event_type, content, created_at, reply_to, forwarded_from,
+                   message_type, media_path, version, pinned, codec, packed, dict_id
+            FROM message_events
+            WHERE (chat_id, message_id) IN (
+                SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+            )
+            ORDER BY chat_id, message_id, event_id
+            """,
+            (json.dumps(list(keys)),),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        await self._load_dictionaries(conn, {row[14] for row in rows if row[13] is not None})
+        histories = {}
+        previous = None
+        for *fields, codec, packed, dict_id in rows:
+            history = histories.setdefault((fields[1], fields[2]), [])
+            if not history:
+                previous = None
+            stored = fields[4] if packed is None else unpack(packed, self._dictionaries[dict_id])
+            text = decode_version(previous, codec, stored)
+            replaced = previous if fields[3] == "edited" else text
+            history.append((*fields[:4], text, *fields[5:10], replaced, *fields[10:]))
+            previous = text
+        return histories
+
     async def get_message_history(self, chat_id: int, message_id: int):
-        history_id = self._generate_history_id(chat_id, message_id)
-        return await self._fetch_with_semaphore(
-            "SELECT * FROM message_events WHERE history_id = ? ORDER BY created_at ASC", (history_id,)
+        async with self.db.reader() as conn:
+            return await self._read_versions(conn, chat_id, message_id)
+
+    async def compact_history(self, cold_after: float = 30 * 86400, batch_size: int = 2000) -> int:
+        # Packs event rows older than cold_after with the newest trained dictionary, in batches so live
+        # writes get the writer in between
+        start_time = time.time()
+        dict_id = await self.write_queue.run(self._ensure_dictionary)
+        if dict_id is None:
+            logging.info("HIST_COMPACT_SKIP: not enough history to train a dictionary")
+            return 0
+        cutoff = int(time.time() - cold_after)
+        position = packed = 0
+        while True:
+            result = await self.write_queue.run(self._pack_events, dict_id, cutoff, position, batch_size)
+            if result is None:
+                break
+            position, count = result
+            packed += count
+        logging.info(f"HIST_COMPACTED: packed={packed}, dict_id={dict_id}, time={time.time() - start_time:.2f}s")
+        return packed
+
+    async def _ensure_dictionary(self, conn):
+        async with conn.execute("SELECT dict_id, data FROM compression_dicts ORDER BY dict_id DESC LIMIT 1") as cursor:
+            row = await cursor.fetchone()
+        if row is not None:
+            self._dictionaries[row[0]] = row[1]
+            return row[0]
+        samples = await self._read_ids(
+            conn,
+            "SELECT content FROM message_events WHERE codec = ? AND content != '' ORDER BY event_id DESC LIMIT ?",
+            (CODEC_TEXT, DICT_SAMPLE_SIZE),
         )
+        if len(samples) < DICT_MIN_SAMPLES:
+            return None
+        data = train_dictionary(samples)
+        cursor = await conn.execute(
+            "INSERT INTO compression_dicts (created_at, data) VALUES (?, ?)", (int(time.time()), data)
+        )
+        self._dictionaries[cursor.lastrowid] = data
+        logging.info(f"HIST_DICT_TRAINED: dict_id={cursor.lastrowid}, samples={len(samples)}, size={len(data)}")
+        return cursor.lastrowid
+
+    async def _pack_events(self, conn, dict_id, cutoff, position, limit):
+        async with conn.execute(
+            """
+            SELECT event_id, content FROM message_events
+            WHERE event_id > ? AND dict_id IS NULL AND created_at < ?
+            ORDER BY event_id LIMIT ?
+            """,
+            (position, cutoff, limit),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            return None
+        zdict = self._dictionaries[dict_id]
+        updates = []
+        for event_id, content in rows:
+            blob = pack(content, zdict) if content else None
+            if blob is not None and len(blob) < len(content.encode()):
+                updates.append((blob, None, dict_id, event_id))
+            else:
+                # Checked and left as is, dict_id keeps the row from being looked at again
+                updates.append((None, content, dict_id, event_id))
+        await conn.executemany(
+            "UPDATE message_events SET packed = ?, content = ?, dict_id = ? WHERE event_id = ?", updates
+        )
+        return rows[-1][0], sum(1 for update in updates if update[0] is not None)
+
+    @staticmethod
+    def _fts_query(text: str) -> str:
+        # User input becomes a conjunction of quoted terms, so FTS5 operators in it are inert. Only the last
+        # term is a prefix query (it is usually still being typed), exact terms are much cheaper to match.
+        terms = [f'"{term}"' for term in re.findall(r"\w+", text)]
+        if terms:
+            terms[-1] += "*"
+        return " ".join(terms)
+
+    @staticmethod
+    def _snippet(text: str, query: str, size: int = 16) -> str:
+        # Same shape as FTS5 snippet(): up to size tokens around the first match, matches marked, "…" where cut
+        if not text:
+            return text
+        terms = [term.casefold() for term in re.findall(r"\w+", query)]
+        tokens = list(re.finditer(r"\w+", text))
+        if not tokens:
+            return text
+
+        def is_match(word):
+            word = word.casefold()
+            return bool(terms) and (word in terms[:-1] or word.startswith(terms[-1]))
+
+        hits = {index for index, token in enumerate(tokens) if is_match(token.group())}
+        first = min(hits, default=0)
+        start = max(0, min(first - size // 4, len(tokens) - size))
+        end = min(len(tokens), start + size)
+        parts = ["…"] if start > 0 else []
+        position = tokens[start].start() if start > 0 else 0
+        for index in range(start, end):
+            token = tokens[index]
+            parts.append(text[position : token.start()])
+            if index in hits:
+                parts.append(f"{SNIPPET_START}{token.group()}{SNIPPET_END}")
+            else:
+                parts.append(token.group())
+            position = token.end()
+        parts.append(text[position:] if end == len(tokens) else "…")
+        return "".join(parts)
+
+    async def search(
+        self,
+        query: str,
+        chat_id: int = None,
+        sender_id: int = None,
+        include_history: bool = False,
+        include_archive: bool = False,
+        order: str = "rank",
+        limit: int = 50,
+        offset: int = 0,
+    ):
+        # Rows: (chat_id, message_id, sender_id, username, created_at, snippet, deleted, edited, event_type).
+        # With include_history every stored version is searched and the best matching one per message is
+        # returned, event_type says which version that was. order="recent" skips bm25 scoring, which is what
+        # makes queries made only of very common words slow on big archives. include_archive also searches the
+        # monthly archive files after the main database. Edit history stays in the main database, so with both
+        # flags archived messages are found without attaching anything, but without a sender.
+        match = self._fts_query(query)
+        if not match:
+            return []
+        filters = ""
+        params = [match]
+        if chat_id is not None:
+            filters += " AND m.chat_id = ?"
+            params.append(chat_id)
+        if sender_id is not None:
+            filters += " AND m.sender_id = ?"
+            params.append(sender_id)
+
+        if not include_history:
+            # Archived months follow the main database, newest first, each attached only when the page reaches it
+            rows = []
+            async with self.db.reader() as conn:
+                for month in [None, *(self.archive.all_months() if include_archive else ())]:
+                    schema = "main" if month is None else await self.archive.attach(conn, month)
+                    async with conn.execute(
+                        f"""
+                        SELECT m.chat_id, m.message_id, m.sender_id, u.username, m.created_at,
+                               snippet(messages_fts, 0, ?, ?, '…', 16), m.deleted, m.edited, NULL
+                        FROM {schema}.messages_fts
+                        JOIN {schema}.messages m ON m.rowid = messages_fts.rowid
+                        LEFT JOIN main.users u ON u.user_id = m.sender_id
+                        WHERE messages_fts MATCH ?{filters}
+                        ORDER BY {"messages_fts.rank" if order == "rank" else "messages_fts.rowid DESC"}
+                        LIMIT ?
+                        """,
+                        (SNIPPET_START, SNIPPET_END, *params, offset + limit - len(rows)),
+                    ) as cursor:
+                        rows += await cursor.fetchall()
+                    if len(rows) >= offset + limit:
+                        break
+            return rows[offset:]
+
+        # The version of each message that matched, with the flags the result list shows
+        columns = """
+            e.event_id, e.chat_id, e.message_id, m.sender_id, u.username, e.created_at,
+            coalesce(m.deleted, EXISTS (
+                SELECT 1 FROM message_events d
+                WHERE d.chat_id = e.chat_id AND d.message_id = e.message_id AND d.event_type = 'deleted'
+            )) AS deleted,
+            coalesce(m.edited, 0) AS edited, e.event_type
+        """
+        source = f"""
+            FROM message_events_fts
+            JOIN message_events e ON e.event_id = message_events_fts.rowid
+            {"LEFT JOIN" if include_archive else "JOIN"} messages m
+                ON m.chat_id = e.chat_id AND m.message_id = e.message_id
+            LEFT JOIN users u ON u.user_id = m.sender_id
+            WHERE message_events_fts MATCH ?{filters.replace("m.chat_id", "e.chat_id")}
+        """
+        if order == "rank":
+            # snippet() is not allowed next to a window function, so pick the best version per message first
+            hits = await self._fetch_with_semaphore(
+                f"""
+                SELECT event_id, chat_id, message_id, sender_id, username, created_at, deleted, edited, event_type
+                FROM (
+                    SELECT {columns}, message_events_fts.rank AS rank,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY e.chat_id, e.message_id ORDER BY message_events_fts.rank
+                           ) AS n
+                    {source}
+                )
+                WHERE n = 1
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+                """,
+                (*params, limit, offset),
+            )
+        else:
+            # Newest events first, straight from the index: the newest matching version of each message is the first
+            # one seen, and the scan stops once the page is full instead of ranking every match
+            hits = []
+            seen = set()
+            async with self.db.reader() as conn:
+                async with conn.execute(
+                    f"SELECT {columns} {source} ORDER BY message_events_fts.rowid DESC", params
+                ) as cursor:
+                    async for hit in cursor:
+                        if (hit[1], hit[2]) in seen:
+                            continue
+                        seen.add((hit[1], hit[2]))
+                        if len(seen) > offset:
+                            hits.append(hit)
+                        if len(hits) >= limit:
+                            break
+        if not hits:
+            return []
+        # message_events_fts keeps no text (event rows may be deltas), snippets come from the rebuilt versions
+        async with self.db.reader() as conn:
+            histories = await self._read_versions_of(conn, {(hit[1], hit[2]) for hit in hits})
+        event_ids = {hit[0] for hit in hits}
+        snippets = {
+            version[0]: self._snippet(version[4], query)
+            for history in histories.values()
+            for version in history
+            if version[0] in event_ids
+        }
+        return [
+            (chat_id, message_id, sender_id, username, created_at, snippets.get(event_id), deleted, edited, event_type)
+            for event_id, chat_id, message_id, sender_id, username, created_at, deleted, edited, event_type in hits
+        ]
 
     async def get_all_chats(self):
         return await self._fetch_with_semaphore("SELECT * FROM chats")
 
-    async def get_messages_for_batch(self, chat_id, direction="older", min_id=None, max_id=None, limit=50):
-        if direction == "older":
-            if min_id is None:
-                query = """
-                SELECT m.message_id, m.content, u.username, m.created_at, m.sender_id
-                FROM messages m JOIN users u ON m.sender_id = u.user_id
-                WHERE m.chat_id = ? AND m.deleted = 0
-                ORDER BY m.message_id DESC LIMIT ?
+    async def load_dialogs(self):
+        # The sidebar, most recent activity first and pinned chats on top. Chats with a stored message are read in
+        # order from the chat_summary activity index, the others are merged in by Telegram's last message time:
+        # both lists come sorted newest first, as heapq.merge needs.
+        async with self.db.reader() as conn:
+            async with conn.execute(
                 """
-                params = (chat_id, limit)
-                rows = await self._fetch_with_semaphore(query, params)
-                rows = rows[::-1]  # To ASC for grouping
-            else:
-                query = """
-                SELECT m.message_id, m.content, u.username, m.created_at, m.sender_id
-                FROM messages m JOIN users u ON m.sender_id = u.user_id
-                WHERE m.chat_id = ? AND m.message_id < ? AND m.deleted = 0
-                ORDER BY m.message_id ASC LIMIT ?
+                SELECT d.chat_id, d.title, d.username, s.unread_count, d.pinned, s.last_activity_at, s.last_content
+                FROM chat_summary s JOIN dialogs d ON d.chat_id = s.chat_id
+                ORDER BY s.last_activity_at DESC
+                """
+            ) as cursor:
+                active = [DialogInfo(*row) for row in await cursor.fetchall()]
+            async with conn.execute(
+                """
+                SELECT chat_id, title, username, unread_count, pinned, last_message_at FROM dialogs
+                WHERE chat_id NOT IN (SELECT chat_id FROM chat_summary) ORDER BY last_message_at DESC
                 """
-                params = (chat_id, min_id, limit)
-                rows = await self._fetch_with_semaphore(query, params)
+            ) as cursor:
+                quiet = [DialogInfo(*row) for row in await cursor.fetchall()]
+        dialogs = heapq.merge(active, quiet, key=lambda dialog: -(dialog.last_message_at or 0))
+        return sorted(dialogs, key=lambda dialog: not dialog.pinned)
+
+    async def _load_stored_dialogs(self):
+        # The list as Telegram reported it last, to tell what a refresh changed
+        rows = await self._fetch_with_semaphore(
+            "SELECT chat_id, title, username, unread_count, pinned, last_message_at FROM dialogs ORDER BY position"
+        )
+        return [DialogInfo(*row) for row in rows]
+
+    async def load_account(self):
+        rows = await self._fetch_with_semaphore("SELECT user_id, username, first_name, last_name FROM account LIMIT 1")
+        return AccountInfo(*rows[0]) if rows else None
+
+    async def refresh_dialogs(self) -> DialogChanges:
+        # Fetches the dialog list and the account and stores only what changed since the last refresh
+        start_time = time.time()
+        await self.connect()
+        me = await self.client.get_me()
+        account = AccountInfo(me.id, me.username, me.first_name, me.last_name)
+        dialogs = []
+        for dialog in await self.client.get_dialogs():
+            self.entities.put(dialog.id, entity_info(dialog.entity))
+            dialogs.append(
+                DialogInfo(
+                    dialog.id,
+                    dialog.name,
+                    getattr(dialog.entity, "username", None),
+                    dialog.unread_count or 0,
+                    int(bool(dialog.pinned)),
+                    int(dialog.date.timestamp()) if dialog.date else None,
+                )
+            )
+        stored = {
+            dialog.chat_id: (position, dialog) for position, dialog in enumerate(await self._load_stored_dialogs())
+        }
+        changed = [
+            (position, dialog)
+            for position, dialog in enumerate(dialogs)
+            if stored.get(dialog.chat_id) != (position, dialog)
+        ]
+        removed = set(stored) - {dialog.chat_id for dialog in dialogs}
+        # Telegram's unread count replaces ours only when it moved, it does not know what was read here
+        unread = [
+            (dialog.unread_count, dialog.chat_id)
+            for _, dialog in changed
+            if dialog.chat_id not in stored or stored[dialog.chat_id][1].unread_count != dialog.unread_count
+        ]
+        await self.write_queue.run(self._write_dialogs, account, changed, removed, unread)
+        logging.info(
+            f"DIALOGS_REFRESHED: dialogs={len(dialogs)}, changed={len(changed)}, removed={len(removed)}, "
+            f"time={time.time() - start_time:.2f}s"
+        )
+        # The sidebar is always the summary-ordered list, with the changed entries as it shows them
+        changed_ids = {dialog.chat_id for _, dialog in changed}
+        sidebar = await self.load_dialogs()
+        return DialogChanges(account, sidebar, [dialog for dialog in sidebar if dialog.chat_id in changed_ids], removed)
+
+    async def _write_dialogs(self, conn, account, changed, removed, unread=()):
+        now = int(time.time())
+        await conn.execute("DELETE FROM account WHERE user_id != ?", (account.id,))
+        await conn.execute(
+            """
+            INSERT INTO account (user_id, username, first_name, last_name, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name,
+                updated_at = excluded.updated_at
+            """,
+            (*account, now),
+        )
+        await conn.executemany("DELETE FROM dialogs WHERE chat_id = ?", [(chat_id,) for chat_id in removed])
+        await conn.executemany(
+            """
+            INSERT INTO dialogs (chat_id, title, username, position, unread_count, pinned, last_message_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                title = excluded.title, username = excluded.username, position = excluded.position,
+                unread_count = excluded.unread_count, pinned = excluded.pinned,
+                last_message_at = excluded.last_message_at, updated_at = excluded.updated_at
+            """,
+            [
+                (dialog.chat_id, dialog.title, dialog.username, position, *dialog[3:6], now)
+                for position, dialog in changed
+            ],
+        )
+        # Read elsewhere when Telegram reports nothing unread
+        await conn.executemany(
+            """
+            UPDATE chat_summary SET
+                unread_count = ?1, read_id = CASE WHEN ?1 = 0 THEN max(read_id, last_message_id) ELSE read_id END
+            WHERE chat_id = ?2
+            """,
+            unread,
+        )
+
+    async def mark_read(self, chat_id: int):
+        # Everything stored for the chat was seen, its unread count drops to zero
+        try:
+            await self.write_queue.run(self._write_read, chat_id)
+        except Exception as exc:
+            logging.exception(f"ERR_MARK_READ: chat_id={chat_id}, exc={exc}")
+
+    async def _write_read(self, conn, chat_id):
+        cursor = await conn.execute(
+            """
+            UPDATE chat_summary SET read_id = max(read_id, last_message_id), unread_count = 0
+            WHERE chat_id = ? AND (read_id < last_message_id OR unread_count != 0)
+            """,
+            (chat_id,),
+        )
+        if cursor.rowcount:
+            await self._publish_summaries(conn, [chat_id])
+
+    async def _publish_summaries(self, conn, chat_ids):
+        # The sidebar rows of the chats a write touched, pushed once it is committed
+        async with conn.execute(
+            """
+            SELECT chat_id, last_content, last_activity_at, unread_count FROM chat_summary
+            WHERE chat_id IN (SELECT value FROM json_each(?))
+            """,
+            (json.dumps(list(chat_ids)),),
+        ) as cursor:
+            for chat_id, *summary in await cursor.fetchall():
+                self.write_queue.after_commit(self.changes.publish, "summary", chat_id, None, ChatSummary(*summary))
+
+    @staticmethod
+    def _batch_query(schema: str, where: str, order: str) -> str:
+        # Archived rows are never updated, a deleted event in main is what marks them deleted
+        hidden = (
+            ""
+            if schema == "main"
+            else """
+            AND NOT EXISTS (
+                SELECT 1 FROM main.message_events e
+                WHERE e.chat_id = m.chat_id AND e.message_id = m.message_id AND e.event_type = 'deleted'
+            )"""
+        )
+        return f"""
+            SELECT m.message_id, m.content, u.username, m.created_at, m.sender_id
+            FROM {schema}.messages m JOIN main.users u ON m.sender_id = u.user_id
+            WHERE m.chat_id = ? AND m.deleted = 0{where}{hidden}
+            ORDER BY m.message_id {order} LIMIT ?
+        """
+
+    async def get_messages_for_batch(self, chat_id, direction="older", min_id=None, max_id=None, limit=50):
+        # Rows come back oldest first. Pages continue from the main database into the monthly archives (and back)
+        # without the caller noticing: archive months are only attached when the page reaches their id range.
+        if direction == "older":
+            descending = True
+            where, params = ("", (chat_id,)) if min_id is None else (" AND m.message_id < ?", (chat_id, min_id))
+            months = self.archive.months_below(chat_id, min_id)
         elif direction == "newer":
             if max_id is None:
                 return []
-            query = """
-            SELECT m.message_id, m.content, u.username, m.created_at, m.sender_id
-            FROM messages m JOIN users u ON m.sender_id = u.user_id
-            WHERE m.chat_id = ? AND m.message_id > ? AND m.deleted = 0
-            ORDER BY m.message_id ASC LIMIT ?
-            """
-            params = (chat_id, max_id, limit)
-            rows = await self._fetch_with_semaphore(query, params)
+            descending = False
+            where, params = " AND m.message_id > ?", (chat_id, max_id)
+            months = self.archive.months_above(chat_id, max_id)
+        else:
+            return []
+        cached = self.windows.page(chat_id, direction, min_id, max_id, limit)
+        if cached is not None:
+            return cached
+        order = "DESC" if descending else "ASC"
+
+        async with self.db.reader() as conn:
+            async with conn.execute(self._batch_query("main", where, order), (*params, limit)) as cursor:
+                rows = await cursor.fetchall()
+            for month, low, high in months:
+                # A full page only needs archive rows that would sort before its last row
+                if len(rows) >= limit and (high <= rows[-1][0] if descending else low >= rows[-1][0]):
+                    break
+                schema = await self.archive.attach(conn, month)
+                async with conn.execute(self._batch_query(schema, where, order), (*params, limit)) as cursor:
+                    archived = await cursor.fetchall()
+                seen = {row[0] for row in rows}  # A row still in main during an interrupted move wins
+                rows = sorted(
+                    rows + [row for row in archived if row[0] not in seen], key=lambda row: row[0], reverse=descending
+                )[:limit]
+        rows = rows[::-1] if descending else rows
+        self.windows.store(chat_id, direction, min_id, max_id, limit, rows)
         return rows
 
     async def get_message_content(self, chat_id, message_id):
@@ -481,120 +1562,302 @@ class TelegramChatManager:
         )
         return result[0][0] if result else None
 
-    async def save_chats_history(self, limit: int = 100):
+    async def save_chats_history(self, limit: int = 100, **options):
+        # Imported here, backfill needs this module
+        from backfill import BackfillEngine
+
         try:
-            start_time = time.time()
-            async for dialog in self.client.iter_dialogs():
-                chat_id = dialog.id
-                logging.info(f"LOADING_CHAT: id={chat_id}")
-                try:
-                    time.sleep(1/10 - (start_time - time.time()))
-                    async with self.api_semaphore:
-                        chat = await self.client.get_entity(chat_id)
-                    chat_type = "channel" if isinstance(chat, (types.Chat, types.Channel)) else "private"
-                    title = getattr(chat, "title", None) or getattr(chat, "username", None)
-                    await self.save_chat(chat_id, chat_type, title)
-                except RPCError as exc:
-                    logging.error(f"ERR_LOAD_CHAT: id={chat_id}, exc={exc}")
-                    continue
-                start_time = time.time()
-
-                await self.save_chat_history(chat_id, limit)
-
-            logging.info("HIST_LOADED")
+            return await BackfillEngine(self, **options).run(limit)
         except Exception as exc:
             logging.exception(f"UNEXP_ERR_LOAD_HIST: exc={exc}")
 
-    async def save_chat_history(self, chat_id, limit: int = 100):
-        messages_to_save = []
-        async with self.api_semaphore:
-            messages = self.client.iter_messages(chat_id, limit=limit)
-        async for message in messages:
-            sender = message.from_id or message.peer_id
-            if isinstance(sender, PeerUser):
-                sender_id = sender.user_id
-            elif isinstance(sender, PeerChat):
-                sender_id = sender.chat_id
-            elif isinstance(sender, PeerChannel):
-                sender_id = sender.channel_id
-            else:
-                continue
+    async def _sync_state(self, chat_id: int):
+        rows = await self._fetch_with_semaphore(
+            "SELECT oldest_id, newest_id, backfill_complete FROM chat_sync WHERE chat_id = ?", (chat_id,)
+        )
+        return rows[0] if rows else (None, None, 0)
 
-            message_id = message.id
-            content = message.message
-            created_at = int(message.date.timestamp())
-            reply_to = message.reply_to_msg_id
-            forwarded_from = None
-            message_type = "text" if content else "media" if message.media else None
-            pinned = message.pinned
-            media_path = None
+    async def sync_chat(self, chat_id: int, limit: int = 200) -> int:
+        # Fetches only messages above the local high-water mark, older ones come from sync_older on demand.
+        # Returns the number of messages stored.
+        async with self._sync_locks.setdefault(chat_id, asyncio.Lock()):
+            start_time = time.time()
+            oldest_id, newest_id, complete = await self._sync_state(chat_id)
+            messages = [
+                message async for message in self.client.iter_messages(chat_id, limit=limit, min_id=newest_id or 0)
+            ]
+            if not messages:
+                logging.info(f"SYNC_UP_TO_DATE: chat_id={chat_id}, newest_id={newest_id}")
+                return 0
+            low = (newest_id or 0) + 1
+            if newest_id is None or len(messages) >= limit:
+                # First sync, or more new messages than one call fetches: the contiguous run restarts at this page
+                # and the messages in between are fetched again when scrolling reaches them
+                oldest_id = min(message.id for message in messages)
+                complete = 0
+                if len(messages) >= limit:
+                    low = oldest_id
+            newest_id = max(message.id for message in messages)
+            stored = await self._store_synced(chat_id, messages, (low, newest_id), (oldest_id, newest_id, complete))
+            logging.info(f"SYNC_NEWER: chat_id={chat_id}, msgs={stored}, time={time.time() - start_time:.2f}s")
+            return stored
 
-            if message.media:
-                if isinstance(message.media, types.MessageMediaPhoto):
-                    media_path = f"{self.assets_path}photo_{message_id}.jpg"
-                elif isinstance(message.media, types.MessageMediaDocument):
-                    media_path = f"{self.assets_path}document_{message_id}"
+    async def sync_older(self, chat_id: int, limit: int = 100) -> int:
+        # Extends the contiguous run below oldest_id. Returns 0 once the start of the chat is reached.
+        if (await self._sync_state(chat_id))[0] is None:
+            return await self.sync_chat(chat_id, limit)
+        async with self._sync_locks.setdefault(chat_id, asyncio.Lock()):
+            oldest_id, newest_id, complete = await self._sync_state(chat_id)
+            if complete:
+                return 0
+            messages = [
+                message async for message in self.client.iter_messages(chat_id, limit=limit, offset_id=oldest_id)
+            ]
+            high = oldest_id - 1
+            if messages:
+                oldest_id = min(message.id for message in messages)
+            complete = int(len(messages) < limit)
+            synced = (1 if complete else oldest_id, high)
+            stored = await self._store_synced(chat_id, messages, synced, (oldest_id, newest_id, complete))
+            logging.info(f"SYNC_OLDER: chat_id={chat_id}, msgs={stored}, oldest_id={oldest_id}")
+            return stored
 
-            history_id = self._generate_history_id(chat_id, message_id)
-            messages_to_save.append(
-                (
-                    message_id,
-                    chat_id,
-                    sender_id,
-                    content,
-                    created_at,
-                    reply_to,
-                    forwarded_from,
-                    message_type,
-                    media_path,
-                    pinned,
-                    history_id,
-                )
+    async def missing_ranges(self, chat_id: int, low: int, high: int):
+        # Id ranges within [low, high] that were never fetched in full, lowest first
+        rows = await self._fetch_with_semaphore(
+            "SELECT low, high FROM synced_ranges WHERE chat_id = ? AND low <= ? AND high >= ? ORDER BY low",
+            (chat_id, high, low),
+        )
+        gaps = []
+        position = low
+        for range_low, range_high in rows:
+            if range_low > position:
+                gaps.append((position, range_low - 1))
+            position = max(position, range_high + 1)
+        if position <= high:
+            gaps.append((position, high))
+        return gaps
+
+    async def fill_gaps(self, chat_id: int, low: int, high: int, limit: int = 500) -> int:
+        # Fetches the missing ranges between low and high. A gap with more than limit messages is filled from its
+        # top, the rest stays missing for the next call. Returns the number of messages stored.
+        if self.windows.is_gap_free(chat_id, low, high):
+            return 0
+        stored = 0
+        # Under the lock: a sync_chat started with the page fills ranges this call would otherwise fetch again
+        async with self._sync_locks.setdefault(chat_id, asyncio.Lock()):
+            gaps = await self.missing_ranges(chat_id, low, high)
+            if not gaps:
+                self.windows.mark_gap_free(chat_id, low, high)
+                return 0
+            spans = self._gap_spans(gaps)
+            for span_low, span_high in spans:
+                # min_id and max_id are exclusive, messages come newest first
+                messages = [
+                    message
+                    async for message in self.client.iter_messages(
+                        chat_id, limit=limit, min_id=span_low - 1, max_id=span_high + 1
+                    )
+                ]
+                if len(messages) >= limit:
+                    span_low = min(message.id for message in messages)
+                stored += await self._store_synced(chat_id, messages, (span_low, span_high))
+        logging.info(f"GAPS_FILLED: chat_id={chat_id}, gaps={len(gaps)}, requests={len(spans)}, msgs={stored}")
+        return stored
+
+    @staticmethod
+    def _gap_spans(gaps, max_requests: int = MAX_GAP_REQUESTS):
+        # At most max_requests id spans covering the gaps: the two closest ones are merged until few enough remain,
+        # the messages stored between them are fetched again rather than paying one round trip per hole
+        spans = list(gaps)
+        while len(spans) > max_requests:
+            i = min(range(len(spans) - 1), key=lambda i: spans[i + 1][0] - spans[i][1])
+            spans[i : i + 2] = [(spans[i][0], spans[i + 1][1])]
+        return spans
+
+    async def _store_synced(self, chat_id, messages, synced, state=None) -> int:
+        messages_to_save = [row for row in (self._history_row(chat_id, message) for message in messages) if row]
+        fetched = len(messages_to_save)
+        messages_to_save = await self._unknown_rows(chat_id, messages_to_save)
+        await self.write_queue.run(
+            self._write_synced, chat_id, messages_to_save, self._history_users(messages), synced, state
+        )
+        self._queue_history_media(messages_to_save, messages)
+        return fetched
+
+    async def _write_synced(self, conn, chat_id, messages_to_save, users, synced, state):
+        # synced is the (low, high) id range the messages were fetched for, state the new chat_sync run if it moved
+        if messages_to_save:
+            await self._write_history(conn, messages_to_save, users)
+        await self._add_synced_range(conn, chat_id, *synced)
+        if state is None:
+            return
+        await conn.execute(
+            """
+            INSERT INTO chat_sync (chat_id, oldest_id, newest_id, backfill_complete, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                oldest_id = excluded.oldest_id, newest_id = excluded.newest_id,
+                backfill_complete = excluded.backfill_complete, updated_at = excluded.updated_at
+            """,
+            (chat_id, *state, int(time.time())),
+        )
+
+    async def _add_synced_range(self, conn, chat_id: int, low: int, high: int):
+        # Ranges of a chat never overlap or touch, the new one absorbs every range it overlaps or touches
+        if low > high:
+            return
+        async with conn.execute(
+            "SELECT min(low), max(high) FROM synced_ranges WHERE chat_id = ? AND low <= ? AND high >= ?",
+            (chat_id, high + 1, low - 1),
+        ) as cursor:
+            merged_low, merged_high = await cursor.fetchone()
+        if merged_low is not None:
+            low, high = min(low, merged_low), max(high, merged_high)
+            await conn.execute(
+                "DELETE FROM synced_ranges WHERE chat_id = ? AND low BETWEEN ? AND ?", (chat_id, low, high)
             )
+        await conn.execute("INSERT INTO synced_ranges (chat_id, low, high) VALUES (?, ?, ?)", (chat_id, low, high))
+
+    async def _extend_synced_range(self, conn, chat_id: int, message_id: int):
+        # A live message continues the synced range that holds the chat's previous message: the ids in between were
+        # used by other chats, private chats and basic groups share one id sequence per account. Without a synced
+        # previous message it gets no range of its own, the next fetch around it records one.
+        async with conn.execute(
+            "SELECT max(message_id) FROM messages WHERE chat_id = ? AND message_id < ?", (chat_id, message_id)
+        ) as cursor:
+            (previous,) = await cursor.fetchone()
+        if previous is None:
+            return
+        async with conn.execute(
+            "SELECT 1 FROM synced_ranges WHERE chat_id = ? AND low <= ? AND high >= ?", (chat_id, previous, previous)
+        ) as cursor:
+            synced = await cursor.fetchone() is not None
+        if synced:
+            await self._add_synced_range(conn, chat_id, previous, message_id)
+
+    def _history_row(self, chat_id: int, message):
+        # (message_id, chat_id, sender_id, content, created_at, reply_to, forwarded_from, message_type, media_path,
+        # pinned) as _write_history takes it, None for messages without a usable sender
+        sender = message.from_id or message.peer_id
+        if isinstance(sender, PeerUser):
+            sender_id = sender.user_id
+        elif isinstance(sender, PeerChat):
+            sender_id = sender.chat_id
+        elif isinstance(sender, PeerChannel):
+            sender_id = sender.channel_id
+        else:
+            return None
+
+        message_id = message.id
+        content = message.message
+        message_type = "text" if content else "media" if message.media else None
+        media_path = None
+        if message.media:
+            if isinstance(message.media, types.MessageMediaPhoto):
+                media_path = f"{self.assets_path}photo_{message_id}.jpg"
+            elif isinstance(message.media, types.MessageMediaDocument):
+                media_path = f"{self.assets_path}document_{message_id}"
+        return (
+            message_id,
+            chat_id,
+            sender_id,
+            content,
+            int(message.date.timestamp()),
+            message.reply_to_msg_id,
+            None,
+            message_type,
+            media_path,
+            message.pinned,
+        )
+
+    def _history_users(self, messages):
+        # Telethon fills message.sender from the users that come with the history page, no extra requests
+        users = {}
+        for message in messages:
+            sender = getattr(message, "sender", None)
+            if isinstance(sender, types.User) and sender.id not in users:
+                info = entity_info(sender)
+                self.entities.put(sender.id, info)
+                users[sender.id] = (sender.id, info.username, info.first_name, info.last_name)
+        return list(users.values())
+
+    def _queue_history_media(self, messages_to_save, messages=()):
+        # The fetched messages go along, the downloader does not have to ask for them again
+        if self.media is not None:
+            by_id = {message.id: message for message in messages}
+            for m in messages_to_save:
+                if m[8]:
+                    self.media.enqueue(m[1], m[0], priority=PRIORITY_SCAN, message=by_id.get(m[0]))
+
+    async def save_chat_history(self, chat_id, limit: int = 100):
+        messages = [message async for message in self.client.iter_messages(chat_id, limit=limit)]
+        messages_to_save = [row for row in (self._history_row(chat_id, message) for message in messages) if row]
 
         if messages_to_save:
-            async with self.db_semaphore:
-                async with aiosqlite.connect(self.db_path, timeout=10) as conn:
-                    try:
-                        await conn.executemany(
-                            """
-                            INSERT OR IGNORE INTO messages (message_id, chat_id, sender_id, content, created_at,
-                                                            reply_to, forwarded_from,
-                                                            message_type, media_path, version, pinned, history_id,
-                                                            read_status, deleted, edited)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, 0, 0, 0)
-                            """,
-                            messages_to_save,
-                        )
-                        await conn.executemany(
-                            """
-                            INSERT OR IGNORE INTO message_events (history_id, event_type, content, created_at, reply_to,
-                                                                  forwarded_from,
-                                                                  message_type, media_path, replaced_content, version,
-                                                                  pinned)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            [
-                                (m[10], "created", m[3], m[4], m[5], m[6], m[7], m[8], m[3], 1, m[9])
-                                for m in messages_to_save
-                            ],
-                        )
-                        await conn.commit()
-                        logging.info(f"HIST_LOADED: chat_id={chat_id}, msgs={len(messages_to_save)}")
-                    except Exception as exc:
-                        logging.error(f"ERR_LOAD_MSGS: chat_id={chat_id}, exc={exc}")
+            try:
+                messages_to_save = await self._unknown_rows(chat_id, messages_to_save)
+                if len(messages) < limit:
+                    synced = (1, max(message.id for message in messages))
+                else:
+                    synced = (min(message.id for message in messages), max(message.id for message in messages))
+                await self.write_queue.run(
+                    self._write_synced, chat_id, messages_to_save, self._history_users(messages), synced, None
+                )
+                logging.info(f"HIST_LOADED: chat_id={chat_id}, msgs={len(messages_to_save)}")
+                self._queue_history_media(messages_to_save, messages)
+            except Exception as exc:
+                logging.error(f"ERR_LOAD_MSGS: chat_id={chat_id}, exc={exc}")
+
+    async def _write_history(self, conn, messages_to_save, users=()):
+        if users:
+            await conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)", users
+            )
+            for user in users:
+                self.write_queue.after_commit(self.known.add_user, user[0])
+        await conn.executemany(
+            """
+            INSERT OR IGNORE INTO messages (message_id, chat_id, sender_id, content, created_at,
+                                            reply_to, forwarded_from,
+                                            message_type, media_path, version, pinned,
+                                            read_status, deleted, edited)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, 0, 0, 0)
+            """,
+            # Newest first: the first message stored of a chat marks it read, the older ones must not count as unread
+            sorted(messages_to_save, key=lambda m: m[0], reverse=True),
+        )
+        async with conn.execute("SELECT max(event_id) FROM message_events") as cursor:
+            (last_event_id,) = await cursor.fetchone()
+        # Re-fetched messages that were already stored must not get a second "created" event
+        await conn.executemany(
+            """
+            INSERT INTO message_events (chat_id, message_id, event_type, content, created_at, reply_to,
+                                        forwarded_from, message_type, media_path, version, pinned)
+            SELECT ?, ?, 'created', ?, ?, ?, ?, ?, ?, 1, ?
+            WHERE NOT EXISTS (SELECT 1 FROM message_events WHERE chat_id = ? AND message_id = ?)
+            """,
+            [(m[1], m[0], m[3], m[4], m[5], m[6], m[7], m[8], m[9], m[1], m[0]) for m in messages_to_save],
+        )
+        await conn.execute(
+            """
+            INSERT INTO message_events_fts (rowid, content)
+            SELECT event_id, content FROM message_events WHERE event_id > ? AND content IS NOT NULL
+            """,
+            (last_event_id or 0,),
+        )
+        self.write_queue.after_commit(self.known.add_messages, [(m[1], m[0]) for m in messages_to_save])
+        spans = {}
+        for m in messages_to_save:
+            low, high = spans.get(m[1], (m[0], m[0]))
+            spans[m[1]] = (min(low, m[0]), max(high, m[0]))
+        for chat_id, (low, high) in spans.items():
+            # After the commit: a page read before it must not be cached past it
+            self.write_queue.after_commit(self.windows.invalidate, chat_id, low, high)
+        await self._publish_summaries(conn, spans)
 
     def _register_handlers(self):
         @self.client.on(events.NewMessage())
         async def handler_new_message(event):
-            event_key = (event.chat_id, event.message.id)
-            if event_key in self.processed_events:
-                logging.info(f"EVT_DUP_IGN_NEW: key={event_key}")
-                return
-            self.processed_events.add(event_key)
-            if len(self.processed_events) > self.max_cache_size:
-                self.processed_events = set(list(self.processed_events)[-self.max_cache_size // 2 :])
-                logging.info("CACHE_TRIMMED")
             message = event.message
             chat_id = event.chat_id
             sender = message.from_id
@@ -621,7 +1884,10 @@ class TelegramChatManager:
                 elif isinstance(message.media, types.MessageMediaDocument):
                     media_path = f"{self.assets_path}document_{message_id}"
 
-            await self.save_message(
+            await self.ingest.submit(
+                chat_id,
+                ("new", chat_id, message_id),
+                self.save_message,
                 chat_id,
                 sender_id,
                 message_id,
@@ -633,18 +1899,9 @@ class TelegramChatManager:
                 media_path,
                 pinned,
             )
-            self.processed_events.discard(event_key)
 
         @self.client.on(events.MessageEdited())
         async def handler_edit_message(event):
-            event_key = (event.chat_id, event.message.id)
-            if event_key in self.processed_events:
-                logging.info(f"EVT_DUP_IGN_EDIT: key={event_key}")
-                return
-            self.processed_events.add(event_key)
-            if len(self.processed_events) > self.max_cache_size:
-                self.processed_events = set(list(self.processed_events)[-self.max_cache_size // 2 :])
-                logging.info("CACHE_TRIMMED")
             message = event.message
             chat_id = event.chat_id
             sender = message.from_id
@@ -671,7 +1928,10 @@ class TelegramChatManager:
                 elif isinstance(message.media, types.MessageMediaDocument):
                     media_path = f"{self.assets_path}document_{message_id}_edited"
 
-            await self.update_message(
+            await self.ingest.submit(
+                chat_id,
+                ("edit", chat_id, message_id, created_at),  # A later edit of the same message is a new key
+                self.update_message,
                 message_id,
                 chat_id,
                 content,
@@ -683,16 +1943,32 @@ class TelegramChatManager:
                 media_path,
                 pinned,
             )
-            self.processed_events.discard(event_key)
 
         @self.client.on(events.MessageDeleted())
         async def handler_delete_message(event):
             created_at = int(datetime.datetime.now().timestamp())
-            for message_id in event.deleted_ids:
-                chat_id = event.chat_id
-                await self.delete_message(chat_id, message_id, created_at)
-                logging.info(f"EVT_DEL: msg_id={message_id}")
+            chat_id = event.chat_id  # None for private chats and basic groups
+            message_ids = sorted(event.deleted_ids)
+            if chat_id is None:
+                # Queued after the chat's messages so it can't overtake their inserts: the events already queued for
+                # private chats and basic groups are applied first, then each id goes to the chat that stores it. Ids
+                # stored nowhere stay without a chat. Channels have ids of their own and are not waited for.
+                await self.ingest.wait_applied(lambda queued_chat_id: queued_chat_id > CHANNEL_ID_BOUND)
+                by_chat = await self._chats_of_messages(message_ids)
+            else:
+                by_chat = {chat_id: message_ids}
+            for target_chat_id, ids in by_chat.items():
+                key = ("deleted", target_chat_id, tuple(ids))
+                await self.ingest.submit(target_chat_id, key, self.delete_messages, target_chat_id, ids, created_at)
+            logging.info(f"EVT_DEL: chat_id={chat_id}, msgs={len(message_ids)}, chats={len(by_chat)}")
 
     async def close(self):
-        self.processed_events.clear()
+        await self.prefetcher.close()
+        await self.ingest.close()
+        logging.info(f"WINDOW_CACHE_STATS: {self.windows.stats()}")
+        if self.media is not None:
+            await self.media.close()
+        logging.info(f"ENTITY_CACHE_STATS: {self.entities.stats()}")
+        await self.write_queue.close()  # Flushes pending writes before the connections go away
+        await self.db.close()
         logging.info("MGR_CLOSED")
\ No newline at end of file
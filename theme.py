@@ -0,0 +1,168 @@
+# theme.py
+from collections import namedtuple
+from string import Template
+
+from PyQt6.QtCore import QObject, pyqtSignal
+from PyQt6.QtGui import QColor
+
+Palette = namedtuple(
+    "Palette",
+    [
+        "background",  # Window and chat area
+        "sidebar",
+        "border",
+        "text",
+        "accent",  # Selection, send button, search highlights
+        "accent_hover",
+        "status",  # Chat status in the header
+        "own_bubble",
+        "other_bubble",
+        "bubble_text",
+        "own_name",
+        "other_name",
+        "timestamp",
+    ],
+)
+
+PALETTES = {
+    "dark": Palette(
+        background="#18222D",
+        sidebar="#1F2A3C",
+        border="#2A2F3B",
+        text="#FFFFFF",
+        accent="#3390FF",
+        accent_hover="#2678CC",
+        status="#FFB84D",
+        own_bubble="#3390FF",
+        other_bubble="#2A2F3B",
+        bubble_text="#FFFFFF",
+        own_name="#008000",
+        other_name="#2C7BE5",
+        timestamp="#808080",
+    ),
+    "light": Palette(
+        background="#FFFFFF",
+        sidebar="#F1F3F6",
+        border="#DADDE1",
+        text="#1C1E21",
+        accent="#3390FF",
+        accent_hover="#2678CC",
+        status="#C77700",
+        own_bubble="#E1F1FF",
+        other_bubble="#F1F3F6",
+        bubble_text="#1C1E21",
+        own_name="#2E7D32",
+        other_name="#2C7BE5",
+        timestamp="#8A8F98",
+    ),
+    "amoled": Palette(
+        background="#000000",
+        sidebar="#0A0A0A",
+        border="#1E1E1E",
+        text="#E8E8E8",
+        accent="#7C4DFF",
+        accent_hover="#651FFF",
+        status="#FFB84D",
+        own_bubble="#4527A0",
+        other_bubble="#1E1E1E",
+        bubble_text="#FFFFFF",
+        own_name="#B388FF",
+        other_name="#82B1FF",
+        timestamp="#9E9E9E",
+    ),
+}
+
+DEFAULT_THEME = "dark"
+
+# One sheet for the whole window. Widgets are styled through their object name, nothing sets its own sheet.
+STYLESHEET = Template("""
+    QWidget {
+        background-color: $background;
+        font-family: 'Arial';
+        color: $text;
+    }
+    QMainWindow {
+        background-color: $background;
+    }
+    QWidget#sidebar {
+        background-color: $sidebar;
+        border-right: 1px solid $border;
+    }
+    QLabel#app_title {
+        font-size: 16px;
+        font-weight: bold;
+    }
+    QLabel#chat_filter_label, QLineEdit#chat_filter, QLabel#chat_name {
+        font-size: 14px;
+        font-weight: bold;
+    }
+    QLineEdit#message_search {
+        font-size: 14px;
+    }
+    QLabel#chat_status {
+        font-size: 12px;
+        color: $status;
+    }
+    QLabel#search_result {
+        background: transparent;
+        padding: 4px;
+    }
+    QListWidget, QListView#chat_list {
+        background-color: $sidebar;
+        border: none;
+    }
+    QLabel#chat_empty {
+        padding: 12px;
+    }
+    QListWidget::item, QListView#chat_list::item {
+        padding: 12px;
+        border-bottom: 1px solid $border;
+        color: $text;
+    }
+    QListWidget::item:selected, QListView#chat_list::item:selected {
+        background-color: $accent;
+        color: #FFFFFF;
+    }
+    QListView#message_view {
+        background-color: $background;
+        border: none;
+    }
+    QPushButton#send_button {
+        background-color: $accent;
+        border: none;
+        border-radius: 20px;
+    }
+    QPushButton#send_button:hover {
+        background-color: $accent_hover;
+    }
+""")
+
+
+class Theme(QObject):
+    # The active palette, its stylesheet and the colours the message delegate paints with. Both are built once per
+    # palette; switching only re-applies the sheet and repaints, no widget is created.
+    changed = pyqtSignal()
+
+    def __init__(self, name: str = DEFAULT_THEME, parent=None):
+        super().__init__(parent)
+        self._compiled = {}  # name -> (stylesheet, colours)
+        self.name = None
+        self.set_palette(name if name in PALETTES else DEFAULT_THEME)
+
+    def _compile(self, name: str):
+        compiled = self._compiled.get(name)
+        if compiled is None:
+            palette = PALETTES[name]
+            colors = {field: QColor(value) for field, value in palette._asdict().items()}
+            compiled = self._compiled[name] = (STYLESHEET.substitute(palette._asdict()), colors)
+        return compiled
+
+    def set_palette(self, name: str):
+        if name not in PALETTES:
+            raise KeyError(f"Unknown theme: {name}")
+        if name == self.name:
+            return
+        self.name = name
+        self.palette = PALETTES[name]
+        self.stylesheet, self.colors = self._compile(name)
+        self.changed.emit()
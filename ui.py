@@ -1,182 +1,65 @@
 # ui.py
 import asyncio
 import datetime
+import html
+import logging
 import time
+from string import Template
 
 from PyQt6.QtCore import Qt, QTimer
-from PyQt6.QtGui import QFontMetrics, QIcon, QAction
+from PyQt6.QtGui import QIcon, QAction
 from PyQt6.QtWidgets import (
     QMainWindow,
     QWidget,
     QVBoxLayout,
     QHBoxLayout,
+    QListView,
     QListWidget,
     QListWidgetItem,
     QPlainTextEdit,
     QPushButton,
     QLabel,
     QSizePolicy,
-    QScrollArea,
     QMenu,
-    QApplication, QLineEdit,
+    QApplication, QLineEdit, QComboBox,
 )
 
 from telethon import TelegramClient
-from tg_api import TelegramChatManager
-
-
-class MessageGroupWidget(QWidget):
-    def __init__(self, username: str, messages: list, is_own: bool = False, parent=None):
-        super().__init__(parent=parent)
-
-        # messages: [(content, timestamp, message_id, is_me), ...]
-        self.message_ids = [msg[2] for msg in messages]
-        self.parent_window = parent  # For access to show_context_menu
-        self.last_width = 0  # For resize optimization
-
-        self.main_layout = QHBoxLayout(self)
-        self.main_layout.setContentsMargins(10, 5, 10, 5)
-        self.main_layout.setSpacing(0)
-        self.messages_widgets = []
-
-        bubble_container = QWidget()
-        bubble_layout = QVBoxLayout(bubble_container)
-        bubble_layout.setContentsMargins(0, 0, 0, 0)
-        bubble_layout.setSpacing(2)
-
-        large_radius = 12
-        small_radius = 4
-
-        for i, (content, timestamp, msg_id) in enumerate(messages):
-            sub_bubble = QWidget()
-            sub_bubble_layout = QVBoxLayout(sub_bubble)
-            sub_bubble_layout.setContentsMargins(10, 4, 10, 4)
-            sub_bubble_layout.setSpacing(2)
-
-            top_radius = large_radius if i == 0 else small_radius
-            bottom_radius = large_radius if i == len(messages) - 1 else small_radius
-
-            if is_own:
-                sub_bubble.setStyleSheet(
-                    f"""
-                    background-color: #3390FF;
-                    border-top-left-radius: {top_radius}px;
-                    border-top-right-radius: {small_radius}px;
-                    border-bottom-left-radius: {bottom_radius}px;
-                    border-bottom-right-radius: {small_radius}px;
-                    color: white;
-                """
-                )
-            else:
-                sub_bubble.setStyleSheet(
-                    f"""
-                    background-color: #2A2F3B;
-                    border-top-left-radius: {small_radius}px;
-                    border-top-right-radius: {top_radius}px;
-                    border-bottom-left-radius: {small_radius}px;
-                    border-bottom-right-radius: {bottom_radius}px;
-                    color: white;
-                """
-                )
-
-            if i == 0:
-                username_label = QLabel(username)
-                username_label.setStyleSheet(
-                    "font-weight: bold; color: green;" if is_own else "font-weight: bold; color: #2c7be5;"
-                )
-                sub_bubble_layout.addWidget(username_label)
-
-            message_label = QLabel(content)
-            message_label.setWordWrap(True)
-            message_label.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-            self.messages_widgets.append(message_label)
-            fm = QFontMetrics(message_label.font())
-            text_height = fm.boundingRect(0, 0, 400, 0, Qt.TextFlag.TextWordWrap, content).height()
-            line_height = fm.lineSpacing()
-            message_label.setMinimumHeight(text_height + line_height)
-
-            timestamp_label = QLabel(timestamp)
-            timestamp_label.setStyleSheet("color: gray; font-size: 10px;")
-            timestamp_label.setAlignment(Qt.AlignmentFlag.AlignRight)
-
-            sub_bubble_layout.addWidget(message_label)
-            sub_bubble_layout.addWidget(timestamp_label)
-
-            # Custom context menu for sub_bubble
-            sub_bubble.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-            sub_bubble.customContextMenuRequested.connect(lambda pos, mid=msg_id: self.show_context_menu(pos, mid))
-
-            bubble_layout.addWidget(sub_bubble)
-
-        if is_own:
-            self.main_layout.addStretch()
-            self.main_layout.addWidget(bubble_container)
-        else:
-            self.main_layout.addWidget(bubble_container)
-            self.main_layout.addStretch()
-
-        self.setLayout(self.main_layout)
-
-    def resizeEvent(self, event):
-        new_width = self.width()
-        if abs(new_width - self.last_width) > 10:  # Optimize: only if significant change
-            max_width_percent = 0.7
-            new_max_width = int(new_width * max_width_percent)
-            for label in self.messages_widgets:
-                label.setMaximumWidth(new_max_width)
-            self.last_width = new_width
-        super().resizeEvent(event)
-
-    def add_message(self, content: str, timestamp: str, msg_id: int):
-        sub_bubble = QWidget()
-        sub_bubble_layout = QVBoxLayout(sub_bubble)
-        sub_bubble_layout.setContentsMargins(10, 4, 10, 4)
-        sub_bubble_layout.setSpacing(2)
-
-        message_label = QLabel(content)
-        message_label.setWordWrap(True)
-        message_label.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-        fm = QFontMetrics(message_label.font())
-        text_height = fm.boundingRect(0, 0, 400, 0, Qt.TextFlag.TextWordWrap, content).height()
-        line_height = fm.lineSpacing()
-        message_label.setMinimumHeight(text_height + line_height)
-
-        timestamp_label = QLabel(timestamp)
-        timestamp_label.setStyleSheet("color: gray; font-size: 10px;")
-        timestamp_label.setAlignment(Qt.AlignmentFlag.AlignRight)
-
-        sub_bubble_layout.addWidget(message_label)
-        sub_bubble_layout.addWidget(timestamp_label)
-
-        # Custom menu
-        sub_bubble.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-        sub_bubble.customContextMenuRequested.connect(lambda pos, mid=msg_id: self.show_context_menu(pos, mid))
-
-        bubble_container = self.main_layout.itemAt(1 if self.main_layout.itemAt(0).spacerItem() else 0).widget()
-        bubble_layout = bubble_container.layout()
-        bubble_layout.addWidget(sub_bubble)
-
-        self.message_ids.append(msg_id)
-        self.adjustSize()
-
-    def show_context_menu(self, pos, message_id):
-        if self.parent_window:
-            self.parent_window.show_message_context_menu(self.mapToGlobal(pos), message_id)
+from bridge import AsyncBridge, FrameBatcher
+from chat_list import CHAT_ID_ROLE, TITLE_ROLE, ChatFilterModel, ChatListModel
+from config import THEME
+from message_view import MessageView
+from theme import PALETTES, Theme
+from tg_api import SNIPPET_END, SNIPPET_START, TelegramChatManager
+
+CHAT_FILTER_DELAY = 150  # ms after the last keystroke before the chat list is filtered
+CHAT_RESULTS = 100  # Best matches shown for a chat query, the proxy sorts only those
+REFRESH_RETRY = 30_000  # ms before a failed dialog refresh (offline) is tried again
+
+
+def template_escape(text) -> str:
+    # Escaped for rich text and for string.Template, whose $ placeholders carry the theme colours
+    return html.escape(text or "").replace("$", "$$")
 
 
 class TelegramWindow(QMainWindow):
-    def __init__(self, client: TelegramClient, manager: TelegramChatManager, loop):
+    def __init__(self, client: TelegramClient, manager: TelegramChatManager, loop, dialogs=None, account=None):
         super().__init__()
         self.client = client
         self.manager: TelegramChatManager = manager
         self.loop = loop
+        self.bridge = AsyncBridge(loop, parent=self)  # Every loop call goes through it, the GUI thread never waits
+        self.theme = Theme(THEME, parent=self)
         self.me = None
-        self.refresh_timer = QTimer()
-        self.refresh_timer.timeout.connect(self.check_new_messages)
-        self.refresh_timer.start(5000)  # Reduced for better responsiveness
+        # New, edited and deleted messages are pushed by the manager once written, at most one update per frame
+        self.changes = FrameBatcher(self.apply_message_changes, parent=self)
+        self.unsubscribe_changes = manager.changes.subscribe(self.changes.push)
+        self.at_latest = False  # The newest stored message of the open chat is shown, pushed ones can be appended
+        self.missed_new = False  # A new message was pushed while not at_latest, the next newer page must include it
 
         # Removed upd_chats_timer - unnecessary frequent API calls
-        self.dialogs = asyncio.run_coroutine_threadsafe(self.client.get_dialogs(), self.loop).result()
+        # Dialogs and the account come from the local cache, refresh_dialogs reconciles them in the background
+        self.dialogs = dialogs or []
 
         self.setWindowTitle("TeleForge")
         self.setGeometry(300, 300, 800, 600)
@@ -184,8 +67,7 @@ class TelegramWindow(QMainWindow):
         self.last_username = None
 
         # Load me
-        future = asyncio.run_coroutine_threadsafe(self.client.get_me(), self.loop)
-        self.me = future.result()
+        self.me = account
 
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -206,34 +88,78 @@ class TelegramWindow(QMainWindow):
 
         # Заголовок
         header_label = QLabel("TeleForge")
-        header_label.setStyleSheet("font-size: 16px; font-weight: bold; color: #FFFFFF;")
-        header_layout.addWidget(header_label)
+        header_label.setObjectName("app_title")
+        self.theme_selector = QComboBox()
+        self.theme_selector.addItems(PALETTES)
+        self.theme_selector.setCurrentText(self.theme.name)
+        self.theme_selector.currentTextChanged.connect(self.theme.set_palette)
+        title_layout = QHBoxLayout()
+        title_layout.addWidget(header_label)
+        title_layout.addStretch()
+        title_layout.addWidget(self.theme_selector)
+        header_layout.addLayout(title_layout)
 
         # Поиск
         label_find = QLabel("Поиск чата по имени:")
         line_edit_find_chat = QLineEdit()
+        self.chat_filter = line_edit_find_chat
 
-        label_find.setStyleSheet("font-size: 14px; font-weight: bold; color: #FFFFFF;")
-        line_edit_find_chat.setStyleSheet("font-size: 14px; font-weight: bold; color: #FFFFFF;")
+        label_find.setObjectName("chat_filter_label")
+        line_edit_find_chat.setObjectName("chat_filter")
 
         search_layout = QHBoxLayout()
         search_layout.addWidget(label_find)
         search_layout.addWidget(line_edit_find_chat)
         header_layout.addLayout(search_layout)
 
-        # при изменении текста вызываем функцию
-        line_edit_find_chat.textChanged.connect(self.load_chats_with_text)
+        # при изменении текста фильтруем список, когда пользователь перестал печатать
+        self.chat_filter_timer = QTimer(self)
+        self.chat_filter_timer.setSingleShot(True)
+        self.chat_filter_timer.setInterval(CHAT_FILTER_DELAY)
+        self.chat_filter_timer.timeout.connect(lambda: self.load_chats_with_text(self.chat_filter.text()))
+        line_edit_find_chat.textChanged.connect(self.on_chat_filter_changed)
+
+        # Поиск по сообщениям (по Enter)
+        self.message_search = QLineEdit()
+        self.message_search.setPlaceholderText("Поиск по сообщениям...")
+        self.message_search.setObjectName("message_search")
+        self.message_search.returnPressed.connect(self.start_message_search)
+        self.message_search.textChanged.connect(self.on_message_search_changed)
+        header_layout.addWidget(self.message_search)
 
         sidebar_layout.addWidget(header)
 
         # --- СПИСОК ЧАТОВ ---
-        self.chat_list = QListWidget()
+        self.chats = ChatListModel(self)
+        self.chat_filter_model = ChatFilterModel(self.chats, self)
+        self.chat_list = QListView()
+        self.chat_list.setObjectName("chat_list")
+        self.chat_list.setModel(self.chat_filter_model)
+        self.chat_list.setUniformItemSizes(True)  # Rows are not measured one by one, thousands of chats stay cheap
+        self.chat_list.setEditTriggers(QListView.EditTrigger.NoEditTriggers)
         self.chat_list.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         self.chat_list.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        self.chat_list.itemClicked.connect(self.load_chat_messages)
+        self.chat_list.clicked.connect(self.load_chat_messages)
+        self.chat_empty = QLabel("Кажется ничего нет 😕")
+        self.chat_empty.setObjectName("chat_empty")
+        self.chat_empty.hide()
         self.load_chats()
 
         sidebar_layout.addWidget(self.chat_list)
+        sidebar_layout.addWidget(self.chat_empty)
+
+        # --- РЕЗУЛЬТАТЫ ПОИСКА ---
+        self.search_results = QListWidget()
+        self.search_results.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.search_results.itemClicked.connect(self.open_search_result)
+        self.search_results.verticalScrollBar().valueChanged.connect(self.on_search_scroll)
+        self.search_results.hide()
+        self.search_query = ""
+        self.search_offset = 0
+        self.search_exhausted = True
+        self.search_page_size = 50
+
+        sidebar_layout.addWidget(self.search_results)
 
         # --- CHAT AREA ---
         chat_area = QWidget()
@@ -245,26 +171,20 @@ class TelegramWindow(QMainWindow):
         chat_header_layout = QHBoxLayout(self.chat_header)
         self.chat_name = QLabel("Select a Chat")
 
-        self.chat_name.setStyleSheet("font-size: 14px; font-weight: bold; color: #FFFFFF;")
+        self.chat_name.setObjectName("chat_name")
         self.chat_status = QLabel("")
-        self.chat_status.setStyleSheet("font-size: 12px; color: #FFB84D;")
+        self.chat_status.setObjectName("chat_status")
         chat_header_layout.addWidget(self.chat_name)
         chat_header_layout.addWidget(self.chat_status)
         chat_header_layout.addStretch()
         chat_layout.addWidget(self.chat_header)
 
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        self.scroll_area.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
-
-        self.messages_container = QWidget()
-        self.messages_layout = QVBoxLayout(self.messages_container)
-        self.messages_layout.setContentsMargins(0, 0, 0, 0)
-        self.messages_layout.setSpacing(8)
-        self.scroll_area.setWidget(self.messages_container)
-
-        chat_layout.addWidget(self.scroll_area)
+        # One row per message, only the visible ones are laid out and painted
+        self.message_view = MessageView(theme=self.theme)
+        self.message_view.setObjectName("message_view")
+        self.messages = self.message_view.model()
+        self.message_view.customContextMenuRequested.connect(self.on_message_context_menu)
+        chat_layout.addWidget(self.message_view)
 
         input_area = QWidget()
         input_layout = QHBoxLayout(input_area)
@@ -286,211 +206,351 @@ class TelegramWindow(QMainWindow):
         main_layout.addWidget(sidebar)
         main_layout.addWidget(chat_area)
 
-        # Стили
-        self.setStyleSheet("""
-            QWidget {
-                background-color: #18222D;
-                font-family: 'Arial';
-                color: #FFFFFF;
-            }
-            QMainWindow {
-                background-color: #18222D;
-            }
-            QWidget#sidebar {
-                background-color: #1F2A3C;
-                border-right: 1px solid #2A2F3B;
-            }
-            QListWidget {
-                background-color: #1F2A3C;
-                border: none;
-            }
-            QListWidget::item {
-                padding: 12px;
-                border-bottom: 1px solid #2A2F3B;
-                color: #FFFFFF;
-            }
-            QListWidget::item:selected {
-                background-color: #3390FF;
-                color: #FFFFFF;
-            }
-            QPushButton#send_button {
-                background-color: #3390FF;
-                border: none;
-                border-radius: 20px;
-            }
-            QPushButton#send_button:hover {
-                background-color: #2678CC;
-            }
-        """)
+        # Стили, one sheet per theme for the whole window
+        self.setStyleSheet(self.theme.stylesheet)
+        self.theme.changed.connect(self.apply_theme)
 
         sidebar.setObjectName("sidebar")
         self.send_button.setObjectName("send_button")
 
         # Connect scroll signal
-        self.scroll_area.verticalScrollBar().valueChanged.connect(self.on_scroll)
+        self.message_view.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+        if dialogs is None:  # Not handed over by startup, the list fills in once the cache is read
+            self.bridge.submit(self.manager.load_dialogs, on_result=self.on_dialogs_loaded)
+        if account is None:
+            self.bridge.submit(self.load_me, on_result=self.on_me_loaded)
+        self.refresh_dialogs()
+
+    def on_chat_filter_changed(self, text):
+        if text.strip():
+            self.chat_filter_timer.start()  # Restarted by every keystroke
+        else:
+            self.chat_filter_timer.stop()
+            self.load_chats_with_text(text)
 
     def load_chats_with_text(self, text):
-        # Удаляем "no results" item, если он есть в конце
-        if self.chat_list.count() > 0 and self.chat_list.item(self.chat_list.count() - 1).text() == "Кажется ничего нет 😕":
-            self.chat_list.takeItem(self.chat_list.count() - 1)
-
-        text_lower = text.lower()
-        has_visible = False
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            title_lower = item.text().lower()
-            username = item.data(Qt.ItemDataRole.UserRole + 1)
-            username_lower = username.lower() if isinstance(username, str) else ""
-            if text_lower in title_lower or text_lower in username_lower:
-                item.setHidden(False)
-                has_visible = True
-            else:
-                item.setHidden(True)
+        # Ranked by the search index, the proxy only shows and orders what it matched
+        ranks = self.chats.search_index.search(text, limit=CHAT_RESULTS) if text.strip() else None
+        self.chat_filter_model.set_ranks(ranks)
+        self.update_chat_empty()
+
+    def update_chat_empty(self):
+        # Если ничего не видно, показываем "no results"
+        self.chat_empty.setVisible(not self.chat_list.isHidden() and self.chat_filter_model.rowCount() == 0)
+
+    def on_message_search_changed(self, text):
+        if not text.strip():
+            self.search_results.hide()
+            self.chat_list.show()
+            self.update_chat_empty()
+
+    def start_message_search(self):
+        self.bridge.cancel_group("search")  # Pages of the previous query are no longer wanted
+        self.search_query = self.message_search.text().strip()
+        self.search_results.clear()
+        self.search_offset = 0
+        self.search_exhausted = False
+        if not self.search_query:
+            self.on_message_search_changed("")
+            return
+        self.chat_list.hide()
+        self.chat_empty.hide()
+        self.search_results.show()
+        self.load_search_page()
 
-        # Если ничего не видно, добавляем "no results" item
-        if not has_visible:
-            item = QListWidgetItem("Кажется ничего нет 😕")
-            self.chat_list.addItem(item)
+    def load_search_page(self):
+        if self.search_exhausted:
+            return
+        query, offset = self.search_query, self.search_offset
+        self.bridge.submit(
+            self.manager.search,
+            query,
+            include_history=True,
+            include_archive=True,
+            order="recent",  # Newest first like other messengers, bm25 makes common words take seconds
+            limit=self.search_page_size,
+            offset=offset,
+            on_result=lambda rows: self.show_search_page(query, offset, rows),
+            group="search",
+        )
 
-    def load_chats(self):
-        self.chat_list.clear()
-        for dialog in self.dialogs:
-            title = dialog.name
-            username = getattr(dialog.entity, 'username', None)
-            chat_id = dialog.id
-            item = QListWidgetItem(title)
+    def show_search_page(self, query, offset, rows):
+        if query != self.search_query or offset != self.search_offset:
+            return  # Another scroll event already showed this page
+        if not offset and not rows:
+            self.search_exhausted = True
+            self.search_results.addItem(QListWidgetItem("Кажется ничего нет 😕"))
+            return
+        self.search_offset += len(rows)
+        self.search_exhausted = len(rows) < self.search_page_size
+
+        for chat_id, message_id, sender_id, username, created_at, snippet, deleted, edited, event_type in rows:
+            title = self.chat_titles.get(chat_id, str(chat_id))
+            timestamp = datetime.datetime.fromtimestamp(created_at).strftime("%d.%m.%Y %H:%M")
+            marks = " (удалено)" if deleted else " (изменено)" if event_type != "created" or edited else ""
+            text = template_escape(snippet).replace(SNIPPET_START, "<b style='color: $accent;'>")
+            label = QLabel()
+            label.setObjectName("search_result")
+            # Rich text colours can't come from the sheet, the template is filled in again on a theme switch
+            label.setProperty(
+                "template",
+                f"<b>{template_escape(title)}</b> <span style='color: $timestamp;'>{timestamp}{marks}</span><br>"
+                f"{template_escape(username)}: {text.replace(SNIPPET_END, '</b>')}",
+            )
+            label.setText(self.search_result_html(label))
+            label.setTextFormat(Qt.TextFormat.RichText)
+            label.setWordWrap(True)
+            item = QListWidgetItem()
             item.setData(Qt.ItemDataRole.UserRole, chat_id)
-            item.setData(Qt.ItemDataRole.UserRole + 1, username)
-            self.chat_list.addItem(item)
+            item.setData(Qt.ItemDataRole.UserRole + 1, message_id)
+            item.setSizeHint(label.sizeHint())
+            self.search_results.addItem(item)
+            self.search_results.setItemWidget(item, label)
+
+    def search_result_html(self, label):
+        return Template(label.property("template")).safe_substitute(self.theme.palette._asdict())
+
+    def apply_theme(self):
+        # Restyles the widgets in place, the message view repaints itself from the new colours
+        self.setStyleSheet(self.theme.stylesheet)
+        for row in range(self.search_results.count()):
+            label = self.search_results.itemWidget(self.search_results.item(row))
+            if label is not None:
+                label.setText(self.search_result_html(label))
+
+    def on_search_scroll(self, value):
+        scrollbar = self.search_results.verticalScrollBar()
+        if value >= scrollbar.maximum() - 100:
+            self.load_search_page()
+
+    def open_search_result(self, item):
+        chat_id = item.data(Qt.ItemDataRole.UserRole)
+        if chat_id is None:
+            return
+        row = self.chats.row_of(chat_id)
+        if row is None:
+            return
+        index = self.chats.index(row)
+        shown = self.chat_filter_model.mapFromSource(index)  # Invalid when the filter hides the chat
+        if shown.isValid():
+            self.chat_list.setCurrentIndex(shown)
+        self.load_chat_messages(index)
 
-        if not self.dialogs:
-            item = QListWidgetItem("Кажется ничего нет 😕")
-            self.chat_list.addItem(item)
+    def load_chats(self):
+        self.chat_titles = {dialog.chat_id: dialog.title for dialog in self.dialogs}
+        self.chats.set_dialogs(self.dialogs)
+        self.load_chats_with_text(self.chat_filter.text())
+
+    def on_dialogs_loaded(self, dialogs):
+        if not self.dialogs:  # The refresh may have been faster
+            self.dialogs = dialogs
+            self.load_chats()
+
+    async def load_me(self):
+        account = await self.manager.load_account()
+        if account is not None:
+            return account
+        await self.manager.connect()  # First start, nothing cached yet
+        return await self.client.get_me()
+
+    def on_me_loaded(self, me):
+        if self.me is None:
+            self.me = me
+
+    def refresh_dialogs(self):
+        # Connects the client first, a connection error ends up in on_refresh_error as well
+        self.bridge.submit(
+            self.manager.refresh_dialogs, on_result=self.apply_dialog_changes, on_error=self.on_refresh_error
+        )
 
-    def check_new_messages(self):
-        if hasattr(self, "current_chat_id"):
+    def on_refresh_error(self, exc):
+        logging.error(f"ERR_REFRESH_DIALOGS: exc={exc!r}")  # Offline, the cached list stays until a retry gets through
+        QTimer.singleShot(REFRESH_RETRY, self.refresh_dialogs)
+
+    def apply_dialog_changes(self, changes):
+        # Updates only the items that changed and moves the ones whose position did, the list is not rebuilt
+        self.me = changes.account
+        self.chats.apply(changes)  # The selection follows the moved rows
+        self.dialogs = changes.dialogs
+        self.chat_titles = {dialog.chat_id: dialog.title for dialog in self.dialogs}
+        self.load_chats_with_text(self.chat_filter.text())
+
+    def load_latest(self):
+        if self.max_loaded_id is None:  # Nothing was stored locally when the chat was opened
+            self.load_messages_batch(direction="older", limit=50, scroll_to_bottom=True)
+        else:
             self.load_messages_batch(direction="newer", limit=50)
 
-    def load_chat_messages(self, item):
-        self.chat_name.setText(item.text())
+    def on_chat_synced(self, chat_id):
+        # sync_chat stores what arrived while the app was closed without pushing the messages, they are read as newer
+        # pages. The chat is open, they are not unread.
+        if chat_id == getattr(self, "current_chat_id", None):
+            self.at_latest = False
+            self.load_latest()
+            self.bridge.submit(self.manager.mark_read, chat_id)
+
+    def reached_latest(self):
+        self.at_latest = True
+        if self.missed_new:
+            self.missed_new = False
+            self.load_latest()
+
+    def load_chat_messages(self, index):
+        self.chat_name.setText(index.data(TITLE_ROLE) or index.data())
         self.chat_status.setText("Loading...")
         # Clear messages
-        while self.messages_layout.count():
-            w = self.messages_layout.takeAt(0).widget()
-            if w:
-                w.setParent(None)
-        self.current_chat_id = item.data(Qt.ItemDataRole.UserRole)
-        asyncio.run_coroutine_threadsafe(self.manager.save_chat_history(self.current_chat_id, 200), self.loop)
+        self.messages.clear()
+        self.bridge.cancel_group("chat")  # Pages still loading for the previous chat
+        self.current_chat_id = index.data(CHAT_ID_ROLE)
+        self.loop.call_soon_threadsafe(self.manager.prefetcher.yield_to, self.current_chat_id)
+        chat_id = self.current_chat_id
+        # Not in the group, it finishes in background
+        self.bridge.submit(self.manager.sync_chat, chat_id, on_result=lambda _: self.on_chat_synced(chat_id))
+        self.bridge.submit(self.manager.mark_read, chat_id)
 
         self.chat_status.setText("N/A")
 
         self.min_loaded_id = None
         self.max_loaded_id = None
+        self.at_latest = False
+        self.missed_new = False
         self.last_username = None
 
         # Initial load of last 50
         self.load_messages_batch(direction="older", limit=50, scroll_to_bottom=True)
 
     def load_messages_batch(self, direction="older", limit=50, scroll_to_bottom=False):
-        rows = []
+        chat_id = self.current_chat_id
         min_id = self.min_loaded_id if direction == "older" else None
         max_id = self.max_loaded_id if direction == "newer" else None
-        future = asyncio.run_coroutine_threadsafe(
-            self.manager.get_messages_for_batch(self.current_chat_id, direction, min_id, max_id, limit),
-            self.loop
+        # Scroll events repeat the same request while it runs, the bridge runs it once
+        self.bridge.submit(
+            self.fetch_batch,
+            chat_id,
+            direction,
+            min_id,
+            max_id,
+            limit,
+            self.message_view.text_layout(),
+            on_result=lambda rows: self.show_batch(chat_id, direction, min_id, max_id, limit, rows, scroll_to_bottom),
+            group="chat",
         )
-        rows = future.result()
 
+    async def fetch_batch(self, chat_id, direction, min_id, max_id, limit, layout):
+        # Runs on the loop. layout is the message view's (font, width) taken on the GUI thread, None before it is shown.
+        rows = await self.manager.get_messages_for_batch(chat_id, direction, min_id, max_id, limit)
+
+        if direction == "older" and min_id is not None and len(rows) < limit:
+            # Scrolled past what is stored locally, fetch the next older page from the API
+            if await self.manager.sync_older(chat_id, limit):
+                rows = await self.manager.get_messages_for_batch(chat_id, direction, min_id, max_id, limit)
+
+        if rows:
+            # Holes between this page and what is already shown are fetched first, the timeline stays continuous
+            if direction == "older":
+                low, high = rows[0][0], (min_id - 1 if min_id is not None else rows[-1][0])
+            else:
+                low, high = max_id + 1, rows[-1][0]
+            if await self.manager.fill_gaps(chat_id, low, high):
+                rows = await self.manager.get_messages_for_batch(chat_id, direction, min_id, max_id, limit)
+            # Wrapped sizes are measured here, the GUI thread only looks them up when it lays the page out
+            if layout is not None:
+                texts = [row[1] or "" for row in rows]
+                await asyncio.wrap_future(self.message_view.layouts.precompute(texts, *layout))
+        return rows
+
+    def show_batch(self, chat_id, direction, min_id, max_id, limit, rows, scroll_to_bottom=False):
+        if chat_id != getattr(self, "current_chat_id", None):
+            return
+        if (self.min_loaded_id if direction == "older" else self.max_loaded_id) != (
+            min_id if direction == "older" else max_id
+        ):
+            return  # Shown already by an earlier subscriber of the same request
+        # The first page of a chat ends at its newest message, a newer page that comes back short reached it
+        latest = min_id is None if direction == "older" else len(rows) < limit
         if not rows:
+            if latest:
+                self.reached_latest()
             return
 
-        # Update min/max loaded ids
-        new_ids = [row[0] for row in rows]
-        if self.min_loaded_id is None:
-            self.min_loaded_id = min(new_ids)
-            self.max_loaded_id = max(new_ids)
+        # Scroll position survives the next layout
+        scrollbar = self.message_view.verticalScrollBar()
+        near_bottom = scrollbar.value() >= scrollbar.maximum() - 50
+        if scroll_to_bottom or (direction == "newer" and near_bottom):
+            self.message_view.stick_to_bottom()
         else:
-            if direction == "older":
-                self.min_loaded_id = min(new_ids)
-            elif direction == "newer":
-                self.max_loaded_id = max(new_ids)
-
-        # Group messages (rows already ASC old to new)
-        grouped = []
-        current_group = None
-        prev_username = None
-        prev_timestamp = None
-
-        for msg_id, content, username, created_at, sender_id in rows:
-            timestamp = datetime.datetime.fromtimestamp(created_at).strftime("%H:%M")
-            is_own = sender_id == self.me.id
-            if current_group and username == prev_username and (created_at - prev_timestamp) <= 300:
-                current_group.append((content, timestamp, msg_id))
+            self.message_view.keep_position()
+
+        self.messages.me_id = self.me.id if self.me is not None else None
+        self.messages.add(rows)
+
+        # The view holds a bounded window, the far end is dropped and read again when scrolled back to
+        if self.messages.trim(self.message_view.MAX_ROWS, from_end=direction == "older") and direction == "older":
+            self.at_latest = False
+            latest = False
+        self.min_loaded_id, self.max_loaded_id = self.messages.ids[0], self.messages.ids[-1]
+        if latest:
+            self.reached_latest()
+
+    def apply_message_changes(self, changes):
+        # Changes pushed since the last frame, those of the open chat are applied in place in one go
+        chat_id = getattr(self, "current_chat_id", None)
+        new, edited, deleted, summaries = {}, {}, set(), {}
+        for change in changes:
+            if change.kind == "summary":  # Any chat, the sidebar row moves up as messages arrive
+                summaries[change.chat_id] = change.payload
+                continue
+            if change.chat_id != chat_id:
+                continue
+            if change.kind == "new":
+                if not self.at_latest:
+                    self.missed_new = True
+                elif self.min_loaded_id is None or change.message_id > self.min_loaded_id:
+                    new[change.message_id] = change.payload
+            elif change.kind == "edit":
+                if change.message_id in new:
+                    new[change.message_id] = new[change.message_id][:1] + (change.payload,) + new[change.message_id][2:]
+                else:
+                    edited[change.message_id] = change.payload
+            elif change.kind == "deleted":
+                deleted.add(change.message_id)
+        if new:
+            scrollbar = self.message_view.verticalScrollBar()
+            if scrollbar.value() >= scrollbar.maximum() - 50:
+                self.message_view.stick_to_bottom()
             else:
-                if current_group:
-                    grouped.append((prev_username, current_group, is_own))
-                current_group = [(content, timestamp, msg_id)]
-                prev_username = username
-            prev_timestamp = created_at
-
-        if current_group:
-            grouped.append((prev_username, current_group, is_own))
-
-        # Save scroll position
-        scrollbar = self.scroll_area.verticalScrollBar()
-        old_value = scrollbar.value()
-        old_max = scrollbar.maximum()
-
-        # Add groups
-        if direction == "older":
-            for username, msgs, is_own in reversed(grouped):
-                group = MessageGroupWidget(username, msgs, is_own, parent=self)
-                self.messages_layout.insertWidget(0, group)
-        else:  # newer
-            for username, msgs, is_own in grouped:
-                group = MessageGroupWidget(username, msgs, is_own, parent=self)
-                self.messages_layout.addWidget(group)
-
-        # Scroll logic
-        if scroll_to_bottom:
-            QTimer.singleShot(0, lambda: scrollbar.setValue(scrollbar.maximum()))
-        elif direction == "newer" and old_value >= old_max - 50:  # Was near bottom
-            QTimer.singleShot(0, lambda: scrollbar.setValue(scrollbar.maximum()))
-
-        # Limit number of widgets (~150 groups)
-        total_widgets = self.messages_layout.count()
-        max_widgets = 150
-        if total_widgets > max_widgets:
-            excess = total_widgets - max_widgets
-            if direction == "older":
-                for _ in range(excess):
-                    w = self.messages_layout.takeAt(self.messages_layout.count() - 1).widget()
-                    if w:
-                        w.setParent(None)
-                self.max_loaded_id = max(max(self.messages_layout.itemAt(i).widget().message_ids) for i in range(self.messages_layout.count()))
-            elif direction == "newer":
-                for _ in range(excess):
-                    w = self.messages_layout.takeAt(0).widget()
-                    if w:
-                        w.setParent(None)
-                self.min_loaded_id = min(min(self.messages_layout.itemAt(i).widget().message_ids) for i in range(self.messages_layout.count()))
+                self.message_view.keep_position()
+            self.messages.me_id = self.me.id if self.me is not None else None
+            self.messages.add(list(new.values()))
+            self.messages.trim(self.message_view.MAX_ROWS, from_end=False)
+            self.min_loaded_id, self.max_loaded_id = self.messages.ids[0], self.messages.ids[-1]
+            self.bridge.submit(self.manager.mark_read, chat_id)  # Shown as they arrive, nothing new is unread
+        for message_id, content in edited.items():
+            self.messages.update(message_id, content)
+        for message_id in deleted:
+            self.messages.mark_deleted(message_id)
+        for summary_chat_id, summary in summaries.items():
+            self.chats.update_summary(summary_chat_id, summary)
 
     def on_scroll(self, value):
-        scrollbar = self.scroll_area.verticalScrollBar()
+        scrollbar = self.message_view.verticalScrollBar()
         threshold = 200
+        if self.min_loaded_id is None:  # Nothing shown yet, the first page is on its way
+            return
 
         if value <= threshold and self.min_loaded_id > 1:
             self.load_messages_batch(direction="older", limit=50)
 
-        if value >= scrollbar.maximum() - threshold:
+        if value >= scrollbar.maximum() - threshold and not self.at_latest:
             self.load_messages_batch(direction="newer", limit=50)
 
     def send_message(self):
         message = self.message_input.toPlainText().strip()
-        if not message or not self.chat_list.currentItem():
+        if not message or not self.chat_list.currentIndex().isValid():
             return
 
-        chat_id = self.chat_list.currentItem().data(Qt.ItemDataRole.UserRole)
+        chat_id = self.chat_list.currentIndex().data(CHAT_ID_ROLE)
 
         async def send():
             sent_message = await self.client.send_message(chat_id, message)
@@ -503,9 +563,17 @@ class TelegramWindow(QMainWindow):
                 message_type="text",
             )
 
-        future = asyncio.run_coroutine_threadsafe(send(), self.loop)
-        future.result()
-        self.message_input.clear()
+        def sent(_):
+            if self.message_input.toPlainText().strip() == message:  # Unless the user started the next one
+                self.message_input.clear()
+
+        # A double click sends once, the key covers the chat and the text
+        self.bridge.submit(send, on_result=sent, key=("send", chat_id, message))
+
+    def on_message_context_menu(self, pos):
+        message_id = self.message_view.message_id_at(pos)
+        if message_id is not None:
+            self.show_message_context_menu(self.message_view.viewport().mapToGlobal(pos), message_id)
 
     def show_message_context_menu(self, pos, message_id):
         menu = QMenu(self)
@@ -521,10 +589,11 @@ class TelegramWindow(QMainWindow):
         menu.exec(pos)
 
     def copy_message(self, message_id):
-        future = asyncio.run_coroutine_threadsafe(
-            self.manager.get_message_content(self.current_chat_id, message_id), self.loop
+        self.bridge.submit(
+            self.manager.get_message_content, self.current_chat_id, message_id, on_result=self.set_clipboard
         )
-        content = future.result()
+
+    def set_clipboard(self, content):
         if content:
             QApplication.clipboard().setText(content)
 
@@ -533,29 +602,18 @@ class TelegramWindow(QMainWindow):
         print(f"Reply to {message_id}")
 
     def delete_message(self, message_id):
-        created_at = int(time.time())
-        future = asyncio.run_coroutine_threadsafe(
-            self.manager.delete_message(self.current_chat_id, message_id, created_at), self.loop
+        chat_id = self.current_chat_id
+        self.bridge.submit(
+            self.manager.delete_message,
+            chat_id,
+            message_id,
+            int(time.time()),
+            key=("delete", chat_id, message_id),  # The bubble is marked when the deletion is pushed back
         )
-        future.result()
-
-        # Find and remove widget
-        for i in range(self.messages_layout.count()):
-            group = self.messages_layout.itemAt(i).widget()
-            if isinstance(group, MessageGroupWidget) and message_id in group.message_ids:
-                idx = group.message_ids.index(message_id)
-                bubble_container = group.main_layout.itemAt(
-                    1 if group.main_layout.itemAt(0).spacerItem() else 0
-                ).widget()
-                bubble_layout = bubble_container.layout()
-                sub = bubble_layout.takeAt(idx).widget()
-                if sub:
-                    sub.setParent(None)
-                group.message_ids.pop(idx)
-                if not group.message_ids:
-                    group.setParent(None)
-                    self.messages_layout.removeWidget(group)
-                break
 
     def closeEvent(self, event):
+        self.unsubscribe_changes()
+        logging.info(f"CHANGE_FEED_STATS: {self.manager.changes.stats()}, frames={self.changes.stats()}")
+        logging.info(f"TEXT_LAYOUT_STATS: {self.message_view.layouts.stats()}")
+        self.message_view.layouts.close()
         super().closeEvent(event)
\ No newline at end of file